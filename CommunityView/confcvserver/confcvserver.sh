@@ -374,9 +374,9 @@ configure() {
     service proftpd restart
     rm -f /var/log/proftpd/proftpd.log* /var/log/proftpd/xferlog*
 
-    task="installing Python and its imaging library"
+    task="installing Python, its imaging library and NumPy"
     echo "***** $task" | tee /dev/tty
-    install "python python-imaging"
+    install "python python-imaging python-numpy"
 
     task="installing and configuring CommunityView server"
     echo "***** $task" | tee /dev/tty
@@ -394,6 +394,21 @@ configure() {
     cp $our_dir/../src/communityview.py $code_dir
     cp $our_dir/../src/utils.py $code_dir
     cp $our_dir/../src/stats.py $code_dir
+    cp $our_dir/../src/imagepool.py $code_dir
+    cp $our_dir/../src/motion.py $code_dir
+    cp $our_dir/../src/watcher.py $code_dir
+    cp $our_dir/../src/imageindex.py $code_dir
+    cp $our_dir/../src/sequencer.py $code_dir
+    cp $our_dir/../src/manifest.py $code_dir
+    cp $our_dir/../src/memory.py $code_dir
+    cp $our_dir/../src/histogram.py $code_dir
+    cp $our_dir/../src/timing.py $code_dir
+    cp $our_dir/../src/metrics.py $code_dir
+    cp $our_dir/../src/health.py $code_dir
+    cp $our_dir/../src/purge.py $code_dir
+    cp $our_dir/../src/storage.py $code_dir
+    cp $our_dir/../src/scheduler.py $code_dir
+    cp $our_dir/../src/controller.py $code_dir
 
     local perf_dir=$site_dir/perf
     mk_dir $perf_dir
@@ -25,9 +25,16 @@ class camera:
     shortname = ""
     longname = ""
     croparea = None # default is entire picture
+    sequence_gap_sec = None # default is the global sequence_gap_sec
+    weight = 1 # camera's share of the processing, relative to the others
+    max_queued = None # default is the global camera_max_queued
     
-    def __init__(self, shortname, longname, croparea = ("0", "0", "100%", "100%")):
+    def __init__(self, shortname, longname, croparea = ("0", "0", "100%", "100%"),
+                 sequence_gap_sec = None, weight = 1, max_queued = None):
         self.shortname = shortname 
         self.longname = longname
         self.croparea = croparea
+        self.sequence_gap_sec = sequence_gap_sec
+        self.weight = weight
+        self.max_queued = max_queued
         return
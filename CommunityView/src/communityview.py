@@ -37,11 +37,31 @@ import ImageDraw
 import shutil
 import datetime
 import re
+import math
+import hashlib
+import collections
 import threading
+import multiprocessing
 import time
 import logging.handlers
 import stats
-from utils import dir2date, file2time, get_images_in_dir, get_daydirs
+import imagepool
+import timing
+import motion
+import watcher
+import imageindex
+import sequencer
+import manifest
+import memory
+import metrics
+import health
+import purge
+import storage
+import scheduler
+import controller
+import argparse
+from utils import dir2date, get_images_in_dir, get_daydirs, \
+    write_if_changed, forget_written, set_thread_prefix
 from localsettings import * #@UnusedWildImport (Camera)
 
     
@@ -104,6 +124,13 @@ def htmlurlfromindex(filename) :
     return htmldir + "/" + os.path.splitext(filename.strip())[0] + html_postfix
 
 
+def imagepageurlfromindex(daydir, cam, filename):
+    if image_pages == "manifest":
+        return manifest.viewer_url_from_index(path2dir(daydir), cam.shortname,
+                                              filename)
+    return htmlurlfromindex(filename)
+
+
 def htmlurl(filename) :
     return os.path.splitext(filename.strip())[0] + html_postfix
 
@@ -131,23 +158,34 @@ def path2dir(daydir):
 def footer_html() :
     return """<h4 align="center">%s</h2>""" % footer
 
-def percent_convert(coor_str, max_size):
+def percent_convert(coor_str, max_size, scale=1):
+    # absolute coordinates are relative to the full-size image, so divide them
+    # by the scale factor if the image was decoded at reduced scale.
+    # Multiply before dividing so that percentages stay accurate at small sizes
     percent_result = re.search(r"([0-9]+)%", coor_str)
     if percent_result != None:
-        coor = max_size / 100 * int(percent_result.group(1))
+        coor = max_size * int(percent_result.group(1)) / 100
     else:
-        coor = int(coor_str)
+        coor = int(coor_str) / scale
     return coor
 
 
-def crop_image(img, croparea):
+def crop_box(croparea, size, scale=1):
     (crop_topleft_x, crop_topleft_y, crop_lowerright_x, crop_lowerright_y) = croparea
-    (size_x, size_y) = img.size
+    (size_x, size_y) = size
+
+    topleft_x = percent_convert(crop_topleft_x, size_x, scale)
+    topleft_y = percent_convert(crop_topleft_y, size_y, scale)    
+    lowerright_x = percent_convert(crop_lowerright_x, size_x, scale)
+    lowerright_y = percent_convert(crop_lowerright_y, size_y, scale)    
 
-    topleft_x = percent_convert(crop_topleft_x, size_x)
-    topleft_y = percent_convert(crop_topleft_y, size_y)    
-    lowerright_x = percent_convert(crop_lowerright_x, size_x)
-    lowerright_y = percent_convert(crop_lowerright_y, size_y)    
+    return (topleft_x, topleft_y, lowerright_x, lowerright_y)
+
+
+def crop_image(img, croparea, scale=1):
+    (size_x, size_y) = img.size
+    (topleft_x, topleft_y, lowerright_x, lowerright_y) = \
+            crop_box(croparea, img.size, scale)
 
     try:
         cropped_image = img.crop((topleft_x, topleft_y, lowerright_x, lowerright_y))
@@ -161,10 +199,75 @@ def crop_image(img, croparea):
     return cropped_image
 
 
-def processImage(indir, filename, cam, master_image=None):
-    global images_to_process
-    logging.info("Starting processImage()")
-    images_to_process = True    # only for testing purposes
+# for each resample_quality profile in localsettings, the filter used to
+# resize the cropped image, and whether JPEG images may be decoded at reduced
+# scale
+resample_profiles = {
+    "fast":     (Image.BILINEAR, True),
+    "balanced": (Image.ANTIALIAS, True),
+    "best":     (Image.ANTIALIAS, False),
+    }
+
+def resample_filter():
+    return resample_profiles[resample_quality][0]
+
+
+def open_image(infilepathfilename, croparea, target_size):
+    """Open the image file and return a tuple of the image and the factor by
+    which it will be reduced when decoded.  If the resample_quality profile
+    allows it, the JPEG decoder is set up (via draft()) to decode at the
+    smallest power-of-two scale that leaves the crop area at least as large
+    as target_size, which is much cheaper than decoding the full image.
+    In low_ram_mode this is always done."""
+    img = Image.open(infilepathfilename)
+    reduce_ok = resample_profiles[resample_quality][1] or low_ram_mode
+    if not reduce_ok or img.format != "JPEG":
+        return (img, 1)
+
+    (size_x, size_y) = img.size
+    (topleft_x, topleft_y, lowerright_x, lowerright_y) = \
+            crop_box(croparea, img.size)
+    # the ratio by which thumbnail() will shrink the full-scale crop area
+    ratio = max(float(lowerright_x - topleft_x) / target_size[0],
+                float(lowerright_y - topleft_y) / target_size[1])
+    if ratio < 2:
+        return (img, 1)
+    img.draft(img.mode, (int(math.ceil(size_x / ratio)),
+                         int(math.ceil(size_y / ratio))))
+    return (img, int(round(float(size_x) / img.size[0])))
+
+
+def draw_motion_boxes(master_image, img):
+    """Draw a box around each region of img that differs from master_image."""
+    found = None
+    if motion_detection == "numpy":
+        found = motion.find_motion(master_image, img, motion_threshold,
+                                   motion_min_pixels, motion_max_boxes)
+    if found is not None:
+        (rects, area) = found
+        logging.debug("motion area %.3f, %d boxes" % (area, len(rects)))
+    else:
+        # NumPy not available or not wanted. One box around all the changes
+        diff_image = ImageOps.posterize(ImageOps.grayscale(ImageChops.difference(master_image, img)),1)
+        rect = diff_image.getbbox()
+        rects = [rect] if rect != None else []
+    draw = ImageDraw.Draw(img)
+    for rect in rects:
+        draw.rectangle(rect, outline="yellow", fill=None)
+
+
+def make_derivatives(indir, filename, cam, master_image=None, mediumres=True):
+    """Make the thumbnail and (unless mediumres is False) mediumres images
+    for the incoming image and move the image to the hires dir.  Return a
+    tuple of the thumbnail image (or None if the image couldn't be cropped)
+    and the result for image_done() (or None if the image was left in the
+    incoming dir): a tuple of the arguments for stats.proc_stats(), the
+    image's state, and the bytes of the hires image and of the derivative
+    images made.
+    May be run in an image worker process, so it must not touch any state
+    shared with the rest of the program."""
+    result = None
+    deriv_bytes = 0
     try:
         infilepathfilename = inpath(indir, filename)
         thumbpathfilename = thumbpath(indir, filename)
@@ -172,21 +275,36 @@ def processImage(indir, filename, cam, master_image=None):
         logging.info("Processing %s" % (infilepathfilename))
     
         thumbexists = os.path.exists(thumbpathfilename)
-        mediumexists = os.path.exists(mediumpathfilename)
+        # a mediumres image that's put off is treated as already made
+        mediumexists = not mediumres or os.path.exists(mediumpathfilename)
     
         cropped_img = None
     
         if not (thumbexists and mediumexists):
             img = None
+            scale = 1
     
+            # we only need to decode enough of the image to make the
+            # largest of the derivative images that are missing
+            target_size = thumbsize if mediumexists else mediumsize
+            t = timing.start()
             try :
-                img = Image.open(infilepathfilename)
+                (img, scale) = open_image(infilepathfilename, cam.croparea,
+                                          target_size)
             except IOError, e:
                 logging.error("Cannot open file %s: %s" % (infilepathfilename, repr(e)))
                 
             if img:
-                cropped_img = crop_image(img, cam.croparea)
-                del img     # close img
+                # reserve the memory needed to decode the image, which happens
+                # when it is cropped
+                mb = memory.image_mb(img)
+                memory.reserve(mb)
+                try:
+                    cropped_img = crop_image(img, cam.croparea, scale)
+                    del img     # close img
+                finally:
+                    memory.release(mb)
+            timing.stop(timing.DECODE, t)
 
             if cropped_img == None:
                 # crop failure is likely due to attempting to process the
@@ -203,31 +321,40 @@ def processImage(indir, filename, cam, master_image=None):
                 if os.path.getmtime(infilepathfilename) >= (time.time() - 3600):
                     logging.info("Returning from processImage()" \
                                  + ", leaving original image in place")
-                    return cropped_img
+                    return (cropped_img, None)
     
             if (not mediumexists) and (not cropped_img==None) :
-                cropped_img.thumbnail(mediumsize, Image.ANTIALIAS)
+                t = timing.start()
+                cropped_img.thumbnail(mediumsize, resample_filter())
+                timing.stop(timing.RESIZE, t)
+                t = timing.start()
                 try :
                     cropped_img.save(mediumpathfilename, "JPEG")
-                except IOError:
+                    deriv_bytes += os.path.getsize(mediumpathfilename)
+                except (IOError, OSError):
                     logging.error("Cannot save mediumres image %s" % mediumpathfilename)
+                timing.stop(timing.ENCODE, t)
     
             if (not thumbexists) and (not cropped_img==None):
+                t = timing.start()
                 try:
-                    cropped_img.thumbnail(thumbsize, Image.ANTIALIAS)
+                    cropped_img.thumbnail(thumbsize, resample_filter())
                 except IOError:
                     logging.error("Cannot make thumbnail %s" % thumbpathfilename)
+                timing.stop(timing.RESIZE, t)
     
                 if master_image != None:
-                    #compare current image with Master and make a box around the change
-                    diff_image = ImageOps.posterize(ImageOps.grayscale(ImageChops.difference(master_image, cropped_img)),1)
-                    rect = diff_image.getbbox()
-                    if rect != None:
-                        ImageDraw.Draw(cropped_img).rectangle(rect, outline="yellow", fill=None)
+                    #compare current image with Master and make boxes around the changes
+                    t = timing.start()
+                    draw_motion_boxes(master_image, cropped_img)
+                    timing.stop(timing.MOTION, t)
+                t = timing.start()
                 try :
                     cropped_img.save(thumbpathfilename, "JPEG")
-                except IOError:
+                    deriv_bytes += os.path.getsize(thumbpathfilename)
+                except (IOError, OSError):
                     logging.error("Cannot save thumbnail %s" % thumbpathfilename)
+                timing.stop(timing.ENCODE, t)
     
       
         # done processing, capture the stats, move raw file to storage so we
@@ -235,35 +362,212 @@ def processImage(indir, filename, cam, master_image=None):
         #
         infilepathfilename = inpath(indir, filename)
         hirespathfilename = hirespath(indir, filename)
-        stats.proc_stats(infilepathfilename)
+        st = os.stat(infilepathfilename)
+        stats_args = (infilepathfilename, st.st_mtime, time.time())
         
         # if this is a file we can't crop, we're now giving up on ever being
         # able to crop it by moving it to hires.  Log as an error
         if cropped_img == None:
             logging.error("Failed to crop image; moving to hires: %s" % infilepathfilename);
             
+        t = timing.start()
         shutil.move(infilepathfilename,hirespathfilename)
+        timing.stop(timing.MOVE, t)
+        result = (stats_args, imageindex.FAILED if cropped_img == None
+                                else imageindex.PROCESSED,
+                  st.st_size, deriv_bytes)
     except Exception, e:
         logging.error("Unexpected exception in processImage()")
         logging.exception(e)
         
+    return (cropped_img, result)
+
+
+def image_done(result):
+    """Record the result returned by make_derivatives().  Always called in the
+    main CommunityView process."""
+    if result is not None:
+        (stats_args, state, hires_bytes, deriv_bytes) = result
+        stats.record_proc(*stats_args)
+        (indir, filename) = os.path.split(stats_args[0])
+        (daydir, camname) = os.path.split(indir)
+        get_image_index().set_state(path2dir(daydir), camname, filename,
+                                    state)
+        get_image_index().add_bytes(path2dir(daydir), camname, hires_bytes,
+                                    deriv_bytes)
+        stats.count_processed(path2dir(daydir), camname)
+
+
+def processImage(indir, filename, cam, master_image=None, mediumres=True):
+    global images_to_process
+    logging.info("Starting processImage()")
+    images_to_process = True    # only for testing purposes
+    (cropped_img, result) = make_derivatives(indir, filename, cam, 
+                                             master_image, mediumres)
+    image_done(result)
+        
     # return the thumbnail image
     logging.info("Returning from processImage()")
     return cropped_img
 
 
-def processImage_threading(indir, filename, cam, master_image=None):
-    
-    current_threads = threading.active_count()
-    
-    logging.info("current Threads %s" % current_threads)
-    
-    if current_threads >= max_threads :
-        processImage(indir, filename, cam, master_image)
-    else:
-        # start new thread
-        image_thread = threading.Thread(target=processImage, args=(indir, filename, cam, master_image))
-        image_thread.start()
+def image_to_data(img):
+    """Return a picklable representation of the image for passing to an
+    image worker process, or None if img is None."""
+    if img is None:
+        return None
+    tobytes = getattr(img, "tobytes", None) or img.tostring
+    return (img.mode, img.size, tobytes())
+
+
+def image_from_data(data):
+    """Return an image made from a representation returned by
+    image_to_data()."""
+    if data is None:
+        return None
+    frombytes = getattr(Image, "frombytes", None) or Image.fromstring
+    return frombytes(*data)
+
+
+def processImage_worker(indir, filename, cam, master_data, mediumres):
+    """Make the derivative images in an image worker process and return the
+    result for worker_image_done()."""
+    logging.info("Starting processImage()")
+    snap = timing.snapshot()
+    (unused_cropped_img, result) = make_derivatives(indir, filename, cam,
+                                    image_from_data(master_data), mediumres)
+    logging.info("Returning from processImage()")
+    return (result, timing.since(snap), health.take_records())
+
+
+def worker_image_done(indir, filename, worker_result):
+    """Record the result returned by processImage_worker() for the image,
+    along with the time the worker spent in each stage and the warnings and
+    errors it logged.  worker_result is None if the worker raised an
+    exception or died."""
+    if worker_result is None:
+        logging.error("%s: image job failed" % inpath(indir, filename))
+        # an image still in the incoming dir is processed again on a later
+        # pass.  One the worker moved to the hires dir before it failed is
+        # counted as processed, as image_done() would have
+        if not os.path.exists(inpath(indir, filename)):
+            (daydir, camname) = os.path.split(indir)
+            stats.count_processed(path2dir(daydir), camname)
+        return
+    (result, times, records) = worker_result
+    timing.add(times)
+    health.add_records(records)
+    image_done(result)
+
+
+def submit_image(indir, filename, cam, master_image=None, mediumres=True):
+    """Queue the image to be processed by the image pool and return a job
+    that may be passed to imagepool.wait().  If the pool isn't running,
+    process the image in this thread and return None."""
+    global images_to_process
+    images_to_process = True    # only for testing purposes
+    if imagepool.pool is None:
+        processImage(indir, filename, cam, master_image, mediumres)
+        return None
+    def done(worker_result):
+        worker_image_done(indir, filename, worker_result)
+    return submit_job(cam, processImage_worker,
+                      (indir, filename, cam, image_to_data(master_image),
+                       mediumres),
+                      done)
+
+
+def submit_job(cam, func, args, callback):
+    """Queue one of the camera's images to be processed by the image pool,
+    as imagepool.ImagePool.submit() does, but wait first if the camera has
+    as many images queued as it's allowed."""
+    max_queued = cam.max_queued if cam.max_queued is not None \
+                    else camera_max_queued
+    scheduler.slots.acquire(cam.shortname, max_queued)
+    def done(result):
+        try:
+            callback(result)
+        finally:
+            scheduler.slots.release(cam.shortname)
+    try:
+        return imagepool.pool.submit(func, args, done)
+    except:
+        scheduler.slots.release(cam.shortname)
+        raise
+
+
+def make_mediumres(indir, filename, cam):
+    """Make the mediumres image of an image in the hires dir, whose mediumres
+    image was put off in catch-up mode.  Return the bytes of the mediumres
+    image, or 0 if it couldn't be made.  May be run in an image worker
+    process."""
+    hirespathfilename = hirespath(indir, filename)
+    mediumpathfilename = mediumpath(indir, filename)
+    cropped_img = None
+    t = timing.start()
+    try :
+        (img, scale) = open_image(hirespathfilename, cam.croparea, mediumsize)
+        mb = memory.image_mb(img)
+        memory.reserve(mb)
+        try:
+            cropped_img = crop_image(img, cam.croparea, scale)
+            del img     # close img
+        finally:
+            memory.release(mb)
+    except IOError, e:
+        logging.error("Cannot open file %s: %s" % (hirespathfilename, repr(e)))
+    timing.stop(timing.DECODE, t)
+    if cropped_img is None:
+        return 0
+
+    t = timing.start()
+    cropped_img.thumbnail(mediumsize, resample_filter())
+    timing.stop(timing.RESIZE, t)
+    t = timing.start()
+    try :
+        cropped_img.save(mediumpathfilename, "JPEG")
+        return os.path.getsize(mediumpathfilename)
+    except (IOError, OSError):
+        logging.error("Cannot save mediumres image %s" % mediumpathfilename)
+        return 0
+    finally:
+        timing.stop(timing.ENCODE, t)
+
+
+def make_mediumres_worker(indir, filename, cam):
+    """Make the mediumres image in an image worker process and return the
+    result for worker_mediumres_done()."""
+    snap = timing.snapshot()
+    nbytes = make_mediumres(indir, filename, cam)
+    return (indir, nbytes, timing.since(snap), health.take_records())
+
+
+def worker_mediumres_done(indir, filename, worker_result):
+    """Record the result returned by make_mediumres_worker() for the image.
+    worker_result is None if the worker raised an exception or died, which
+    leaves the mediumres image to be made on a later pass."""
+    if worker_result is None:
+        logging.error("%s: mediumres job failed" % hirespath(indir, filename))
+        return
+    (indir, nbytes, times, records) = worker_result
+    timing.add(times)
+    health.add_records(records)
+    (daydir, camname) = os.path.split(indir)
+    get_image_index().add_bytes(path2dir(daydir), camname, 0, nbytes)
+
+
+def submit_mediumres(indir, filename, cam):
+    """Queue the making of the image's put-off mediumres image, as
+    submit_image() does."""
+    if imagepool.pool is None:
+        worker_mediumres_done(indir, filename,
+                              (indir, make_mediumres(indir, filename, cam),
+                               None, []))
+        return None
+    def done(worker_result):
+        worker_mediumres_done(indir, filename, worker_result)
+    return submit_job(cam, make_mediumres_worker, (indir, filename, cam),
+                      done)
 
 
 
@@ -273,6 +577,7 @@ def make_index_page(daydirs, day_index, cam, sequences, datestamp, hidden=False)
 
     # Index_hidden page SHOWS hidden images. Hidden = True
 
+    t = timing.start()
     daydir = daydirs[day_index]
 
     indir = os.path.join(daydir, cam.shortname)
@@ -285,7 +590,6 @@ def make_index_page(daydirs, day_index, cam, sequences, datestamp, hidden=False)
         logging.info("Making 'Hidden' Index Page")
         htmlfilepath = indexhtmlpath(indir, "index_hidden")
 
-    htmlfile = open(htmlfilepath, "w")
     htmlstring = """<title>%s - %s </title>
     """ % (datestamp.isoformat(), cam.longname)
     htmlstring += """<h1 align="center">%s</h1>
@@ -316,7 +620,7 @@ def make_index_page(daydirs, day_index, cam, sequences, datestamp, hidden=False)
                     %s sec.</td>
                     </tr>
             </table>
-            """ % (htmlurlfromindex(filename),  thumburlfromindex(filename), timestamp.time().isoformat(), sequencetime.seconds)
+            """ % (imagepageurlfromindex(daydir, cam, filename),  thumburlfromindex(filename), timestamp.time().isoformat(), sequencetime.seconds)
 
     htmlstring_thumbnails += "</td></tr></table>"
 
@@ -358,14 +662,15 @@ def make_index_page(daydirs, day_index, cam, sequences, datestamp, hidden=False)
 
     htmlstring += footer_html() 
     
-    htmlfile.write(htmlstring)
-    htmlfile.close()
+    write_if_changed(htmlfilepath, htmlstring)
+    timing.stop(timing.INDEXHTML, t)
 
     return
 
 
 
 def make_image_html(indir, sequences, sequence_index, image_index):
+    t = timing.start()
     sequence = sequences[sequence_index]
     (filename, timestamp) = sequence[image_index]
     logging.info("making html page for %s" % filename)
@@ -397,7 +702,6 @@ def make_image_html(indir, sequences, sequence_index, image_index):
 #     relativethumbpathfilename = thumburl(filename)
     relativemediumpathfilename = "../" + mediumresdir + "/" + os.path.splitext(filename.strip())[0] + medium_postfix
 
-    htmlfile = open(htmlfilepath, "w")
     htmlstring = """
     <h1 align="center">%s</h1>""" % title
 
@@ -472,13 +776,43 @@ def make_image_html(indir, sequences, sequence_index, image_index):
     htmlstring += footer_html() 
 
 
-    htmlfile.write(htmlstring)
-    htmlfile.close()
+    write_if_changed(htmlfilepath, htmlstring)
+    timing.stop(timing.IMAGEHTML, t)
 
     return
 
 
-def process_sequence(indir, sequences, cam, sequence_index):
+# the signature of each sequence when its image pages were last made, by
+# camera dir, {indir: {sequence index: signature}}, for only the
+# SIGNATURE_DIRS camera dirs whose pages were most recently made
+SIGNATURE_DIRS = 100
+sequence_signatures = collections.OrderedDict()
+signatures_lock = threading.Lock()
+
+def sequence_signature(sequences, sequence_index):
+    """Return a value that changes whenever anything shown on the pages of
+    the sequence's images changes: a digest of the sequence's images, and
+    the last image of the previous sequence and first image of the next."""
+    sequence = sequences[sequence_index]
+    signature = (hashlib.md5("\n".join(sequence.filenames())).digest(),)
+    if sequence_index > 0:
+        signature += (sequences[sequence_index-1][-1][0],)
+    else:
+        signature += (None,)
+    if sequence_index + 1 < len(sequences):
+        signature += (sequences[sequence_index+1][0][0],)
+    else:
+        signature += (None,)
+    return signature
+
+
+def process_sequence(indir, sequences, cam, sequence_index, limit=None,
+                     mediumres=True):
+    """Process up to limit (by default, all) of the sequence's unprocessed
+    images, and make its image pages if none are left.  If mediumres is
+    False (in catch-up mode), make only the thumbnails, and put off the
+    mediumres images and the image pages.  Return the number of images
+    processed."""
         
     logging.info("next_sequence")
     sequence = sequences[sequence_index]
@@ -493,23 +827,117 @@ def process_sequence(indir, sequences, cam, sequence_index):
 #         next_sequence = None
 
 
+    nprocessed = 0
     if os.path.exists(inpath(indir,sequence[-1][0])):
-        cleanest_thumbnail = processImage(indir, sequence[-1][0], cam)
+        cleanest_thumbnail = processImage(indir, sequence[-1][0], cam,
+                                          mediumres=mediumres)
+        nprocessed += 1
     else:
-        cleanest_thumbnail = None
+        # the rest of a sequence that was started on an earlier turn
+        cleanest_thumbnail = open_thumbnail(indir, sequence[-1][0])
     
+    jobs = []
+    unfinished = False
     for image_index in range(0,len(sequence)):
         currentfile = sequence[image_index]
         (filename, unused_timestamp) = currentfile
 
         if os.path.exists(inpath(indir,filename)):
-            processImage_threading(indir, filename, cam, cleanest_thumbnail)
-#            processImage(indir, filename, cam, cleanest_thumbnail)
+            if limit is not None and nprocessed >= limit:
+                unfinished = True
+                break
+            jobs.append(submit_image(indir, filename, cam, cleanest_thumbnail,
+                                     mediumres))
+            nprocessed += 1
+
+    # the sequence's derivative images must exist before its html is made
+    imagepool.wait(jobs)
+    if not unfinished and mediumres:
+        make_sequence_pages(indir, sequences, sequence_index)
+    return nprocessed
+
+
+def make_sequence_pages(indir, sequences, sequence_index):
+    """Make the image pages of the sequence, if they're out of date."""
+
+    if image_pages == "manifest":
+        # the image pages are made from the camera-day's manifest
+        return
+
+    # the image pages only need to be made again if the sequence's images or
+    # its links to the neighboring sequences have changed (or the pages have
+    # been removed)
+    sequence = sequences[sequence_index]
+    signature = sequence_signature(sequences, sequence_index)
+    with signatures_lock:
+        known = sequence_signatures.get(indir, {}).get(sequence_index)
+    if known == signature \
+            and os.path.exists(htmlpath(indir, sequence[0][0])) \
+            and os.path.exists(htmlpath(indir, sequence[-1][0])):
+        logging.info("sequence %d is unchanged" % sequence_index)
+        return
+
+    for image_index in range(0,len(sequence)):
         #make html file
-        
         make_image_html(indir, sequences, sequence_index, image_index)
+    with signatures_lock:
+        signatures = sequence_signatures.pop(indir, None)
+        if signatures is None:
+            signatures = {}
+            while sequence_signatures \
+                    and len(sequence_signatures) >= SIGNATURE_DIRS:
+                sequence_signatures.popitem(last=False)
+        sequence_signatures[indir] = signatures
+        signatures[sequence_index] = signature
+
+
+def finish_deferred(indir, sequences, cam, limit=None):
+    """Make up to limit (by default, all) of the mediumres images put off in
+    catch-up mode for the camera-day, and the image pages of each sequence
+    whose mediumres images are all made.  Return a tuple of the number of
+    images done and True if there are more left."""
+    (daydir, camname) = os.path.split(indir)
+    ndone = 0
+    for sequence_index in range(len(sequences)-1, -1, -1):
+        # only the images that have thumbnails; the others couldn't be
+        # decoded
+        todo = [f for f in sequences[sequence_index].filenames()
+                if not os.path.exists(mediumpath(indir, f))
+                   and os.path.exists(thumbpath(indir, f))
+                   and os.path.exists(hirespath(indir, f))]
+        if limit is not None and len(todo) > limit - ndone:
+            todo = todo[:limit - ndone]
+            unfinished = True
+        else:
+            unfinished = False
+        imagepool.wait([submit_mediumres(indir, f, cam) for f in todo])
+        ndone += len(todo)
+        health.beat()
+        if unfinished:
+            return (ndone, True)
+        make_sequence_pages(indir, sequences, sequence_index)
+    logging.info("finished the work put off for %s" % indir)
+    get_image_index().set_deferred(path2dir(daydir), camname, False)
+    return (ndone, False)
+
+
+def open_thumbnail(indir, filename):
+    """Return the image's thumbnail, or None if it has no thumbnail or it
+    can't be read."""
+    try:
+        img = Image.open(thumbpath(indir, filename))
+        img.load()
+        return img
+    except IOError:
+        return None
 
-    return
+
+def forget_sequence_signatures(daydir):
+    prefix = os.path.join(daydir, "")
+    with signatures_lock:
+        for indir in [d for d in sequence_signatures
+                      if d.startswith(prefix)]:
+            del sequence_signatures[indir]
 
 
 def make_subdirs(indir):
@@ -521,139 +949,234 @@ def make_subdirs(indir):
     return
 
 
-def sequence_dirlist(files, indir, last_processed_image):
-    logging.info("sequencing dirlist for %s" % indir)
-    (processingyear,processingmonth, processingday) = dir2date(indir)
-
-    timestamp = datetime.datetime(processingyear, processingmonth, processingday, 0, 0, 0)
+def get_image_index():
+    """Return the image index, opening it if necessary."""
+    if imageindex.index is None:
+        imageindex.open_index(index_path)
+    return imageindex.index
 
-    sequences = []
-    current_sequence = []
-    last_processed_sequence = 0
 
-    for filename in files:
-        if filename.lower().endswith(".jpg"):
-            (processinghour, processingmin, processingsec) = file2time(filename)
+def get_sequence_gap(cam):
+    """Return the number of seconds between two of the camera's sequences."""
+    if cam.sequence_gap_sec is not None:
+        return cam.sequence_gap_sec
+    return sequence_gap_sec
 
-            prev_time = timestamp
-            timestamp = datetime.datetime(processingyear, processingmonth, processingday, processinghour, processingmin, processingsec)
 
-            if timestamp - prev_time >= datetime.timedelta(0,sequence_gap_sec):
-                sequences.append(current_sequence)
-                current_sequence = []
-                
-            current_sequence.append((filename, timestamp))
-
-            if filename == last_processed_image:
-                last_processed_sequence = len(sequences) -1
-
-    sequences.append(current_sequence)
-
-    if sequences[0] == []:
-        sequences = sequences[1:]
-    return (sequences, last_processed_sequence)
-
-
-def make_sequence_and_last_processed_image(indir):
+def make_sequence_and_last_processed_image(indir, cam):
 
     origfiles = get_images_in_dir(indir)
 
+    # the index knows about the processed images, so only the incoming dir
+    # needs to be listed
+    (daydir, camname) = os.path.split(indir)
+    day = path2dir(daydir)
+    index = get_image_index()
+    index.sync_incoming(day, camname, indir, origfiles)
+    stats.set_unprocessed(day, camname, len(origfiles))
+
     if 0 == len(origfiles) :
         logging.info("there are no jpeg files to process in %s" % indir)
         sequences = None
         last_processed_sequence = None
     else:
-        hiresdirpath = hirespath(indir, "")    
-        hiresfiles = get_images_in_dir(hiresdirpath)
-
-
         # find first unprocessed image in orig.
-        if len(origfiles) > 0 :
-            first_unprocessed_image = origfiles[0]
-        else:
-            first_unprocessed_image = None
-
+        first_unprocessed_image = origfiles[0]
 
         # find last processed image in Hires.
-        if len(hiresfiles) > 0 :
-            last_processed_image = hiresfiles[-1]
-        else:
-            last_processed_image = None
-
+        last_processed_image = index.last_processed(day, camname)
 
-        if first_unprocessed_image != None :
-            last_processed_image = min(first_unprocessed_image,last_processed_image)
+        last_processed_image = min(first_unprocessed_image,last_processed_image)
     
         logging.info("last Processed image %s" % last_processed_image)
 
-        logging.info("sorting entire dirlist")
-        files = sorted(hiresfiles + origfiles)
+        # only the images added since the last pass need to be sequenced
+        sequences = sequencer.get_sequencer(datetime.date(*dir2date(daydir)),
+                                camname, get_sequence_gap(cam), index)
+        last_processed_sequence = sequences.sequence_of(last_processed_image)
+        if last_processed_sequence is None:
+            last_processed_sequence = 0
 
-        (sequences, last_processed_sequence) = sequence_dirlist(files, indir, last_processed_image)
+        # record the membership of the sequences we're about to process
+        index.set_seqs(day, camname,
+                       [(f, i) for i in range(last_processed_sequence,
+                                              len(sequences))
+                               for f in sequences[i].filenames()])
 
     return (sequences, last_processed_sequence)
 
 
-def process_day(daysdirs, day_index):
-
-    for cam in cameras:
-        daydir = daysdirs[day_index]
-
-        indir = os.path.join(daydir, cam.shortname)
-    
-        if os.path.isdir(indir):
-
-            (processingyear, processingmonth, processingday) = dir2date(daydir)
-
-            logging.info("Date %s, %s, %s" % (processingyear, processingmonth, processingday))
-
-            make_subdirs(indir)
-
-            (sequences, last_processed_sequence) = make_sequence_and_last_processed_image(indir)
-            if sequences != None:
+def make_manifest(indir, cam, sequences):
+    logging.info("Making manifest")
+    manifest.make_manifest(indir, path2dir(os.path.dirname(indir)), cam,
+                           sequences,
+                           {"thumbnails": thumbdir,
+                            "thumb_postfix": thumb_postfix,
+                            "mediumres": mediumresdir,
+                            "medium_postfix": medium_postfix,
+                            "hires": hiresdir})
 
-                # make index page.
 
-                datestamp = datetime.date(processingyear, processingmonth, processingday)
-                make_index_page(daysdirs, day_index, cam, sequences, datestamp)
-                make_index_page(daysdirs, day_index, cam, sequences, datestamp, hidden=True)
+def queue_day(daysdirs, day_index, priority):
+    """Queue each of the day's camera-days to be processed."""
 
-                # Process image sequence.
+    # we're about to look at all the images in the day dir, so forget
+    # the watcher's record of the ones that have arrived
+    if watcher.watcher is not None:
+        watcher.watcher.take_arrivals(daysdirs[day_index])
 
-                for sequence_index in range(last_processed_sequence, len(sequences)):
-                    process_sequence(indir, sequences, cam, sequence_index)
-             
-                logging.info('done')
-
-    return
-
-
-def deltree(deldir):
-    logging.info("deltree: %s" % (deldir))
-    files_to_be_deleted = sorted(os.listdir(deldir))
-    for file2del in files_to_be_deleted:
-        filepath = os.path.join(deldir, file2del)
-        if os.path.isdir(filepath):
-            deltree(filepath)
-            rmdir(filepath)
-        else:
-            logging.info("deleting %s" % filepath)
-            if delete == False :
-                logging.warn("would have deleted %s here - to really delete change delete flag to True" % filepath)
-            else :
-                os.remove(filepath)
-    rmdir(deldir)
-    return
+    for cam in cameras:
+        if os.path.isdir(os.path.join(daysdirs[day_index], cam.shortname)):
+            scheduler.work.put((daysdirs[day_index], cam), priority)
+
+
+def process_queued(daysdirs, max_priority=None):
+    """Claim and process queued camera-days, highest priority first, until
+    there are none left with a priority of max_priority or higher.  Each
+    turn at a camera-day processes up to its camera's share of images, and
+    a camera-day that has more is queued again for another turn.  A
+    camera-day with work put off in catch-up mode is queued again to do it
+    after all other work."""
+    while True:
+        item = scheduler.work.claim(max_priority)
+        if item is None:
+            return
+        unfinished = False
+        deferred_left = False
+        try:
+            (daydir, cam) = item
+            # the day may have been purged since it was queued
+            if daydir in daysdirs:
+                limit = None
+                if fair_share_quantum > 0:
+                    limit = scheduler.work.allowance(cam.shortname,
+                                            fair_share_quantum * cam.weight)
+                deferred = scheduler.is_deferred(
+                                    scheduler.work.claimed_priority(item))
+                (nprocessed, unfinished, deferred_left) = process_camday(
+                        daysdirs, daysdirs.index(daydir), cam, limit, deferred)
+                if limit is not None:
+                    scheduler.work.charge(cam.shortname, nprocessed,
+                                          unfinished)
+        finally:
+            scheduler.work.release(item, unfinished)
+        if deferred_left:
+            scheduler.work.put(item, scheduler.deferred_priority(
+                                        datetime.date(*dir2date(daydir))))
+        health.beat()
+
+
+def process_camday(daysdirs, day_index, cam, limit=None, deferred=False):
+    """Process up to limit (by default, all) of the camera-day's unprocessed
+    images.  In catch-up mode, put off their mediumres images and image
+    pages.  Otherwise, if deferred is True, go on to do the work that was
+    put off.  Return a tuple of the number of images processed, True if
+    there are more left, and True if there's work put off that deferred
+    wasn't True to do."""
+    daydir = daysdirs[day_index]
+    day = path2dir(daydir)
+    catchup = controller.catchup
+    nprocessed = 0
 
+    indir = os.path.join(daydir, cam.shortname)
 
-def purge_images(daydirs):
+    if os.path.isdir(indir):
+
+        (processingyear, processingmonth, processingday) = dir2date(daydir)
+
+        logging.info("Date %s, %s, %s" % (processingyear, processingmonth, processingday))
+
+        make_subdirs(indir)
+
+        (sequences, last_processed_sequence) = make_sequence_and_last_processed_image(indir, cam)
+        if sequences != None:
+
+            # make index page.
+
+            datestamp = datetime.date(processingyear, processingmonth, processingday)
+            make_index_page(daysdirs, day_index, cam, sequences, datestamp)
+            make_index_page(daysdirs, day_index, cam, sequences, datestamp, hidden=True)
+
+            # Process image sequence: the newest first, so that the latest
+            # images are on the site as soon as possible, then the backlog.
+
+            nincoming = len(get_image_index().incoming(day, cam.shortname))
+            order = range(last_processed_sequence, len(sequences))
+            for sequence_index in order[-1:] + order[:-1]:
+                n = process_sequence(indir, sequences, cam, sequence_index,
+                                None if limit is None else limit - nprocessed,
+                                mediumres=not catchup)
+                # note the work put off, once there is some
+                if catchup and n > 0 and nprocessed == 0:
+                    get_image_index().set_deferred(day, cam.shortname, True)
+                nprocessed += n
+                health.beat()
+                if limit is not None and nprocessed >= limit:
+                    left = len(get_image_index().incoming(day, cam.shortname))
+                    if left:
+                        logging.info("%s's turn is over" % cam.shortname)
+                        # if none of the images could be processed, leave
+                        # them for the next pass rather than trying again
+                        # at once
+                        return (nprocessed, left < nincoming, False)
+                    # nothing left to do but the rest of the pages
+                    limit = None
+
+            if image_pages == "manifest":
+                make_manifest(indir, cam, sequences)
+         
+            logging.info('done')
+
+        # the work put off in catch-up mode is done once the backlog has
+        # drained, after all other work
+        if not controller.catchup \
+                and get_image_index().is_deferred(day, cam.shortname):
+            if not deferred:
+                return (nprocessed, False, True)
+            sequences = sequencer.get_sequencer(datetime.date(*dir2date(daydir)),
+                                cam.shortname, get_sequence_gap(cam),
+                                get_image_index())
+            (ndone, unfinished) = finish_deferred(indir, sequences, cam,
+                        None if limit is None else max(limit - nprocessed, 0))
+            return (nprocessed + ndone, unfinished, False)
+
+    return (nprocessed, False, False)
+
+
+def purge_images(daydirs, strip=()):
+    """Delete the day dirs, and the mediumres images of the camera-days in
+    strip, a list of (day, camera shortname) tuples.  Their thumbnails are
+    kept, since their index pages show them."""
+    set_thread_prefix(threading.current_thread(), "Purge")
     logging.info("Starting purge_images()")
     try:
+        purge.set_idle_io_priority()
+        for (day, cam) in strip:
+            health.beat()
+            if delete == False :
+                logging.warn("would have purged the mediumres images of %s/%s here - to really delete change delete flag to True" % (day, cam))
+                continue
+            dirpath = os.path.join(root, day, cam, mediumresdir)
+            if os.path.isdir(dirpath):
+                purge.trash(dirpath, root)
+            get_image_index().set_stripped(day, cam,
+                imageindex.dir_bytes(os.path.join(root, day, cam, thumbdir)))
         for del_dir in daydirs:
-            deltree(del_dir)
+            health.beat()
+            if delete == False :
+                logging.warn("would have purged %s here - to really delete change delete flag to True" % del_dir)
+                continue
+            purge.trash(del_dir, root)
+            get_image_index().remove_day(path2dir(del_dir))
+            sequencer.remove_day(path2dir(del_dir))
+            stats.forget_unprocessed(path2dir(del_dir))
+            forget_sequence_signatures(del_dir)
+            forget_written(del_dir)
+        purge.empty_trash(root, purge_unlinks_per_sec)
     except Exception, e:
         logging.error("Unexpected exception in purge_images()")
         logging.exception(e)
+    health.done()
     logging.info("Returning from purge_images()")
     return
 
@@ -664,27 +1187,27 @@ def isdir_today(indir):
 
     return (processingyear==current.year and processingmonth == current.month and processingday==current.day)
 
-# keep track of what daydir processtoday() is working on in this var.
-# Set before processtoday_thread starts and cleared after it terminates.
-# We do this so that process_previous_days() can insure that it does not
-# start to work on a daydir that processtoday() is still working on
-#
-processtoday_daydir = ""
+def queue_previous_days(daydirs):
+    """Queue the camera-days of all the days but today, newest first."""
+    start = 1 if len(daydirs) > 0 and isdir_today(daydirs[0]) else 0
+    for day_index in range(start, len(daydirs)):
+        queue_day(daydirs, day_index, scheduler.day_priority(
+                                datetime.date(*dir2date(daydirs[day_index]))))
+
 
 def process_previous_days(daydirs):
+    """Work on the queued camera-days until there are none left.  Run by
+    each of the previous days' worker threads, which also take today's
+    camera-days when they're queued ahead of the previous days'."""
+    set_thread_prefix(threading.current_thread(), "PrevDays")
     logging.info("Starting process_previous_days()")
     try:
-        if len(daydirs) > 0:
-            start = 1 if isdir_today(daydirs[0]) else 0
-            for day_index in range(start, len(daydirs)):
-                if daydirs[day_index]==processtoday_daydir:
-                    logging.info("process_previous_days() skipping "
-                                 + processtoday_daydir)
-                    continue
-                process_day(daydirs, day_index)
+        health.beat()
+        process_queued(daydirs)
     except Exception, e:
         logging.error("Unexpected exception in process_previous_days()")
         logging.exception(e)
+    health.done()
     logging.info("Returning from process_previous_days()")
     return
 
@@ -694,23 +1217,41 @@ def process_previous_days(daydirs):
 #
 terminate_processtoday_loop = False 
 
+def wait_for_images(daydir, seconds):
+    """Sleep for the specified number of seconds, or until the watcher reports
+    that images have arrived in daydir.  If there's no watcher, just sleep."""
+    if watcher.watcher is None:
+        time.sleep(seconds)
+        return
+    for unused_tick in range(int(seconds / watch_tick_sec)):
+        if watcher.watcher.has_arrivals(daydir) \
+                or terminate_processtoday_loop:
+            return
+        time.sleep(watch_tick_sec)
+
+
 def processtoday(daysdirs):
+    set_thread_prefix(threading.current_thread(), "Today")
     logging.info("starting processtoday()")
     try:
         while isdir_today(daysdirs[0]):
-            process_day(daysdirs, 0)
+            health.beat()
+            queue_day(daysdirs, 0, scheduler.TODAY)
+            process_queued(daysdirs, scheduler.TODAY)
             logging.info("sleeping")
-            time.sleep(60)
+            wait_for_images(daysdirs[0], 60)
             if terminate_processtoday_loop:
                 break
     
         if not terminate_processtoday_loop:
             # remaining images in the directory at midnight are processed by one last pass
-            process_day(daysdirs, 0)
+            queue_day(daysdirs, 0, scheduler.TODAY)
+            process_queued(daysdirs, scheduler.TODAY)
     except Exception, e:
         logging.error("Unexpected exception in processtoday()")
         logging.exception(e)
 
+    health.done()
     logging.info("returning from processtoday()")
     return
 
@@ -720,7 +1261,6 @@ def make_day_list_html(daydirs):
     logging.info("Making daylist Index page")
     htmlfilepath = daylisthtmlpath("index")
 
-    htmlfile = open(htmlfilepath, "w")
     htmlstring = """<title>Day list last %s days</title>""" % retain_days
     htmlstring += """<h1 align="center">%s</h1>
     """ % title
@@ -750,8 +1290,7 @@ def make_day_list_html(daydirs):
 
     htmlstring += footer_html() 
 
-    htmlfile.write(htmlstring)
-    htmlfile.close()
+    write_if_changed(htmlfilepath, htmlstring)
 
     return
 
@@ -770,6 +1309,9 @@ def set_up_logging():
                 '%(asctime)s %(levelname)-8s %(threadName)-10s %(message)s',
                 '%m-%d %H:%M:%S'))
         logger.addHandler(logfile)
+
+        # count the warnings and errors for the per-server stats
+        logger.addHandler(health.CountingHandler())
         
         set_up_logging.not_done = False       
 set_up_logging.not_done = True  # logging should only be set up once, but
@@ -796,15 +1338,32 @@ def main():
     
     global images_to_process
     global files_to_purge
-    global processtoday_daydir
     
     set_up_logging()
     logging.info("Program Started, version %s", version_string)
     stats.restart_stats()
 
+    # start the image worker processes before any threads are started
+    # in low-RAM mode, only one image is decoded and encoded at a time
+    if low_ram_mode:
+        nworkers = 1
+    else:
+        nworkers = image_workers if image_workers > 0 \
+                    else multiprocessing.cpu_count()
+    imagepool.start(nworkers, image_queue_per_worker * nworkers,
+                    memory_budget_mb)
+
+    stats.start_aggregator()
+
+    if use_inotify:
+        watcher.start(root)
+
+    if metrics_port:
+        metrics.start(metrics_address, metrics_port)
+
     try:
         # Setup the threads, don't actually run them yet.
-        process_previous_days_thread = threading.Thread(target=process_previous_days, args=())
+        process_previous_days_threads = []
         processtoday_thread = threading.Thread(target=processtoday, args=())
     
         purge_thread = threading.Thread(target=purge_images, args=())
@@ -814,6 +1373,12 @@ def main():
             images_to_process = False   # only for testing purposes
         
             daydirs = get_daydirs()
+
+            # (re)open the image index in case it's been removed or replaced
+            imageindex.open_index(index_path)
+
+            if watcher.watcher is not None:
+                watcher.watcher.sync(daydirs)
     
             files_to_purge = len(daydirs) > retain_days
             
@@ -832,33 +1397,59 @@ def main():
                 stats.expire_stats(retain_days)
 
                 daydirs = daydirs[-retain_days:] # only move forward with the daydirs that are not about to be deleted.
+
+            # if the disk is getting full, delete more than retain_days would
+            (strip, days) = storage.plan(get_image_index(), root,
+                                         datetime.date.today().isoformat(),
+                                         storage_high_water_pct,
+                                         storage_low_water_pct)
+            if (strip or days) and not purge_thread.is_alive():
+                purge_thread = threading.Thread(target=purge_images,
+                        args=([os.path.join(root, d) for d in days], strip))
+                purge_thread.start()
+                daydirs = [d for d in daydirs if path2dir(d) not in days]
     
             # reverse sort the days so that most recent day is first
             daydirs = sorted(daydirs, reverse=True)
     
             make_day_list_html(daydirs)
+            if image_pages == "manifest":
+                manifest.make_viewer_page(root, title, footer)
                     
-            # track which daydir processtoday() is working on
-            if not processtoday_thread.is_alive():
-                processtoday_daydir = ""
-            
-            # Today runs in 1 thread, all previous days are handled in 1 thread 
-            # starting with most recent day and working backwards.
+            # Today runs in 1 thread.  All previous days are handled by
+            # the previous days' worker threads, starting with most recent day
+            # and working backwards, and they help with today's camera-days
+            # when there's more than one to do.  The scheduler's claims keep
+            # any two threads from working on the same camera-day.
             if len(daydirs) > 0 and isdir_today(daydirs[0]):
                 if not processtoday_thread.is_alive():
-                    processtoday_daydir = daydirs[0] # track which day we're on
                     processtoday_thread = threading.Thread(target=processtoday, args=(daydirs,))
                     processtoday_thread.start()
     
                    
             # Only if previous days is not running, run it to check that 
             # everything is processed.
-            if not process_previous_days_thread.is_alive():
-                process_previous_days_thread = threading.Thread(target=process_previous_days, args=(daydirs,))
-                process_previous_days_thread.start()
+            if not [t for t in process_previous_days_threads if t.is_alive()]:
+                queue_previous_days(daydirs)
+                nprevworkers = 1 if low_ram_mode else max(previous_days_workers, 1)
+                process_previous_days_threads = [
+                        threading.Thread(target=process_previous_days,
+                                         args=(daydirs,))
+                        for unused_i in range(nprevworkers)]
+                for t in process_previous_days_threads:
+                    t.start()
+
+            for (i, t) in enumerate(process_previous_days_threads):
+                metrics.threads["process_previous_days_%d" % i] = t
+            metrics.threads.update({
+                "processtoday": processtoday_thread,
+                "purge": purge_thread,
+                "stats": stats_thread,
+                "aggregator": stats.aggregator_thread,
+                })
                    
                
-            time.sleep(sleeptime) # sleep for x minutes
+            time.sleep(controller.sleeptime) # sleep for x minutes
             
             if terminate_main_loop:     # for testing purposes only
                 break
@@ -866,5 +1457,23 @@ def main():
         logging.error("Unexpected exception in main loop")
         logging.exception(e)
         
+def rebuild_index():
+    """Rebuild the image index from the images in the filesystem."""
+    set_up_logging()
+    logging.info("Rebuilding image index, version %s", version_string)
+    get_image_index().rebuild(get_daydirs(), cameras)
+    logging.info("Done rebuilding image index")
+
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+                        description="Build the CommunityView website from "
+                                    "uploaded images.")
+    parser.add_argument("--rebuild-index", action="store_true",
+                        help="rebuild the image index from the filesystem "
+                             "and exit. Stop the CommunityView service first.")
+    args = parser.parse_args()
+    if args.rebuild_index:
+        rebuild_index()
+    else:
+        main()
@@ -0,0 +1,162 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Adjust the number of image workers running at once, and the time between
+# the main loop's passes, to what the server can take, rather than to
+# settings tuned by hand for each server.
+#
+# Once a minute, the stats thread passes in the 95th percentile processing
+# latency of the images uploaded in the last few minutes and the number of
+# images waiting to be processed.  The workers are adjusted AIMD-style:
+#
+#   - if the load average per CPU core is above max_load_per_cpu, or the
+#     memory available is below min_memory_available_pct, the server is
+#     overloaded, and the number of workers is multiplied by
+#     concurrency_backoff.  The load average lags, so the workers are then
+#     left alone for concurrency_cooldown_min minutes before they're cut
+#     again or added to
+#   - otherwise, if images are waiting and either the latency is above
+#     target_proc_latency_min (or nothing has been processed) or the
+#     number waiting isn't going down, one worker is added
+#   - otherwise the number of workers is left as it is
+#
+# always within image_workers_min and the number of worker processes.  The
+# time between the main loop's passes is halved, down to sleeptime_min,
+# while images are waiting, and lengthened by sleeptime_min each minute
+# they're not, up to sleeptime.  Every decision is logged.
+#
+# The number of images waiting also switches catch-up mode on, when it
+# reaches catchup_backlog, and off again, when it's down to
+# catchup_backlog_off.  In catch-up mode only the thumbnails and index pages
+# are made, and the mediumres images and image pages are put off until the
+# backlog has drained.  Catch-up mode doesn't depend on
+# adaptive_concurrency.
+
+import os
+import multiprocessing
+import logging
+import memory
+import imagepool
+from localsettings import adaptive_concurrency, image_workers_min, \
+    target_proc_latency_min, max_load_per_cpu, min_memory_available_pct, \
+    concurrency_backoff, concurrency_cooldown_min, sleeptime_min, \
+    sleeptime as sleeptime_max, catchup_backlog, catchup_backlog_off
+
+# the time between the main loop's passes
+sleeptime = sleeptime_max
+
+# the images waiting at the last update
+last_backlog = None
+
+# the minutes left before the workers may be changed again after a cut
+cooldown = 0
+
+# True while in catch-up mode
+catchup = False
+
+
+def load_per_cpu():
+    """Return the 1-minute load average per CPU core, or None if it isn't
+    available."""
+    try:
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (OSError, AttributeError, NotImplementedError):
+        return None
+
+
+def decide(workers, max_workers, poll, latency, backlog, prev_backlog, load,
+           mem_pct, cooling=0):
+    """Return a tuple of the new number of workers and time between passes,
+    and the reason for the number of workers, given the current ones and the
+    signals: the processing latency in minutes (None if nothing has been
+    processed), the images waiting now and a minute ago (None if not
+    known), the load average per CPU core and the percent of memory
+    available (None if not known).  While cooling is more than 0 minutes,
+    the number of workers is left as it is."""
+    if cooling > 0:
+        reason = "cooling down after a cut, %d min left" % cooling
+    elif load is not None and load > max_load_per_cpu:
+        reason = "load %.2f per CPU > %.2f" % (load, max_load_per_cpu)
+        workers = int(workers * concurrency_backoff)
+    elif mem_pct is not None and mem_pct < min_memory_available_pct:
+        reason = "memory available %.0f%% < %.0f%%" \
+                    % (mem_pct, min_memory_available_pct)
+        workers = int(workers * concurrency_backoff)
+    elif backlog > 0 and latency is None:
+        reason = "%d images waiting, none processed" % backlog
+        workers += 1
+    elif backlog > 0 and latency > target_proc_latency_min:
+        reason = "%d images waiting, latency %.1f min > %.1f" \
+                    % (backlog, latency, target_proc_latency_min)
+        workers += 1
+    elif backlog > 0 and prev_backlog is not None and backlog >= prev_backlog:
+        reason = "%d images waiting, was %d" % (backlog, prev_backlog)
+        workers += 1
+    else:
+        reason = "%d images waiting, latency %s" \
+                    % (backlog, "%.1f min" % latency if latency is not None
+                                else "n/a")
+    workers = max(min(image_workers_min, max_workers),
+                  min(workers, max_workers))
+
+    if backlog > 0:
+        poll = max(sleeptime_min, poll / 2)
+    else:
+        poll = min(sleeptime_max, poll + sleeptime_min)
+    return (workers, poll, reason)
+
+
+def update_catchup(backlog):
+    """Switch catch-up mode on or off for the number of images waiting."""
+    global catchup
+    if not catchup and catchup_backlog > 0 and backlog >= catchup_backlog:
+        logging.warn("catch-up mode on: %d images waiting; putting off "
+                     "mediumres images and image pages" % backlog)
+        catchup = True
+    elif catchup and backlog <= catchup_backlog_off:
+        logging.info("catch-up mode off: %d images waiting" % backlog)
+        catchup = False
+
+
+def update(latency, backlog):
+    """Adjust the image workers and the time between passes to the signals,
+    and switch catch-up mode on or off.  Called by the stats thread once a
+    minute."""
+    global sleeptime, last_backlog, cooldown
+    update_catchup(backlog)
+    pool = imagepool.pool
+    if not adaptive_concurrency or pool is None:
+        return
+    (workers, poll, reason) = decide(pool.active, pool.nworkers, sleeptime,
+                                     latency, backlog, last_backlog,
+                                     load_per_cpu(), memory.available_pct(),
+                                     cooldown)
+    last_backlog = backlog
+    if workers < pool.active:
+        cooldown = concurrency_cooldown_min
+    elif cooldown > 0:
+        cooldown -= 1
+    logging.info("concurrency: %d -> %d image workers, %d -> %d sec between "
+                 "passes: %s" % (pool.active, workers, sleeptime, poll, reason))
+    if workers != pool.active:
+        pool.set_active(workers)
+    sleeptime = poll
@@ -0,0 +1,135 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Counts of the warnings and errors logged, and heartbeats of the
+# long-running threads, for the per-server stats.
+#
+# The CountingHandler is added to the root logger.  For each WARNING or
+# higher record, it appends the prefix of the logging thread's name (e.g.,
+# "Today" for "Today-3") and whether it was an error to a deque, without
+# taking a lock, and the stats thread takes the counts once a minute.  Image
+# worker processes take their own records after each image and return them
+# to be added to this process's.
+#
+# Each long-running thread calls beat() as it makes progress and done() when
+# it returns, so that a thread that has stalled shows up as a heartbeat that
+# keeps getting older.  The heartbeats are kept by the full thread name, and
+# the oldest is reported for each name prefix, so that one of several
+# threads with the same prefix (e.g., the PrevDays workers) that has stalled
+# isn't hidden by the others.
+
+import collections
+import logging
+import re
+import threading
+import time
+
+# the threads whose heartbeats are recorded in the stats, by name prefix
+HEARTBEATS = ("Today", "PrevDays", "Purge", "Stats", "Aggregator")
+
+# (thread name prefix, True if an error) for each record not yet counted
+_records = collections.deque()
+
+# counts of all the records taken: {(thread name prefix, "error" or
+# "warning"): count}
+totals = {}
+
+# time.time() of each thread's last heartbeat: {thread name: time}
+heartbeats = {}
+
+
+def thread_prefix(name):
+    """Return the thread name without its "-<thread number>"."""
+    return re.sub(r"-\d+$", "", name)
+
+
+class CountingHandler(logging.Handler):
+    """Counts the WARNING and higher records logged."""
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+
+    def handle(self, record):
+        # deque.append() is atomic, so unlike logging.Handler.handle(), take
+        # no lock
+        if record.levelno >= self.level:
+            _records.append((thread_prefix(record.threadName),
+                             record.levelno >= logging.ERROR))
+        return True
+
+    def emit(self, record):
+        pass
+
+
+def take_records():
+    """Return a list of the records not yet taken, and forget them."""
+    records = []
+    try:
+        while True:
+            records.append(_records.popleft())
+    except IndexError:
+        pass
+    return records
+
+
+def add_records(records):
+    """Add records returned by take_records() in another process."""
+    if records:
+        _records.extend(records)
+
+
+def take_counts():
+    """Return a tuple of the numbers of errors and warnings logged since the
+    last call and a dict of them by thread name prefix, {prefix: [errors,
+    warnings]}, and add them to the totals.  Only called by the stats
+    thread."""
+    by_thread = {}
+    for (prefix, is_error) in take_records():
+        by_thread.setdefault(prefix, [0, 0])[0 if is_error else 1] += 1
+    for (prefix, (errors, warnings)) in by_thread.items():
+        for (level, n) in (("error", errors), ("warning", warnings)):
+            if n:
+                totals[(prefix, level)] = totals.get((prefix, level), 0) + n
+    return (sum([c[0] for c in by_thread.values()]),
+            sum([c[1] for c in by_thread.values()]), by_thread)
+
+
+def beat():
+    """Record a heartbeat of the calling thread."""
+    heartbeats[threading.current_thread().name] = time.time()
+
+
+def done():
+    """Forget the calling thread's heartbeat, because it is returning."""
+    heartbeats.pop(threading.current_thread().name, None)
+
+
+def heartbeat_age(prefix, now=None):
+    """Return the seconds since the oldest last heartbeat of the threads
+    with the name prefix, or None if none of them is running.  A thread
+    that ended without calling done() isn't counted."""
+    running = set([t.name for t in threading.enumerate()])
+    beats = [last for (name, last) in heartbeats.items()
+             if thread_prefix(name) == prefix and name in running]
+    if not beats:
+        return None
+    return max((now or time.time()) - min(beats), 0)
@@ -0,0 +1,108 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Fixed-bucket, log-scale histograms of latencies, from which percentiles can
+# be estimated without keeping the individual values.
+#
+# Latencies are in minutes.  Bucket 0 holds latencies of less than a second;
+# above that, each bucket is 2**(1/4) (about 19%) wider than the one before,
+# up to about ten days, and the last bucket holds everything longer.  A
+# percentile is estimated as the geometric middle of the bucket it falls in,
+# so it is within about 10% of the true value.
+#
+# A histogram is an array('I') of NBUCKETS counts.  Histograms with the same
+# buckets can simply be added together, e.g., to combine cameras or minutes.
+
+import array
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HMIN = 1.0 / 60         # upper bound of bucket 0: one second
+RATIO = 2 ** 0.25       # ratio of the bounds of successive buckets
+NBUCKETS = 82
+
+_logratio = math.log(RATIO)
+
+
+def new():
+    """Return an empty histogram."""
+    return array.array("I", [0]) * NBUCKETS
+
+
+def bucket(value):
+    """Return the index of the bucket that holds the value."""
+    if value < HMIN:
+        return 0
+    return min(int(math.log(value / HMIN) / _logratio) + 1, NBUCKETS - 1)
+
+
+def bucket_value(i):
+    """Return the value that represents the values in bucket i."""
+    if i == 0:
+        return HMIN / 2
+    return HMIN * RATIO ** (i - 1) * math.sqrt(RATIO)
+
+
+def bucket_bound(i):
+    """Return the upper bound of the values in bucket i, which is infinite
+    for the last bucket."""
+    if i == NBUCKETS - 1:
+        return float("inf")
+    return HMIN * RATIO ** i
+
+
+def add(hist, value, n=1):
+    """Count n occurrences of the value in the histogram."""
+    hist[bucket(value)] += n
+
+
+def merge(hists):
+    """Return a new histogram that is the sum of the histograms."""
+    hists = list(hists)
+    if numpy is not None and hists:
+        sums = numpy.sum([numpy.frombuffer(h, dtype=numpy.uintc)
+                          for h in hists], axis=0)
+        return array.array("I", sums.tolist())
+    total = new()
+    for h in hists:
+        for i in xrange(NBUCKETS):
+            total[i] += h[i]
+    return total
+
+
+def percentile(hist, q):
+    """Return the estimated q'th quantile (0 < q <= 1) of the values in the
+    histogram, or None if it's empty."""
+    count = sum(hist)
+    if count == 0:
+        return None
+    rank = q * count
+    cum = 0
+    for i in xrange(NBUCKETS):
+        cum += hist[i]
+        if cum >= rank:
+            return bucket_value(i)
+    return bucket_value(NBUCKETS - 1)
@@ -0,0 +1,332 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Persistent index of the images in the upload directory, kept in an SQLite
+# database at index_path, outside the website.
+#
+# For each image the index records its day and camera, its time of day (from
+# its filename), its processing state and the sequence it belongs to.  This
+# lets each processing pass find its work without listing the hires dir of
+# every camera for every day.
+#
+# The first time a camera-day is seen, its hires dir is listed once to import
+# the images that were processed before the index existed.
+#
+# The index also keeps the bytes used by each camera-day's hires images and
+# by its derivative (thumbnail and mediumres) images, which are added to as
+# images are processed, for the storage governor, and which camera-days have
+# work put off in catch-up mode.  If the index is lost or damaged it can be
+# rebuilt from the filesystem with
+#   python communityview.py --rebuild-index
+#
+# All access is through one connection, serialized by a lock, and only from
+# the main CommunityView process.
+
+import sqlite3
+import threading
+import os
+import logging
+from utils import file2time, get_images_in_dir
+
+# image states
+INCOMING = 0    # in the incoming (camera) dir, waiting to be processed
+PROCESSED = 1   # processed and moved to the hires dir
+FAILED = 2      # couldn't be processed; moved to the hires dir
+
+_schema = """
+CREATE TABLE IF NOT EXISTS images (
+    day         TEXT NOT NULL,      -- YYYY-MM-DD
+    cam         TEXT NOT NULL,      -- camera shortname
+    filename    TEXT NOT NULL,
+    secs        INTEGER NOT NULL,   -- seconds since midnight, from filename
+    state       INTEGER NOT NULL,
+    seq         INTEGER,            -- index of the image's sequence
+    PRIMARY KEY (day, cam, filename)
+);
+CREATE INDEX IF NOT EXISTS images_state ON images (day, cam, state);
+-- camera-days whose hires dir has been imported
+CREATE TABLE IF NOT EXISTS daycams (
+    day         TEXT NOT NULL,
+    cam         TEXT NOT NULL,
+    hires_bytes INTEGER NOT NULL,   -- bytes of hires images
+    deriv_bytes INTEGER NOT NULL,   -- bytes of derivative images
+    stripped    INTEGER NOT NULL DEFAULT 0,
+                                    -- 1 if the mediumres images have been
+                                    -- deleted
+    deferred    INTEGER NOT NULL DEFAULT 0,
+                                    -- 1 if mediumres images and image pages
+                                    -- were put off in catch-up mode
+    PRIMARY KEY (day, cam)
+);
+"""
+
+# the dirs of each camera-day's derivative images
+derivative_dirs = ("thumbnails", "mediumres")
+
+
+def dir_bytes(dirpath):
+    """Return the total size of the files in the directory, 0 if it doesn't
+    exist."""
+    total = 0
+    try:
+        names = os.listdir(dirpath)
+    except OSError:
+        return 0
+    for name in names:
+        try:
+            total += os.path.getsize(os.path.join(dirpath, name))
+        except OSError:
+            pass
+    return total
+
+# the open index, if any
+index = None
+
+
+def filename2secs(filename):
+    (hr, minute, sec) = file2time(filename)
+    if hr is None:
+        return 0
+    return hr*3600 + minute*60 + sec
+
+
+class ImageIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        with self.lock, self.conn:
+            self.conn.executescript(_schema)
+        self.ino = os.stat(path).st_ino
+        # incremented whenever images are removed, which may free their
+        # rowids for reuse, so that a Sequencer can tell it must start over
+        self.generation = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def is_current(self):
+        """Return True if the database file is still the one that was
+        opened, i.e., it hasn't been removed or replaced."""
+        try:
+            return os.stat(self.path).st_ino == self.ino
+        except OSError:
+            return False
+
+    def _insert(self, day, cam, filenames, state):
+        """Add the images to the index if they aren't already there, and
+        return the number added.  Caller must hold the lock."""
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO images (day, cam, filename, secs, state) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(day, cam, f, filename2secs(f), state) for f in filenames])
+        return self.conn.total_changes - before
+
+    def sync_incoming(self, day, cam, indir, filenames):
+        """Bring the index up to date for a camera-day, given the list of
+        images currently in its incoming dir, indir.  If the camera-day
+        hasn't been seen before, import its hires dir.  Incoming images that
+        the index doesn't know about are added, and images the index thinks
+        are incoming but no longer are have their state corrected.  Return the
+        number of incoming images added."""
+        with self.lock, self.conn:
+            known = self.conn.execute(
+                "SELECT 1 FROM daycams WHERE day=? AND cam=?",
+                (day, cam)).fetchone()
+            if not known:
+                logging.info("importing hires dir of %s into index" % indir)
+                self._insert(day, cam,
+                             get_images_in_dir(os.path.join(indir, "hires")),
+                             PROCESSED)
+                self.conn.execute(
+                        "INSERT INTO daycams (day, cam, hires_bytes, "
+                        "deriv_bytes) VALUES (?, ?, ?, ?)",
+                        (day, cam) + camday_bytes(indir))
+            added = self._insert(day, cam, filenames, INCOMING)
+            current = set(filenames)
+            for (f,) in self.conn.execute(
+                    "SELECT filename FROM images "
+                    "WHERE day=? AND cam=? AND state=?",
+                    (day, cam, INCOMING)).fetchall():
+                if f in current:
+                    continue
+                if os.path.exists(os.path.join(indir, "hires", f)):
+                    self.conn.execute(
+                        "UPDATE images SET state=? "
+                        "WHERE day=? AND cam=? AND filename=?",
+                        (PROCESSED, day, cam, f))
+                else:
+                    self.conn.execute(
+                        "DELETE FROM images "
+                        "WHERE day=? AND cam=? AND filename=?",
+                        (day, cam, f))
+                    self.generation += 1
+        return added
+
+    def set_state(self, day, cam, filename, state):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE images SET state=? "
+                "WHERE day=? AND cam=? AND filename=?",
+                (state, day, cam, filename))
+
+    def set_seqs(self, day, cam, filename_seqs):
+        """Record the sequence membership of each image, given a list of
+        (filename, sequence index) tuples."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE images SET seq=? "
+                "WHERE day=? AND cam=? AND filename=? "
+                "AND (seq IS NULL OR seq!=?)",
+                [(s, day, cam, f, s) for (f, s) in filename_seqs])
+
+    def incoming(self, day, cam):
+        """Return a sorted list of the filenames of the camera-day's
+        unprocessed images."""
+        with self.lock:
+            return [f for (f,) in self.conn.execute(
+                    "SELECT filename FROM images "
+                    "WHERE day=? AND cam=? AND state=? ORDER BY filename",
+                    (day, cam, INCOMING))]
+
+    def last_processed(self, day, cam):
+        """Return the filename of the camera-day's last processed image,
+        or None if there isn't one."""
+        with self.lock:
+            return self.conn.execute(
+                    "SELECT MAX(filename) FROM images "
+                    "WHERE day=? AND cam=? AND state!=?",
+                    (day, cam, INCOMING)).fetchone()[0]
+
+    def images(self, day, cam, after=None):
+        """Return a list of (filename, secs) for all of the camera-day's
+        images, sorted by filename, or only those whose filenames sort after
+        the specified filename."""
+        with self.lock:
+            return self.conn.execute(
+                    "SELECT filename, secs FROM images "
+                    "WHERE day=? AND cam=? AND filename>? ORDER BY filename",
+                    (day, cam, after or "")).fetchall()
+
+    def last_rowid(self):
+        """Return the rowid of the image added to the index most recently, 0
+        if there are none.  Images added later have greater rowids."""
+        with self.lock:
+            return self.conn.execute(
+                    "SELECT IFNULL(MAX(rowid), 0) FROM images").fetchone()[0]
+
+    def images_since(self, day, cam, rowid):
+        """Return a list of (filename, secs) for the camera-day's images
+        whose rowids are greater than rowid, sorted by filename."""
+        with self.lock:
+            # the + keeps SQLite from using the primary key, which would
+            # scan all of the camera-day's images rather than only the new
+            # rows
+            return self.conn.execute(
+                    "SELECT filename, secs FROM images "
+                    "WHERE rowid>? AND +day=? AND +cam=? ORDER BY filename",
+                    (rowid, day, cam)).fetchall()
+
+    def add_bytes(self, day, cam, hires_bytes, deriv_bytes):
+        """Add to the bytes used by the camera-day's images."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE daycams SET hires_bytes=hires_bytes+?, "
+                "deriv_bytes=deriv_bytes+? WHERE day=? AND cam=?",
+                (hires_bytes, deriv_bytes, day, cam))
+
+    def set_stripped(self, day, cam, deriv_bytes):
+        """Record that the camera-day's mediumres images have been deleted,
+        leaving deriv_bytes of thumbnails."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE daycams SET deriv_bytes=?, stripped=1, deferred=0 "
+                "WHERE day=? AND cam=?", (deriv_bytes, day, cam))
+
+    def set_deferred(self, day, cam, deferred):
+        """Record whether the camera-day has mediumres images and image pages
+        still to be made."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE daycams SET deferred=? WHERE day=? AND cam=?",
+                (1 if deferred else 0, day, cam))
+
+    def is_deferred(self, day, cam):
+        with self.lock:
+            row = self.conn.execute(
+                    "SELECT deferred FROM daycams WHERE day=? AND cam=?",
+                    (day, cam)).fetchone()
+            return bool(row and row[0])
+
+    def usage(self):
+        """Return a list of (day, cam, hires bytes, derivative bytes,
+        stripped) for all of the camera-days, oldest first."""
+        with self.lock:
+            return self.conn.execute(
+                    "SELECT day, cam, hires_bytes, deriv_bytes, stripped "
+                    "FROM daycams "
+                    "ORDER BY day, cam").fetchall()
+
+    def remove_day(self, day):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM images WHERE day=?", (day,))
+            self.conn.execute("DELETE FROM daycams WHERE day=?", (day,))
+            self.generation += 1
+
+    def rebuild(self, daydirs, cameras):
+        """Discard the index's contents and rebuild it from the filesystem."""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM images")
+            self.conn.execute("DELETE FROM daycams")
+            self.generation += 1
+        for daydir in daydirs:
+            day = os.path.basename(daydir)
+            for cam in cameras:
+                indir = os.path.join(daydir, cam.shortname)
+                if os.path.isdir(indir):
+                    self.sync_incoming(day, cam.shortname, indir,
+                                       get_images_in_dir(indir))
+
+
+def camday_bytes(indir):
+    """Return a tuple of the bytes used by the hires and the derivative
+    images in the camera-day dir indir, by listing the dirs."""
+    return (dir_bytes(os.path.join(indir, "hires")),
+            sum([dir_bytes(os.path.join(indir, d)) for d in derivative_dirs]))
+
+
+def open_index(path):
+    """Open the index database at path, creating it if necessary.  If the
+    index is already open, reopen it only if the path has changed or the
+    file has been removed or replaced."""
+    global index
+    if index is not None:
+        if index.path == path and index.is_current():
+            return
+        index.close()
+        index = None
+    logging.info("opening image index %s" % path)
+    index = ImageIndex(path)
@@ -0,0 +1,262 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Pool of worker processes for making the derivative (thumbnail and mediumres)
+# images.  Image decoding and resizing is CPU-bound, so running it in
+# processes rather than threads lets it use all of the server's cores.
+#
+# Work is submitted to a bounded queue: submit() blocks when the queue is full,
+# so the threads producing work cannot get arbitrarily far ahead of the
+# workers.  The result of each job is handed to a callback that runs in this
+# (the parent) process, so that shared state such as the stats tables is only
+# ever updated by the parent.
+#
+# A worker may die part way through a job, e.g., killed by the OOM killer.
+# The pool starts another worker in its place, but the job's callback would
+# never be called, so each job records the worker running it in a shared
+# array, and the threads waiting on jobs or queue slots check every
+# check_sec seconds for jobs whose workers have died.  Those jobs are failed
+# as if they had raised an exception.
+#
+# The number of workers that may run jobs at once can be lowered (and
+# raised again) while they run, e.g., by the concurrency controller.  The
+# limit is kept in this process: no more than that many jobs are handed to
+# the workers at once, and the rest of the queued jobs are held back until
+# jobs finish (or are failed), so a worker that dies can't use up any of
+# it.
+
+import multiprocessing
+import threading
+import collections
+import logging
+import logging.handlers
+import os
+import memory
+import timing
+
+# the pool, once started
+pool = None
+
+# the process ID of the worker running the job in each queue slot, or 0 if
+# the job hasn't been started, shared with the workers
+_job_pids = None
+
+# seconds between checks for jobs whose workers have died
+check_sec = 5
+
+
+def _init_worker():
+    """Called in each worker process when it starts."""
+    threading.current_thread().name = multiprocessing.current_process().name
+
+    # only the parent process may rotate the log file.  Have the workers
+    # write through a handler that reopens the log file after the parent
+    # rotates it
+    logger = logging.getLogger()
+    for h in list(logger.handlers):
+        if isinstance(h, logging.handlers.TimedRotatingFileHandler):
+            wh = logging.handlers.WatchedFileHandler(h.baseFilename)
+            wh.setLevel(h.level)
+            wh.setFormatter(h.formatter)
+            logger.removeHandler(h)
+            logger.addHandler(wh)
+
+
+def _run_job(slot, func, args):
+    """Run func(*args) in a worker process for the job in the queue slot and
+    return a tuple of its value (None if it raised an exception) and the
+    seconds it took.  Never raise, so that the job's callback is always
+    called and its queue slot is always released."""
+    _job_pids[slot] = os.getpid()
+    started = timing.clock()
+    try:
+        result = func(*args)
+    except Exception, e:
+        logging.error("Unexpected exception in image worker")
+        logging.exception(e)
+        result = None
+    return (result, timing.clock() - started)
+
+
+class Job:
+    """A job submitted to the pool, which may be passed to wait()."""
+
+    def __init__(self, slot, func, args, callback):
+        self.slot = slot
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.finished = False
+        self.event = threading.Event()
+
+
+class ImagePool:
+
+    def __init__(self, nworkers, maxqueued):
+        global _job_pids
+        self.nworkers = nworkers
+        self.maxqueued = maxqueued
+        # the array of the jobs' workers must be made before the workers are
+        # forked
+        _job_pids = multiprocessing.RawArray("i", maxqueued)
+        self.active = nworkers      # the limit of workers running jobs
+        self.pool = multiprocessing.Pool(nworkers, _init_worker)
+        # the free queue slots, and the jobs in the others
+        self.cond = threading.Condition()
+        self.free_slots = range(maxqueued)
+        self.jobs = {}
+        # the jobs held back by the limit, and the number handed to the
+        # workers
+        self.held = collections.deque()
+        self.dispatched = 0
+        # for monitoring: the numbers of jobs submitted and completed, and
+        # the total seconds the workers have spent running jobs
+        self.submitted = 0
+        self.completed = 0
+        self.busy_seconds = 0.0
+
+    def submit(self, func, args, callback):
+        """Queue func(*args) to be run in a worker process, blocking while the
+        queue is full.  When the job is done, callback is called in this
+        process with the value returned by func, or None if func raised an
+        exception or its worker died.  Return a job object that may be
+        passed to wait()."""
+        with self.cond:
+            while not self.free_slots:
+                self.cond.wait(check_sec)
+                if not self.free_slots:
+                    self.cond.release()
+                    try:
+                        self.fail_lost_jobs()
+                    finally:
+                        self.cond.acquire()
+            job = Job(self.free_slots.pop(), func, args, callback)
+            self.jobs[job.slot] = job
+            _job_pids[job.slot] = 0
+            self.submitted += 1
+            self.held.append(job)
+            self.dispatch()
+        return job
+
+    def dispatch(self):
+        """Hand the held jobs to the workers, up to the limit.  Called with
+        self.cond held."""
+        while self.held and self.dispatched < self.active:
+            job = self.held.popleft()
+            self.dispatched += 1
+            def done((result, seconds), job=job):
+                self.finish(job, result, seconds)
+            self.pool.apply_async(_run_job, (job.slot, job.func, job.args),
+                                  callback=done)
+
+    def finish(self, job, result, seconds):
+        """Call the job's callback with the result, once only, then release
+        its queue slot."""
+        with self.cond:
+            if job.finished:
+                return
+            job.finished = True
+            del self.jobs[job.slot]
+            self.completed += 1
+            self.busy_seconds += seconds
+            self.dispatched -= 1
+            self.dispatch()
+        try:
+            job.callback(result)
+        except Exception, e:
+            logging.error("Unexpected exception in image job callback")
+            logging.exception(e)
+        finally:
+            with self.cond:
+                self.free_slots.append(job.slot)
+                self.cond.notify()
+            job.event.set()
+
+    def fail_lost_jobs(self):
+        """Fail the jobs whose workers have died, and release what they had
+        reserved from the memory budget.  Return the number of jobs failed."""
+        with self.cond:
+            lost = [(job, _job_pids[job.slot]) for job in self.jobs.values()
+                    if _job_pids[job.slot] != 0
+                        and not self.alive(_job_pids[job.slot])]
+        for (job, pid) in lost:
+            logging.error("Image worker %d died during a job" % pid)
+            memory.release_worker(pid)
+            self.finish(job, None, 0.0)
+        return len(lost)
+
+    def set_active(self, n):
+        """Limit the number of workers running jobs at once to n, from 1 up
+        to the number of workers."""
+        with self.cond:
+            self.active = max(1, min(n, self.nworkers))
+            self.dispatch()
+
+    def alive(self, pid):
+        """Return False if the worker process has exited.  The pool reaps
+        its workers soon after they exit, but one that hasn't been reaped
+        yet is still in the pool's list."""
+        for w in list(self.pool._pool):
+            if w.pid == pid and w.exitcode is not None:
+                return False
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def in_flight(self):
+        """Return the number of jobs queued or running."""
+        with self.cond:
+            return self.submitted - self.completed
+
+
+def start(nworkers, maxqueued, memory_mb=0):
+    """Start the worker pool if it is not already running, with the workers
+    sharing a memory budget of memory_mb megabytes (0 for no limit).  Must be
+    called before any other threads are started, because the worker
+    processes are forked from the calling process."""
+    global pool
+    if pool is None:
+        logging.info("Starting image pool: %d workers, %d queue slots"
+                     % (nworkers, maxqueued))
+        # the workers, a dead worker not yet reaped for each job, and this
+        # process may hold reservations
+        memory.set_budget(memory_mb, nworkers + maxqueued + 1)
+        pool = ImagePool(nworkers, maxqueued)
+
+
+def worker_pids():
+    """Return a list of the process IDs of the image workers."""
+    if pool is None:
+        return []
+    return [p.pid for p in pool.pool._pool]
+
+
+def wait(jobs):
+    """Wait for each of the jobs returned by submit() to complete, or to be
+    failed because its worker died.  Any job that is None is taken to be
+    already complete."""
+    for job in jobs:
+        if job is not None:
+            while not job.event.wait(check_sec):
+                pool.fail_lost_jobs()
@@ -26,7 +26,8 @@ import logging
 ##################################################################################
 #                                                                                #
 #  Camera Setup is important                                                     #
-#     camera( shortname, longname, [croparea]                                    #
+#     camera( shortname, longname, [croparea], [sequence_gap_sec=N],             #
+#             [weight=N], [max_queued=N] )                                       #
 #                                                                                #
 #  shortname must match the name of directory where you upload the images        #
 #  (case sensitive)                                                              #
@@ -40,6 +41,15 @@ import logging
 #  image and x2,y2 is the lower right corner. Accepts absolute coordinates and   #
 #  percentage for truly resolution independant cropping                          #
 #                                                                                #
+#  sequence_gap_sec - Optional, overrides the global sequence_gap_sec below for  #
+#  this camera                                                                   #
+#                                                                                #
+#  weight - Optional, the camera's share of the image processing when cameras    #
+#  have a backlog, relative to the others (default 1)                            #
+#                                                                                #
+#  max_queued - Optional, overrides the global camera_max_queued below for this  #
+#  camera                                                                        #
+#                                                                                #
 ##################################################################################
 
 
@@ -58,13 +68,155 @@ cameras = [
 root = "/home/example_user/upload_directory/"
 
 retain_days = 30 # number of days to retain images.
+
+# the image index, a database of all of the images that's rebuilt from the
+# images if it's lost.  It lists every image, so keep it out of the website.
+# A relative path is taken from the directory CommunityView is started in,
+# where its log files are written
+index_path = "cvindex.sqlite"
 hide_sequences_shorter_than_sec = 1 # Sequences lenght 0 sec are hidden
+# the sequences of the camera-days most recently processed are kept in
+# memory between passes, for up to this many camera-days
+sequencer_cache_camdays = 50
+
+# the performance stats tables of days other than today are dropped from
+# memory when they haven't been used for this many minutes
+stats_cache_minutes = 10
+# and the least recently used of them are dropped when there are more than
+# this many tables in memory
+stats_cache_tables = 200
+# each minute's changes to the performance stats are appended to a journal;
+# the CSV files read by the stats page are brought up to date every this many
+# minutes, and at the end of the day
+stats_csv_minutes = 5
+# the performance stats' counts of unprocessed images are kept up to date as
+# images arrive and are processed, and checked against the upload
+# directories every this many minutes
+stats_reconcile_minutes = 15
+# the hourly and daily rollups of the performance stats, used by the stats
+# page to graph weeks and months, are brought up to date every this many
+# minutes
+stats_rollup_minutes = 60
+# time the stages of processing images (decode, resize, encode, etc.) and
+# record the totals for each minute in the per-server performance stats
+stage_timing = True
+# serve the server's current state (queues, backlogs, latencies, threads) in
+# the Prometheus text format at http://<metrics_address>:<metrics_port>/metrics.
+# 0 means don't serve it
+metrics_port = 0
+metrics_address = "127.0.0.1"
+
+# expired days are moved to the trash and deleted at no more than this many
+# files per second, at idle I/O priority, so that purging doesn't hold up
+# image processing.  0 means no limit
+purge_unlinks_per_sec = 500
+# when the disk holding the root gets this percent full, images are deleted
+# to bring it back down to storage_low_water_pct full, even if they're within
+# retain_days: first the thumbnails and mediumres images of the oldest days,
+# then the oldest days' original images.  0 means only retain_days limits
+# the images kept
+storage_high_water_pct = 0
+storage_low_water_pct = 85
 
 # the number of seconds between two sequences.
 sequence_gap_sec = 3
-max_threads = 6
+
+# number of threads working through the previous days' images, each taking
+# one camera-day at a time, newest day first.  Today's images have their own
+# thread
+previous_days_workers = 2
+
+# the cameras take turns at being processed.  Each turn, a camera may
+# process this many images times its weight (see Camera Setup), so that a
+# camera that's triggered constantly can't hold up the others.  0 means each
+# camera-day is processed to the end in one turn
+fair_share_quantum = 100
+# limit on the number of each camera's images queued for the image workers
+# at once, unless the camera sets its own max_queued.  0 means no limit
+# but the image workers' queue
+camera_max_queued = 0
+
+# number of worker processes making thumbnail and mediumres images;
+# 0 means one per CPU core
+image_workers = 0
+# number of images that may be queued for the image workers, per worker,
+# before the threads queueing images are made to wait
+image_queue_per_worker = 4
+# limit, in megabytes, on the memory used by the image workers to decode
+# images.  Each image's share is estimated from its dimensions before it is
+# decoded, and workers wait until their images fit in the budget.  0 means no
+# limit
+memory_budget_mb = 0
+# for servers with little memory: always decode images at reduced scale
+# (whatever resample_quality is) and make the derivative images for only one
+# image at a time
+low_ram_mode = False
 sleeptime = 300 # 600 = 10 minutes, time between main thread wakes up and checks if there are new images to process.
 
+# adjust the number of image workers processing images at once, and the time
+# between the main thread's checks for new images, to the server's load,
+# once a minute.  While images are waiting to be processed, a worker is
+# added each minute that the processing latency is over
+# target_proc_latency_min or the number waiting isn't going down, and the
+# time between checks is halved.  When the server is overloaded, the
+# workers are cut by concurrency_backoff, and then left alone for
+# concurrency_cooldown_min minutes
+adaptive_concurrency = False
+# the fewest image workers processing images at once.  The most is
+# image_workers
+image_workers_min = 1
+# 95th percentile processing latency, in minutes, of newly uploaded images
+target_proc_latency_min = 5
+# the server is overloaded when its 1-minute load average per CPU core is
+# above max_load_per_cpu, or the percent of its memory available is below
+# min_memory_available_pct
+max_load_per_cpu = 1.5
+min_memory_available_pct = 10
+concurrency_backoff = 0.5
+concurrency_cooldown_min = 5
+# the shortest time between the main thread's checks; the longest is
+# sleeptime
+sleeptime_min = 60
+
+# when this many images are waiting to be processed, switch to catch-up mode:
+# make only the thumbnails and index pages, and put off the mediumres images
+# and the image pages until the number waiting is down to
+# catchup_backlog_off.  0 means never
+catchup_backlog = 2000
+catchup_backlog_off = 100
+
+# watch for newly uploaded images with inotify (Linux only) so they are
+# processed as soon as they arrive.  The directories are still polled, less
+# often, to catch anything the watcher misses
+use_inotify = True
+# how often, in seconds, today's processing thread checks for new arrivals
+watch_tick_sec = 1
+
+# trade-off between speed and quality when making thumbnail and mediumres
+# images: "fast", "balanced" or "best".  "fast" and "balanced" decode the
+# uploaded JPEG at reduced scale when it is much larger than needed, "best"
+# always decodes the full image.  "fast" also uses a cheaper resize filter.
+resample_quality = "balanced"
+
+# how the page for each image is made.  "html" writes an HTML file for each
+# image.  "manifest" writes one JSON manifest for each camera for each day, and
+# the image pages are made in the browser by a single viewer page, viewer.html
+# in the root of the website, which makes for far fewer files to write and
+# purge.
+image_pages = "html"
+
+# how the changes between each thumbnail and its sequence's master image are
+# found: "numpy" draws a box around each separate region of change (requires
+# NumPy; falls back to "pillow" if NumPy is not installed), "pillow" draws one
+# box around all of the changes
+motion_detection = "numpy"
+# minimum difference in pixel brightness (0-255) considered to be a change
+motion_threshold = 32
+# changed regions smaller than this many thumbnail pixels are ignored
+motion_min_pixels = 6
+# maximum number of boxes drawn on a thumbnail
+motion_max_boxes = 4
+
 # logging level for output to log file(s)
 logfile_log_level = logging.INFO
 
@@ -0,0 +1,201 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Image pages made in the browser, rather than one HTML file per image.
+#
+# When image_pages is set to "manifest", a single JSON manifest is written for
+# each camera-day, listing its sequences and the filename and time of each
+# image, and the image pages are made by a single static viewer page,
+# viewer.html in the root of the website.  The viewer is addressed as
+#   viewer.html#<day>/<camera shortname>/<image filename>
+# and fetches the camera-day's manifest, then shows the image along with the
+# same navigation and sequence thumbnails as the HTML image pages.
+
+import json
+import os
+from utils import write_if_changed
+
+manifestname = "manifest.json"
+viewername = "viewer.html"
+
+
+def viewer_url_from_index(day, cam, filename):
+    """Return the URL of the viewer page for the image, relative to the
+    camera-day's index page."""
+    return "../../%s#%s/%s/%s" % (viewername, day, cam, filename)
+
+
+def make_manifest(indir, day, cam, sequences, dirs):
+    """Write the manifest for the camera-day whose dir is indir.  day is the
+    YYYY-MM-DD day, cam is the camera object, sequences is its Sequencer
+    and dirs is a dict giving the names of the derivative image dirs and the
+    postfixes of their filenames."""
+    (filenames, secs) = (sequences.filenames, sequences.secs)
+    manifest = dict(dirs)
+    manifest.update({
+        "day": day,
+        "camera": cam.shortname,
+        "longname": cam.longname,
+        "sequences": [[[filenames[i], secs[i]]
+                       for i in xrange(sequence.start, sequence.end)]
+                      for sequence in sequences],
+        })
+    write_if_changed(os.path.join(indir, manifestname),
+                     json.dumps(manifest, separators=(",", ":")))
+
+
+def make_viewer_page(root, title, footer):
+    """Write the viewer page in the root of the website."""
+    write_if_changed(os.path.join(root, viewername),
+                     _viewer_html % {"title": title, "footer": footer,
+                                     "manifestname": manifestname})
+
+
+_viewer_html = """<title>%(title)s</title>
+<h1 align="center">%(title)s</h1>
+<div id="page"></div>
+<h4 align="center">%(footer)s</h4>
+<script>
+var manifest = null;
+var manifestDir = null;
+
+function pad(n) {
+    return (n < 10 ? "0" : "") + n;
+}
+
+function timeString(secs) {
+    return manifest.day + " " + pad(Math.floor(secs / 3600)) + ":"
+        + pad(Math.floor(secs / 60) %% 60) + ":" + pad(secs %% 60);
+}
+
+function derivative(dir, postfix, filename) {
+    return manifestDir + manifest[dir] + "/"
+        + filename.replace(/\\.[^.]*$/, "") + manifest[postfix];
+}
+
+// the location hash and the manifest come from outside the page, so
+// everything taken from them is escaped before it's put in the page's HTML
+function esc(s) {
+    return String(s).replace(/&/g, "&amp;").replace(/</g, "&lt;")
+        .replace(/>/g, "&gt;").replace(/"/g, "&quot;").replace(/'/g, "&#39;");
+}
+
+function link(filename, text) {
+    return '<a href="#' + esc(manifestDir + filename) + '">' + text + '</a>';
+}
+
+function render() {
+    var parts = location.hash.substr(1).split("/");
+    // day/camera/filename, each a plain name, so that the manifest can only
+    // be fetched from a camera-day dir of this site
+    if (parts.length != 3 || !parts.every(function(p) {
+            return /^[A-Za-z0-9_.-]+$/.test(p); })) {
+        show('<p align="center">No image</p>');
+        return;
+    }
+    var dir = parts[0] + "/" + parts[1] + "/";
+    var filename = parts[2];
+    if (dir != manifestDir) {
+        var xhr = new XMLHttpRequest();
+        xhr.onload = function() {
+            if (xhr.status != 200) {
+                show("<p align=\\"center\\">Can't load " + esc(dir) + "</p>");
+                return;
+            }
+            manifest = JSON.parse(xhr.responseText);
+            manifestDir = dir;
+            render();
+        };
+        xhr.open("GET", dir + "%(manifestname)s");
+        xhr.setRequestHeader("Cache-Control", "no-cache");
+        xhr.send();
+        return;
+    }
+
+    var seqs = manifest.sequences;
+    var s, i;
+    for (s = 0; s < seqs.length; s++) {
+        for (i = 0; i < seqs[s].length; i++) {
+            if (seqs[s][i][0] == filename) {
+                break;
+            }
+        }
+        if (i < seqs[s].length) {
+            break;
+        }
+    }
+    if (s == seqs.length) {
+        show("<p align=\\"center\\">" + esc(filename) + " not found</p>");
+        return;
+    }
+    var seq = seqs[s];
+    var space = "&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;";
+
+    var html = '<p align="center"><a href="'
+        + esc(manifestDir + manifest.hires + "/" + filename)
+        + '">Show Original Image<br><img border="0" src="'
+        + esc(derivative("mediumres", "medium_postfix", filename))
+        + '"></a></p>';
+    html += '<p align="center">' + esc(timeString(seq[i][1])) + "</p>";
+
+    html += '<p align="center">';
+    if (i > 0) {
+        html += link(seq[i-1][0], "&lt;-- Prev Image");
+    }
+    html += space + '<a href="' + esc(manifestDir) + 'index.html">Up</a>'
+        + space;
+    if (i + 1 < seq.length) {
+        html += link(seq[i+1][0], "Next Image --&gt;");
+    }
+    html += "</p>";
+
+    html += '<p align="center">';
+    if (s > 0) {
+        html += link(seqs[s-1][seqs[s-1].length-1][0], "&lt;-- Prev Sequence");
+    }
+    html += space + space;
+    if (s + 1 < seqs.length) {
+        html += link(seqs[s+1][0][0], "Next Sequence --&gt;");
+    }
+    html += "</p>";
+
+    html += '<p align="center">' + esc(timeString(seq[0][1])) + " - "
+        + esc(timeString(seq[seq.length-1][1])) + "<br>" + seq.length
+        + " images, " + esc(seq[seq.length-1][1] - seq[0][1]) + " sec<br>";
+    for (var j = 0; j < seq.length; j++) {
+        html += link(seq[j][0], '<img border="' + (j == i ? 1 : 0)
+            + '" src="'
+            + esc(derivative("thumbnails", "thumb_postfix", seq[j][0]))
+            + '">');
+    }
+    html += "</p>";
+    show(html);
+}
+
+function show(html) {
+    document.getElementById("page").innerHTML = html;
+}
+
+window.onhashchange = render;
+render();
+</script>
+"""
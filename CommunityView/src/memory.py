@@ -0,0 +1,219 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Keep the memory used for decoding images within a budget, and measure the
+# memory used by CommunityView and the memory available.
+#
+# Before an image is decoded, the memory it will take is estimated from the
+# dimensions in its header and reserved from a budget shared by all of the
+# image worker processes.  If the reservation would exceed the budget, the
+# worker waits until other workers have released enough.  An image larger
+# than the whole budget is decoded only when no other image is.
+#
+# A worker may be killed at any time, so the megabytes reserved by each
+# process are kept by its pid, and the pid of the process holding the
+# budget's lock is kept too.  When the image pool finds a dead worker, it
+# calls release_worker(), which releases the lock if the worker died holding
+# it and then the worker's megabytes.  The budget's lock is a plain lock,
+# which any process may release, and waiting workers poll for room rather
+# than waiting on a condition, whose lock only its holder could release.
+#
+# The budget must be created (by set_budget()) before the worker processes
+# are forked, so that they share it.
+
+import multiprocessing
+import os
+import time
+import logging
+
+# the shared budget, if any
+budget = None
+
+# seconds between a waiting reservation's checks for room in the budget
+poll_sec = 0.05
+
+# seconds to wait for the budget's lock before giving up on releasing a
+# dead worker's megabytes
+lock_timeout_sec = 10
+
+
+class MemoryBudget:
+
+    def __init__(self, limit_mb, nprocs=0):
+        self.limit_mb = limit_mb
+        self.lock = multiprocessing.Lock()
+        self.owner = multiprocessing.RawValue("i", 0)   # pid holding lock
+        self.used = multiprocessing.RawValue("i", 0)
+        # (pid, megabytes reserved) of up to nprocs processes
+        self.nprocs = max(nprocs, 1)
+        self.held = multiprocessing.RawArray("i", 2 * self.nprocs)
+
+    def _acquire(self, timeout=None):
+        if timeout is None:
+            self.lock.acquire()
+        elif not self.lock.acquire(True, timeout):
+            return False
+        self.owner.value = os.getpid()
+        return True
+
+    def _release(self):
+        self.owner.value = 0
+        self.lock.release()
+
+    def _hold(self, pid, mb):
+        """Add mb to the megabytes held by the process.  Called with the lock
+        held."""
+        free = None
+        for i in range(0, 2 * self.nprocs, 2):
+            if self.held[i] == pid:
+                self.held[i+1] += mb
+                if self.held[i+1] == 0:
+                    self.held[i] = 0
+                return
+            if free is None and self.held[i] == 0:
+                free = i
+        if free is not None:
+            self.held[free] = pid
+            self.held[free+1] = mb
+
+    def reserve(self, mb):
+        """Wait until mb megabytes can be reserved within the budget, then
+        reserve them."""
+        while True:
+            self._acquire()
+            try:
+                if self.used.value == 0 \
+                        or self.used.value + mb <= self.limit_mb:
+                    self.used.value += mb
+                    self._hold(os.getpid(), mb)
+                    return
+            finally:
+                self._release()
+            time.sleep(poll_sec)
+
+    def release(self, mb):
+        self._acquire()
+        try:
+            self.used.value -= mb
+            self._hold(os.getpid(), -mb)
+        finally:
+            self._release()
+
+    def release_worker(self, pid):
+        """Release the lock, if the dead worker process pid holds it, and
+        whatever it still has reserved."""
+        if self.owner.value == pid:
+            logging.error("Image worker %d died holding the memory budget"
+                          % pid)
+            self._release()
+        if not self._acquire(lock_timeout_sec):
+            logging.error("Can't lock the memory budget to release image "
+                          "worker %d's memory" % pid)
+            return
+        try:
+            for i in range(0, 2 * self.nprocs, 2):
+                if self.held[i] == pid:
+                    self.used.value -= self.held[i+1]
+                    self.held[i] = self.held[i+1] = 0
+        finally:
+            self._release()
+
+
+def set_budget(limit_mb, nprocs=0):
+    """Set up the budget shared by all processes forked after this call,
+    up to nprocs of which may hold reservations at once.  A limit of 0 means
+    there is no limit."""
+    global budget
+    if limit_mb > 0:
+        logging.info("Image memory budget: %d MB" % limit_mb)
+        budget = MemoryBudget(limit_mb, nprocs)
+    else:
+        budget = None
+
+
+def image_mb(img):
+    """Return the estimated number of megabytes needed to decode the opened
+    (but not yet loaded) PIL image and make a cropped copy of it."""
+    (w, h) = img.size
+    return (2 * w * h * len(img.getbands()) + (1 << 20) - 1) >> 20
+
+
+def reserve(mb):
+    if budget is not None:
+        budget.reserve(mb)
+
+
+def release(mb):
+    if budget is not None:
+        budget.release(mb)
+
+
+def release_worker(pid):
+    if budget is not None:
+        budget.release_worker(pid)
+
+
+def _status_kb(pid, field):
+    """Return the value in kB of the field (e.g., "VmHWM") of the process's
+    /proc status, or 0 if it can't be read."""
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return 0
+
+
+def peak_rss_mb(pids):
+    """Return the sum of the peak resident set sizes of this process and the
+    processes pids, in megabytes, since the last call, and reset the peaks.
+    Where a peak can't be reset, the peak since the process started is
+    used.  Return None if the sizes can't be read (e.g., not Linux)."""
+    total = 0
+    for pid in [os.getpid()] + list(pids):
+        total += _status_kb(pid, "VmHWM")
+        try:
+            with open("/proc/%d/clear_refs" % pid, "w") as f:
+                f.write("5")
+        except IOError:
+            pass
+    if total == 0:
+        return None
+    return (total + 1023) / 1024
+
+
+def available_pct():
+    """Return the percent of the system's memory that's available for new
+    work without swapping, or None if it can't be read (e.g., not Linux)."""
+    fields = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                (name, value) = line.split(":", 1)
+                fields[name] = int(value.split()[0])
+    except (IOError, ValueError):
+        return None
+    if not fields.get("MemTotal") or "MemAvailable" not in fields:
+        return None
+    return 100.0 * fields["MemAvailable"] / fields["MemTotal"]
@@ -0,0 +1,279 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# A local HTTP endpoint serving the server's current state in the Prometheus
+# text format, so that servers can be monitored without reading their stats
+# CSV files.
+#
+# Everything is read from memory: today's stats tables in stats.statdict, the
+# stats and image pool queues, the threads registered in the threads dict,
+# the heartbeats and log counts kept by health, the storage usage last found
+# by storage, and the queued images counted by scheduler.  Nothing is
+# locked, so a scrape may see a table part way through an update, which is
+# at worst a minute out of date.
+#
+# The endpoint is off unless metrics_port is set in localsettings.py, and
+# only listens on metrics_address (by default, the loopback interface).
+
+import BaseHTTPServer
+import socket
+import threading
+import time
+import logging
+import stats
+import imagepool
+import histogram
+import health
+import storage
+import scheduler
+from utils import set_thread_prefix
+
+# the threads whose liveness is reported: {name: threading.Thread}, kept up
+# to date by the main loop as it (re)starts them
+threads = {}
+
+# the server, once started
+server = None
+
+
+class _Metrics:
+    """Accumulates metrics in the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, mtype, helptext):
+        self.lines.append("# HELP %s %s" % (name, helptext))
+        self.lines.append("# TYPE %s %s" % (name, mtype))
+
+    def sample(self, name, value, **labels):
+        if labels:
+            name += "{%s}" % ",".join(['%s="%s"' % (k, _escape(labels[k]))
+                                       for k in sorted(labels)])
+        self.lines.append("%s %s" % (name, _format(value)))
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+                     .replace("\n", "\\n")
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _latest(table, col, minute):
+    """Return the most recent value in the column at or before the minute,
+    or 0 if there isn't one."""
+    for m in xrange(minute, -1, -1):
+        v = table[m][col]
+        if v is not None:
+            return v
+    return 0
+
+
+def _histogram(m, name, helptext, tables, metric):
+    """Add the latency histogram of the metric for the whole of today,
+    combining all of the tables, in seconds."""
+    hist = histogram.merge([t.merged_histogram(metric, xrange(stats.MINPERDAY))
+                            for t in tables])
+    m.family(name, "histogram", helptext)
+    cum = 0
+    total = 0.0
+    for i in xrange(histogram.NBUCKETS):
+        cum += hist[i]
+        total += hist[i] * histogram.bucket_value(i) * 60
+        m.sample(name + "_bucket", cum,
+                 le=_format(histogram.bucket_bound(i) * 60))
+    m.sample(name + "_sum", total)
+    m.sample(name + "_count", cum)
+
+
+def render(now=None):
+    """Return the metrics as of the time now (by default, the current
+    time), in the Prometheus text format."""
+    if now is None:
+        now = time.time()
+    ts_tm = time.localtime(now)
+    today = time.strftime("%Y-%m-%d", ts_tm)
+    minute = ts_tm.tm_hour*60 + ts_tm.tm_min
+    m = _Metrics()
+
+    # today's tables, without loading any that have been evicted
+    entries = [(k[1], e[stats.TABLE]) for (k, e) in stats.statdict.items()
+               if k[0] == today]
+    server_table = dict(entries).get("")
+    cam_tables = sorted([(c, t) for (c, t) in entries if c != ""])
+
+    nproc = server_table.column_sum(stats.NPROC) if server_table else None
+    m.family("communityview_images_processed_today", "counter",
+             "Images processed since midnight.")
+    m.sample("communityview_images_processed_today", int(nproc or 0))
+
+    m.family("communityview_unprocessed_images", "gauge",
+             "Images waiting to be processed, as of the last stats minute.")
+    for (cam, table) in cam_tables:
+        m.sample("communityview_unprocessed_images",
+                 _latest(table, stats.NUNPROC, minute), camera=cam, day="today")
+        m.sample("communityview_unprocessed_images",
+                 _latest(table, stats.NUNPROCPREV, minute), camera=cam,
+                 day="previous")
+
+    m.family("communityview_queued_images", "gauge",
+             "Images queued for or being processed by the image workers.")
+    for (cam, n) in sorted(scheduler.slots.counts.items()):
+        m.sample("communityview_queued_images", n, camera=cam)
+
+    _histogram(m, "communityview_upload_latency_seconds",
+               "Time from image creation to upload, for today's images.",
+               [t for (c, t) in cam_tables], stats.UPLAT)
+    _histogram(m, "communityview_processing_latency_seconds",
+               "Time from image upload to processing, for today's images.",
+               [t for (c, t) in cam_tables], stats.PROCLAT)
+
+    m.family("communityview_stats_queue_length", "gauge",
+             "Processing records waiting to be tallied into the stats.")
+    m.sample("communityview_stats_queue_length", len(stats.proc_queue))
+
+    pool = imagepool.pool
+    if pool is not None:
+        m.family("communityview_image_jobs_in_flight", "gauge",
+                 "Images queued for or being processed by the image workers.")
+        m.sample("communityview_image_jobs_in_flight", pool.in_flight())
+        m.family("communityview_image_workers", "gauge",
+                 "Number of image worker processes.")
+        m.sample("communityview_image_workers", pool.nworkers)
+        m.family("communityview_image_workers_active", "gauge",
+                 "Number of image workers allowed to process images at "
+                 "once.")
+        m.sample("communityview_image_workers_active", pool.active)
+        m.family("communityview_image_worker_busy_seconds_total", "counter",
+                 "Seconds the image workers have spent processing images.  "
+                 "Its rate divided by the number of workers is their "
+                 "utilisation.")
+        m.sample("communityview_image_worker_busy_seconds_total",
+                 pool.busy_seconds)
+
+    m.family("communityview_thread_alive", "gauge",
+             "1 if the thread is running, 0 if not.")
+    for name in sorted(threads):
+        m.sample("communityview_thread_alive",
+                 1 if threads[name].is_alive() else 0, thread=name)
+
+    m.family("communityview_heartbeat_age_seconds", "gauge",
+             "Seconds since the thread last showed progress.")
+    for prefix in health.HEARTBEATS:
+        age = health.heartbeat_age(prefix)
+        if age is not None:
+            m.sample("communityview_heartbeat_age_seconds", age,
+                     thread=prefix)
+
+    m.family("communityview_log_records_total", "counter",
+             "Warnings and errors logged, as of the last stats minute.")
+    for ((prefix, level), count) in sorted(health.totals.items()):
+        m.sample("communityview_log_records_total", count, level=level,
+                 thread=prefix)
+
+    if storage.last_usage is not None:
+        (free, hires, deriv) = storage.last_usage
+        m.family("communityview_disk_free_bytes", "gauge",
+                 "Bytes free on the filesystem holding the images.")
+        m.sample("communityview_disk_free_bytes", free)
+        m.family("communityview_image_bytes", "gauge",
+                 "Bytes of images kept, by kind.")
+        m.sample("communityview_image_bytes", hires, kind="hires")
+        m.sample("communityview_image_bytes", deriv, kind="derivative")
+
+    m.family("communityview_stats_tables_cached", "gauge",
+             "Stats tables in memory.")
+    m.sample("communityview_stats_tables_cached", len(stats.statdict))
+    for (event, count) in sorted(stats.cache_counts.items()):
+        name = "communityview_stats_table_%s_total" % event
+        m.family(name, "counter", "Stats tables %s." % {
+                "loads": "loaded into memory",
+                "evictions": "dropped from memory",
+                "flushes": "written out when dropped from memory"}[event])
+        m.sample(name, count)
+
+    return m.text()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        try:
+            body = render()
+        except Exception, e:
+            logging.error("Unexpected exception rendering metrics")
+            logging.exception(e)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug("metrics: " + fmt % args)
+
+
+def _serve(httpd):
+    set_thread_prefix(threading.current_thread(), "Metrics")
+    logging.info("Serving metrics on %s:%d" % httpd.server_address)
+    httpd.serve_forever()
+
+
+def start(address, port):
+    """Start serving the metrics on the address and port in a thread of
+    their own, if not already started.  Return the server, or None if the
+    port can't be used."""
+    global server
+    if server is None:
+        try:
+            httpd = BaseHTTPServer.HTTPServer((address, port), _Handler)
+        except socket.error, e:
+            logging.error("Can't serve metrics on %s:%d: %s"
+                          % (address, port, e))
+            return None
+        thread = threading.Thread(target=_serve, args=(httpd,))
+        thread.daemon = True
+        thread.start()
+        server = httpd
+    return server
+
+
+def stop():
+    """Stop serving the metrics."""
+    global server
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        server = None
@@ -0,0 +1,132 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Change detection between a thumbnail and its sequence's master thumbnail.
+#
+# The pixel-wise difference of the two images is thresholded, cleaned of
+# isolated noise pixels with a morphological opening, and split into
+# connected regions.  The bounding box of each sufficiently large region is
+# returned, along with the fraction of the image that changed.
+#
+# NumPy is optional.  If it is not installed, find_motion() returns None and
+# the caller falls back to the Pillow-only comparison.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _erode(mask):
+    """Return the mask eroded by a 3x3 square."""
+    p = numpy.pad(mask, 1, "constant", constant_values=False)
+    out = mask.copy()
+    (h, w) = mask.shape
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            out &= p[dy:dy+h, dx:dx+w]
+    return out
+
+
+def _dilate(mask):
+    """Return the mask dilated by a 3x3 square."""
+    p = numpy.pad(mask, 1, "constant", constant_values=False)
+    out = mask.copy()
+    (h, w) = mask.shape
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            out |= p[dy:dy+h, dx:dx+w]
+    return out
+
+
+def _label(mask):
+    """Return an array the shape of mask in which each 4-connected region of
+    True pixels has a distinct positive label and all other pixels are 0.
+    Each pass replaces every pixel's label with the smallest label among
+    itself and its neighbors, until no label changes."""
+    (h, w) = mask.shape
+    big = h * w + 1
+    labels = numpy.where(mask, numpy.arange(1, h*w + 1).reshape(h, w), big)
+    while True:
+        p = numpy.pad(labels, 1, "constant", constant_values=big)
+        m = numpy.minimum(labels, p[0:h, 1:w+1])
+        m = numpy.minimum(m, p[2:h+2, 1:w+1])
+        m = numpy.minimum(m, p[1:h+1, 0:w])
+        m = numpy.minimum(m, p[1:h+1, 2:w+2])
+        m[~mask] = big
+        # jump each label straight to its own label's current value, which
+        # collapses long chains much faster than neighbor passes alone
+        flat = numpy.append(m.ravel(), big)
+        m = numpy.where(mask, flat[m - 1], big)
+        if numpy.array_equal(m, labels):
+            break
+        labels = m
+    labels[~mask] = 0
+    return labels
+
+
+def find_motion(master, img, threshold, min_pixels, max_boxes):
+    """Compare img with master (PIL images of the same mode) and return a
+    tuple of a list of bounding boxes around the regions that changed, largest
+    region first, and the fraction of the image's area that changed.  Boxes
+    are (left, top, right, bottom), inclusive, suitable for
+    ImageDraw.rectangle().  Pixels whose difference in luminance is no more
+    than threshold are considered unchanged, regions of fewer than
+    min_pixels pixels are ignored, and at most max_boxes boxes are returned.
+    Return None if NumPy is not installed."""
+    if numpy is None:
+        return None
+
+    a = numpy.asarray(master, dtype=numpy.int32)
+    b = numpy.asarray(img, dtype=numpy.int32)
+    # the images may differ in size by a pixel due to rounding when resized
+    h = min(a.shape[0], b.shape[0])
+    w = min(a.shape[1], b.shape[1])
+    diff = numpy.abs(a[:h, :w] - b[:h, :w])
+    if diff.ndim == 3:
+        diff = (diff[:, :, 0] * 299 + diff[:, :, 1] * 587
+                + diff[:, :, 2] * 114) / 1000
+
+    mask = _dilate(_erode(diff > threshold))
+    npixels = int(mask.sum())
+    if npixels == 0:
+        return ([], 0.0)
+
+    labels = _label(mask)
+    (ys, xs) = numpy.nonzero(labels)
+    lv = labels[ys, xs]
+    order = numpy.argsort(lv, kind="mergesort")
+    (lv, ys, xs) = (lv[order], ys[order], xs[order])
+    starts = numpy.flatnonzero(numpy.r_[True, lv[1:] != lv[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(lv)])
+    left = numpy.minimum.reduceat(xs, starts)
+    right = numpy.maximum.reduceat(xs, starts)
+    top = numpy.minimum.reduceat(ys, starts)
+    bottom = numpy.maximum.reduceat(ys, starts)
+
+    boxes = []
+    for i in numpy.argsort(-counts, kind="mergesort"):
+        if counts[i] < min_pixels or len(boxes) >= max_boxes:
+            break
+        boxes.append((int(left[i]), int(top[i]),
+                      int(right[i]), int(bottom[i])))
+    return (boxes, float(npixels) / (h * w))
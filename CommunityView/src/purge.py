@@ -0,0 +1,177 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Purge expired day directories, and the derivative images of days chosen by
+# the storage governor, without slowing down image processing.
+#
+# A day directory (or derivative image directory) is first renamed into the
+# trash directory, .trash in the root, which takes it out of get_daydirs() at
+# once.  The trash must be on the same filesystem as the root for the rename,
+# so it's in the website, and it holds an .htaccess file that denies the web
+# server access to it.  The trash is then emptied at a limited rate of
+# unlinks per second, at idle I/O priority where the kernel supports it, so
+# the purge mostly uses disk time that image processing doesn't.  Anything
+# left in the trash by an interrupted purge is deleted by the next one.
+
+import ctypes
+import logging
+import os
+import platform
+import time
+import health
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+trashname = ".trash"
+
+# keeps Apache from serving anything in the trash
+_htaccess = "Require all denied\n"
+
+
+class _DirEntry:
+    """The part of os.scandir()'s DirEntry used here, for when scandir isn't
+    available."""
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isdir(self.path)
+
+
+def scandir(dirpath):
+    """Return the entries of the directory, as for os.scandir()."""
+    if _scandir is not None:
+        return _scandir(dirpath)
+    return [_DirEntry(dirpath, name) for name in os.listdir(dirpath)]
+
+
+# ioprio_set() system call numbers, which Python doesn't wrap
+_ioprio_set = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30,
+               "armv6l": 314, "armv7l": 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+def set_idle_io_priority():
+    """Give the calling thread idle I/O priority, so that it only gets disk
+    time when no other process wants it.  Return True if it was set."""
+    nr = _ioprio_set.get(platform.machine())
+    if nr is None or platform.system() != "Linux":
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        # who = 0 is the calling thread
+        if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0,
+                        IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+            logging.debug("ioprio_set failed: %s"
+                          % os.strerror(ctypes.get_errno()))
+            return False
+    except (OSError, AttributeError), e:
+        logging.debug("ioprio_set not available: %s" % e)
+        return False
+    return True
+
+
+def trash_path(root):
+    return os.path.join(root, trashname)
+
+
+def trash(dirpath, root):
+    """Move the directory, a day directory or one of its subdirectories,
+    into the trash."""
+    trashdir = trash_path(root)
+    if not os.path.isdir(trashdir):
+        os.mkdir(trashdir)
+        with open(os.path.join(trashdir, ".htaccess"), "w") as f:
+            f.write(_htaccess)
+    name = os.path.relpath(dirpath, root).replace(os.sep, "_")
+    dest = os.path.join(trashdir, name)
+    n = 0
+    while os.path.exists(dest):
+        # left over from an interrupted purge
+        n += 1
+        dest = os.path.join(trashdir, "%s.%d" % (name, n))
+    os.rename(dirpath, dest)
+    logging.info("moved %s to the trash" % dirpath)
+
+
+class _Throttle:
+    """Sleeps as needed to keep the unlinks to the limit per second (0 for
+    no limit), and beats the purge thread's heartbeat after each batch of
+    unlinks."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.started = time.time()
+        self.count = 0
+        # check the rate about ten times a second
+        self.batch = max(limit / 10, 1) if limit > 0 else 100
+
+    def unlinked(self):
+        self.count += 1
+        if self.count % self.batch != 0:
+            return
+        health.beat()
+        if self.limit <= 0:
+            return
+        ahead = float(self.count) / self.limit - (time.time() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def _empty(dirpath, throttle, counts):
+    """Delete everything in the directory, and count the files and dirs."""
+    # read the whole directory first, since deleting entries while reading
+    # it may cause others to be skipped
+    for entry in list(scandir(dirpath)):
+        if entry.is_dir(follow_symlinks=False):
+            _empty(entry.path, throttle, counts)
+            os.rmdir(entry.path)
+            counts[1] += 1
+        else:
+            os.remove(entry.path)
+            counts[0] += 1
+            throttle.unlinked()
+
+
+def empty_trash(root, unlinks_per_sec):
+    """Delete the trash and everything in it at no more than
+    unlinks_per_sec unlinks per second (0 for no limit)."""
+    trashdir = trash_path(root)
+    if not os.path.isdir(trashdir):
+        return
+    started = time.time()
+    counts = [0, 0]     # files, dirs
+    _empty(trashdir, _Throttle(unlinks_per_sec), counts)
+    os.rmdir(trashdir)
+    logging.info("emptied the trash: %d files and %d directories in %.1f sec"
+                 % (counts[0], counts[1], time.time() - started))
@@ -0,0 +1,188 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Work queue of the camera-days waiting to be processed, shared by today's
+# processing thread and the previous days' worker threads.
+#
+# Each item is a (day dir, camera) with a priority; the lowest
+# priority value is taken first, and items of equal priority are taken in
+# the order they were queued.  Today's camera-days are queued ahead of all
+# others, then the previous days newest to oldest, and last of all the
+# mediumres images and image pages put off in catch-up mode.  (Within a
+# camera-day, process_camday() does the newest sequence first.)
+#
+# A thread claims an item while it works on it, so that no two threads ever
+# work on the same camera-day.  An item queued while it's claimed is held
+# back until the claim is released, and then queued again, so that images
+# arriving during a pass aren't missed.
+#
+# So that a camera that's triggered constantly can't hold up the others,
+# the cameras share the work by deficit round robin: each turn at a
+# camera-day allows it a quantum of images, in proportion to its camera's
+# weight, plus whatever it was allowed but didn't use on its last turn.  A
+# camera-day with images left over at the end of its turn is queued again,
+# behind the others of the same priority.  Separately, each camera may be
+# limited in the number of its images queued for the image pool at once.
+
+import heapq
+import itertools
+import threading
+
+TODAY = (0, 0)      # priority of today's camera-days
+
+
+def day_priority(day):
+    """Return the priority of a previous day's camera-days, given the day as
+    a datetime.date: newer days come first."""
+    return (1, -day.toordinal())
+
+
+def deferred_priority(day):
+    """Return the priority of the work put off in catch-up mode for a day's
+    camera-days, given the day as a datetime.date: after all other work,
+    newer days first."""
+    return (2, -day.toordinal())
+
+
+def is_deferred(priority):
+    return priority[0] == 2
+
+
+class Scheduler:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []              # (priority, order, item)
+        self.order = itertools.count()
+        self.queued = {}            # item: priority, for items in the heap
+        self.claimed = {}           # claimed item: its priority
+        self.again = {}             # claimed item: priority to requeue at
+        self.deficits = {}          # camera shortname: images allowed
+
+    def put(self, item, priority):
+        """Queue the item, or if it's already queued, raise its priority to
+        this one if that's higher."""
+        with self.lock:
+            if item in self.claimed:
+                self.again[item] = min(priority,
+                                       self.again.get(item, priority))
+            elif item not in self.queued or priority < self.queued[item]:
+                self._push(item, priority)
+
+    def _push(self, item, priority):
+        # a previous entry of the item, at a lower priority, is left in the
+        # heap and skipped when it comes up
+        self.queued[item] = priority
+        heapq.heappush(self.heap, (priority, next(self.order), item))
+
+    def claim(self, max_priority=None):
+        """Take the highest priority item that isn't claimed, and claim it.
+        Return None if there are none, or none with a priority of
+        max_priority or higher (i.e., a value of max_priority or less)."""
+        with self.lock:
+            while self.heap:
+                (priority, unused_order, item) = self.heap[0]
+                if max_priority is not None and priority > max_priority:
+                    return None
+                heapq.heappop(self.heap)
+                if self.queued.get(item) != priority:
+                    continue        # superseded by a higher priority entry
+                del self.queued[item]
+                self.claimed[item] = priority
+                return item
+            return None
+
+    def release(self, item, unfinished=False):
+        """Release the claim on the item, queueing it again, at the back of
+        its priority, if it's unfinished or was queued while claimed."""
+        with self.lock:
+            priority = self.claimed.pop(item)
+            if unfinished:
+                self.again[item] = min(priority,
+                                       self.again.get(item, priority))
+            if item in self.again:
+                self._push(item, self.again.pop(item))
+
+    def allowance(self, cam, quantum):
+        """Start a turn of one of the camera's camera-days: add the quantum
+        to the camera's deficit, and return the number of images it may
+        process."""
+        with self.lock:
+            self.deficits[cam] = self.deficits.get(cam, 0) + quantum
+            return self.deficits[cam]
+
+    def charge(self, cam, used, unfinished):
+        """End a turn: take the number of images processed from the camera's
+        deficit.  A camera with nothing left to do keeps no deficit."""
+        with self.lock:
+            if unfinished:
+                self.deficits[cam] = max(self.deficits.get(cam, 0) - used, 0)
+            else:
+                self.deficits.pop(cam, None)
+
+    def claimed_priority(self, item):
+        """Return the priority the claimed item was queued at."""
+        with self.lock:
+            return self.claimed[item]
+
+    def is_claimed(self, item):
+        with self.lock:
+            return item in self.claimed
+
+    def __len__(self):
+        """Return the number of items queued."""
+        with self.lock:
+            return len(self.queued)
+
+
+# the scheduler of the camera-days to be processed
+work = Scheduler()
+
+
+class CameraSlots:
+    """Counts each camera's images queued for or being processed by the
+    image pool, and limits them."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.counts = {}            # camera shortname: images
+
+    def acquire(self, cam, limit):
+        """Wait until the camera has fewer than limit images queued (limit
+        0 for no limit), then count one more."""
+        with self.cond:
+            while limit and self.counts.get(cam, 0) >= limit:
+                self.cond.wait()
+            self.counts[cam] = self.counts.get(cam, 0) + 1
+
+    def release(self, cam):
+        """Count one less of the camera's images queued."""
+        with self.cond:
+            self.counts[cam] -= 1
+            self.cond.notify_all()
+
+    def count(self, cam):
+        return self.counts.get(cam, 0)
+
+
+# each camera's images queued for the image pool
+slots = CameraSlots()
@@ -0,0 +1,190 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Divide a camera-day's images into sequences, incrementally.
+#
+# A Sequencer keeps the times of a camera-day's images as an array of seconds
+# since midnight, along with the index of the first image of each sequence.
+# Images that arrive later are appended: they either extend the last (open)
+# sequence or start new ones, and the earlier (closed) sequences are never
+# looked at again.  A Sequencer is kept between passes for each of the
+# sequencer_cache_camdays camera-days most recently processed, along with the
+# image index's rowid when it was brought up to date, so each pass only does
+# work in proportion to the number of new images.
+#
+# The Sequencer is itself a read-only list of sequences, and each sequence a
+# read-only list of (filename, datetime) tuples that are made only when they
+# are asked for.
+
+import array
+import bisect
+import datetime
+import logging
+import threading
+import collections
+from localsettings import sequencer_cache_camdays
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the Sequencer for each (day, camera shortname), least recently used first
+sequencers = collections.OrderedDict()
+sequencers_lock = threading.Lock()
+
+
+def _breaks(secs, first, gap):
+    """Return a list of the indices i >= first of the array secs at which
+    secs[i] - secs[i-1] >= gap, i.e., at which a new sequence starts."""
+    if first < 1:
+        first = 1
+    if numpy is not None:
+        a = numpy.frombuffer(secs, dtype=numpy.intc)
+        return (numpy.flatnonzero(numpy.diff(a[first-1:]) >= gap)
+                + first).tolist()
+    return [i for i in xrange(first, len(secs)) if secs[i] - secs[i-1] >= gap]
+
+
+class Sequence:
+    """A view of one of a Sequencer's sequences, which behaves as a read-only
+    list of (filename, datetime) tuples."""
+
+    def __init__(self, seqr, start, end):
+        self.seqr = seqr
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("sequence index out of range")
+        return self.seqr.image(self.start + i)
+
+    def filenames(self):
+        return self.seqr.filenames[self.start:self.end]
+
+
+class Sequencer:
+    """The sequences of a camera-day's images.  day is a datetime.date, and
+    images that are gap or more seconds apart are in different sequences."""
+
+    def __init__(self, day, gap):
+        self.midnight = datetime.datetime.combine(day, datetime.time())
+        self.gap = gap
+        self.filenames = []
+        self.secs = array.array("i")    # seconds since midnight
+        self.starts = array.array("i")  # index of each sequence's first image
+        # the image index, its generation, and its last rowid when the
+        # images were last added from it
+        self.index = None
+        self.generation = None
+        self.rowid = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.starts)
+        if i < 0 or i >= len(self.starts):
+            raise IndexError("sequence index out of range")
+        if i + 1 < len(self.starts):
+            end = self.starts[i+1]
+        else:
+            end = len(self.filenames)
+        return Sequence(self, self.starts[i], end)
+
+    def image(self, i):
+        """Return a (filename, datetime) tuple for the i'th image."""
+        return (self.filenames[i],
+                self.midnight + datetime.timedelta(seconds=self.secs[i]))
+
+    def last_filename(self):
+        if self.filenames:
+            return self.filenames[-1]
+        return None
+
+    def add(self, images):
+        """Append images, a list of (filename, seconds since midnight) tuples
+        sorted by filename, all of which sort after the images already
+        added."""
+        if not images:
+            return
+        first = len(self.filenames)
+        self.filenames.extend([f for (f, unused_secs) in images])
+        self.secs.extend([s for (unused_f, s) in images])
+        if first == 0:
+            self.starts.append(0)
+        self.starts.extend(_breaks(self.secs, first, self.gap))
+
+    def sequence_of(self, filename):
+        """Return the index of the sequence containing the image filename,
+        or None if there isn't one."""
+        i = bisect.bisect_left(self.filenames, filename)
+        if i == len(self.filenames) or self.filenames[i] != filename:
+            return None
+        return bisect.bisect_right(self.starts, i) - 1
+
+
+def get_sequencer(day, cam, gap, index):
+    """Return the up-to-date Sequencer for the camera-day, adding the images
+    that the image index has gained since the last call.  day is a
+    datetime.date and cam is a camera shortname.  If the index has lost any
+    images or gained any that don't sort after those already sequenced, or
+    the gap has changed, sequence the camera-day again from scratch."""
+    daystr = day.isoformat()
+    with sequencers_lock:
+        seqr = sequencers.pop((daystr, cam), None)
+    if seqr is not None and (seqr.gap != gap or seqr.index is not index
+                             or seqr.generation != index.generation):
+        seqr = None
+    if seqr is not None:
+        rowid = index.last_rowid()
+        images = index.images_since(daystr, cam, seqr.rowid)
+        if images and seqr.filenames and images[0][0] <= seqr.filenames[-1]:
+            seqr = None
+        else:
+            seqr.add(images)
+            seqr.rowid = rowid
+    if seqr is None:
+        logging.info("sequencing %s for %s" % (daystr, cam))
+        seqr = Sequencer(day, gap)
+        (seqr.index, seqr.generation) = (index, index.generation)
+        seqr.rowid = index.last_rowid()
+        seqr.add(index.images(daystr, cam))
+    with sequencers_lock:
+        while len(sequencers) >= sequencer_cache_camdays:
+            sequencers.popitem(last=False)
+        sequencers[(daystr, cam)] = seqr
+    return seqr
+
+
+def remove_day(daystr):
+    """Forget the Sequencers for the day, a YYYY-MM-DD string."""
+    with sequencers_lock:
+        for key in [k for k in sequencers if k[0] == daystr]:
+            del sequencers[key]
@@ -21,6 +21,9 @@
 ################################################################################
 
 from localsettings import root # and lwebrootpath when there is one
+from localsettings import stats_cache_minutes, stats_cache_tables, \
+                          stats_csv_minutes, stats_reconcile_minutes, \
+                          stats_rollup_minutes
 import threading
 import os.path
 import csv
@@ -31,6 +34,22 @@ import time
 import logging
 import platform
 import re
+import collections
+import array
+import struct
+import memory
+import imagepool
+import histogram
+import timing
+import health
+import storage
+import scheduler
+import controller
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # general exception for stats problems
@@ -43,10 +62,10 @@ class StatsError(Exception):
 #   per server: YYYY-DD-MM.csv
 #
 # All files are in lwebrootpath/perf.  Saved for same number of days as images.
-# In-memory values are stored in a dictionary of datecam-minute lists for the
-# per-camera values and date-minute lists for the server data.
-# Key is filename minus extension, value points to list of 1440 (one per second)
-# lists of stat values.
+# In-memory values are stored in a dictionary of datecam-minute tables for the
+# per-camera values and date-minute tables for the server data.
+# Key is filename minus extension, value points to a StatTable of 1440 (one per
+# minute) rows of stat values, stored compactly as an array of doubles.
 # 
 
 # XXX hack for initial implementation on old CommunityView
@@ -63,14 +82,20 @@ statdict = {}
 # in memory
 dictlock = threading.RLock()
 
+# number of tables loaded into statdict, evicted from it, and written out
+# because they were evicted
+cache_counts = {"loads": 0, "evictions": 0, "flushes": 0}
+
 # true when the server was restarted during the current minute
 restarted = False
 
 # datecam and per-server tables statdict:
-# top level is list: [RLock, table, changed]
+# top level is list: [RLock, table, changed, touched, stale]
 LOCK = 0
 TABLE = 1
 CHANGED = 2
+TOUCHED = 3     # time.time() when the table was last locked
+STALE = 4       # True if the CSV file lacks changes that are in the journal
 
 # datecam table column indicies
 NCREATE     = 0 # number of uploaded images that were created during this minute
@@ -80,28 +105,240 @@ AVGPROCLAT  = 3 # avg processing latency for images uploaded during this minute
 NPROC       = 4 # number of files processed during this minute
 NUNPROC     = 5 # number of unprocessed files from today at this minute
 NUNPROCPREV = 6 # number of unprocessed files from previous days at this minute
+UPLATP50    = 7 # median upload latency for images created during this minute
+UPLATP95    = 8 # 95th percentile of the same
+UPLATP99    = 9 # 99th percentile of the same
+PROCLATP50  = 10 # median processing latency for images uploaded this minute
+PROCLATP95  = 11 # 95th percentile of the same
+PROCLATP99  = 12 # 99th percentile of the same
+NQUEUED     = 13 # number of images queued for the image workers at this minute
 
-LENDCROW    = 7 # length of the datecam table row
+LENDCROW    = 14 # length of the datecam table row
 
 # extra columns in per-server table
-RESTARTED   = 7 # non-zero if server restarted during this minute
-NERRORS     = 8 # future use: count of ERROR-level events during this minute
+RESTARTED   = 14 # non-zero if server restarted during this minute
+NERRORS     = 15 # count of ERROR-level events during this minute
+PEAKRSS     = 16 # peak resident memory (MB) of the server during this minute
+STAGETIME   = 17 # seconds spent in each timing stage during this minute,
+                 # followed by the number of times through each stage
+NWARNINGS   = STAGETIME + 2*len(timing.STAGES)
+                 # count of WARNING-level events during this minute
+HEARTBEAT   = NWARNINGS + 1
+                 # seconds since the heartbeat of each of the long-running
+                 # threads, empty if the thread isn't running
+
+DISKFREE    = HEARTBEAT + len(health.HEARTBEATS)
+                 # MB free on the filesystem holding the images
+HIRESMB     = DISKFREE + 1 # MB of original images kept
+DERIVMB     = DISKFREE + 2 # MB of thumbnail and mediumres images kept
+
+LENPSROW    = DISKFREE + 3 # length of per-server row
 
-LENPSROW    = 9 # length of the per-server table row
+# columns holding averages, percentiles and times; all of the others hold
+# counts, which are returned as ints
+FLOATCOLS = (AVGUPLAT, AVGPROCLAT, UPLATP50, UPLATP95, UPLATP99,
+             PROCLATP50, PROCLATP95, PROCLATP99) \
+            + tuple(range(STAGETIME, STAGETIME + len(timing.STAGES)))
+
+# latency histograms kept for each minute of each table, and the columns of
+# the percentiles derived from them
+UPLAT = 0
+PROCLAT = 1
+PCTCOLS = {
+    UPLAT:   ((0.50, UPLATP50), (0.95, UPLATP95), (0.99, UPLATP99)),
+    PROCLAT: ((0.50, PROCLATP50), (0.95, PROCLATP95), (0.99, PROCLATP99)),
+    }
+# the histogram of each column of averages
+AVGHIST = {AVGUPLAT: UPLAT, AVGPROCLAT: PROCLAT}
+
+# how the columns are combined into the hourly and daily rollups: counts are
+# summed, the unprocessed and queued images, peak RSS, heartbeat ages and
+# storage used take the highest value and the free storage the lowest,
+# averages are weighted by the count of their images, and percentiles are
+# taken from the merged histograms
+SUMCOLS = (NCREATE, NUPLOAD, NPROC, RESTARTED, NERRORS, NWARNINGS) \
+            + tuple(range(STAGETIME, STAGETIME + 2*len(timing.STAGES)))
+MAXCOLS = (NUNPROC, NUNPROCPREV, NQUEUED, PEAKRSS) \
+            + tuple(range(HEARTBEAT, HEARTBEAT + len(health.HEARTBEATS))) \
+            + (HIRESMB, DERIVMB)
+MINCOLS = (DISKFREE,)
+AVGCOUNTCOL = {AVGUPLAT: NCREATE, AVGPROCLAT: NUPLOAD}
 
 # datecam CSV file column headers
 DCCSVHEADERS = ("Time", "Images Created/Min", "Upload Latency", 
                 "Images Uploaded/Min", "Processing Latency",
                 "Images Processed/Min", "Today's Unprocessed Images", 
-                "Previous Days' Unprocessed Images")
+                "Previous Days' Unprocessed Images",
+                "Upload Latency p50", "Upload Latency p95",
+                "Upload Latency p99", "Processing Latency p50",
+                "Processing Latency p95", "Processing Latency p99",
+                "Queued Images")
 
 # extra column headers in per-server table
-PSCSVHEADERS = DCCSVHEADERS + ("Restarted", "Errors")
+PSCSVHEADERS = DCCSVHEADERS + ("Restarted", "Errors", "Peak RSS") \
+            + tuple([s + " Time" for s in timing.STAGES]) \
+            + tuple([s + " Count" for s in timing.STAGES]) \
+            + ("Warnings",) \
+            + tuple([t + " Heartbeat Age" for t in health.HEARTBEATS]) \
+            + ("Disk Free MB", "Images MB", "Derivatives MB")
 
 # the number of rows in the datecam and server csv tables is equal to the number
 # of minutes in a day
 MINPERDAY = 1440
 
+# stored in the tables where there is no data
+NAN = float("nan")
+
+
+
+class StatRow:
+    """A view of one row of a StatTable, which behaves as a list of the row's
+    values, None where there is no data."""
+
+    def __init__(self, table, rowindex):
+        self.table = table
+        self.base = rowindex * table.ncols
+
+    def __len__(self):
+        return self.table.ncols
+
+    def __getitem__(self, colindex):
+        if colindex < 0 or colindex >= self.table.ncols:
+            raise IndexError("stats column index out of range")
+        v = self.table.data[self.base + colindex]
+        if v != v:      # NaN
+            return None
+        return v if colindex in FLOATCOLS else int(v)
+
+    def __setitem__(self, colindex, value):
+        if colindex < 0 or colindex >= self.table.ncols:
+            raise IndexError("stats column index out of range")
+        self.table.data[self.base + colindex] = \
+                NAN if value is None else value
+        self.table.dirty.add(self.base / self.table.ncols)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class StatTable:
+    """A table of MINPERDAY rows of ncols stats values, stored in one
+    array of doubles, with NaN where there is no data.  Indexing the table
+    by minute returns a StatRow, so table[minute][column] reads and writes
+    values as for a list of lists."""
+
+    def __init__(self, ncols, data=None):
+        self.ncols = ncols
+        if data is None:
+            data = array.array("d", [NAN]) * (MINPERDAY * ncols)
+        self.data = data
+        self.dirty = set()  # indices of the rows changed since take_dirty()
+        # {column index: row index} of the columns zeroback() has filled,
+        # whose rows before the row index need not be looked at again
+        self.zeroed = {}
+        # latency histograms: {(metric, minute): histogram}, only for the
+        # minutes that have latencies
+        self.hists = {}
+
+    def copy(self):
+        table = StatTable(self.ncols, array.array("d", self.data))
+        table.hists = dict([(k, array.array("I", h))
+                            for (k, h) in self.hists.items()])
+        return table
+
+    def add_latencies(self, metric, minute, buckets):
+        """Add the counts of latencies, a dict of {histogram bucket: count},
+        to the metric's histogram for the minute, and update the minute's
+        percentile columns."""
+        hist = self.hists.get((metric, minute))
+        if hist is None:
+            hist = self.hists[(metric, minute)] = histogram.new()
+        for (b, n) in buckets.items():
+            hist[b] += n
+        row = self[minute]
+        for (q, col) in PCTCOLS[metric]:
+            row[col] = round(histogram.percentile(hist, q), 4)
+
+    def merged_histogram(self, metric, minutes):
+        """Return the sum of the metric's histograms for the minutes, e.g.,
+        for an hour's percentiles."""
+        return histogram.merge([self.hists[(metric, m)] for m in minutes
+                                if (metric, m) in self.hists])
+
+    def take_dirty(self):
+        """Return a sorted list of the indices of the rows that have changed
+        since the last call, and forget them."""
+        dirty = sorted(self.dirty)
+        self.dirty = set()
+        return dirty
+
+    def __len__(self):
+        return MINPERDAY
+
+    def __getitem__(self, rowindex):
+        if rowindex < 0 or rowindex >= MINPERDAY:
+            raise IndexError("stats row index out of range")
+        return StatRow(self, rowindex)
+
+    def set_row(self, rowindex, values):
+        """Set the row's values from a list, which may be shorter than the
+        row; the remaining values are set to None."""
+        row = StatRow(self, rowindex)
+        for i in range(self.ncols):
+            row[i] = values[i] if i < len(values) else None
+        # the row may have gained None values that zeroback() should fill
+        self.zeroed = {}
+
+    def _view(self):
+        """Return a 2-D NumPy view of the table, or None if there's no
+        NumPy."""
+        if numpy is None:
+            return None
+        return numpy.frombuffer(self.data, dtype=numpy.float64) \
+                    .reshape(MINPERDAY, self.ncols)
+
+    def zeroback(self, rowindex, colindex):
+        """Starting with row rowindex-1 and working backward, replace all None
+        values in the column with zero until a non-None value is
+        encountered.  Only the rows since the column was last filled are
+        looked at, unless rowindex is before them."""
+        low = self.zeroed.get(colindex, 0)
+        if low > rowindex:
+            low = 0
+        self.zeroed[colindex] = rowindex
+        view = self._view()
+        if view is not None:
+            col = view[low:rowindex, colindex]
+            known = numpy.flatnonzero(~numpy.isnan(col))
+            start = (known[-1] + 1) if len(known) else 0
+            col[start:] = 0
+            self.dirty.update(xrange(low + start, rowindex))
+            return
+        data = self.data
+        i = (rowindex - 1) * self.ncols + colindex
+        while i >= low * self.ncols and data[i] != data[i]:
+            data[i] = 0
+            self.dirty.add(i / self.ncols)
+            i -= self.ncols
+
+    def column_sum(self, colindex):
+        """Return the sum of the column's values, ignoring None values."""
+        view = self._view()
+        if view is not None:
+            return float(numpy.nansum(view[:, colindex]))
+        return sum([v for v in self.data[colindex::self.ncols] if v == v])
+
+    def column_max(self, colindex):
+        """Return the largest of the column's values, or None if it has no
+        values."""
+        vals = [v for v in self.data[colindex::self.ncols] if v == v]
+        return max(vals) if vals else None
 
 
 def datecam_to_fn(datecam):
@@ -134,161 +371,247 @@ def lock_datecam(datecam, changed=True):
     dictlock.acquire() 
     if datecam not in statdict:
         # begin with an empty table
-        trow = [None] * (LENPSROW if is_ps else LENDCROW)
-        table = [None] * MINPERDAY  # initialization optimization
-        table = [list(trow) for _ in range(MINPERDAY)]
-        statdict[datecam] = [threading.RLock(), table,  changed]
+        ncols = LENPSROW if is_ps else LENDCROW
+        table = StatTable(ncols)
+        statdict[datecam] = [threading.RLock(), table,  changed, time.time(),
+                             False]
+        cache_counts["loads"] += 1
         
         fp = os.path.join(statspath, datecam_to_fn(datecam))
         if os.path.isfile(fp):
             with open(fp, "rb") as csvfile:
-                hh = csv.Sniffer().has_header(csvfile.read(1024))
+                # the header row starts with the Time header.  (The
+                # sniffer can't find the delimiter in a sample that's all
+                # header, as it is now that the headers are so long)
+                hh = csvfile.readline().startswith(DCCSVHEADERS[0])
                 csvfile.seek(0)
                 if not hh:
                     logging.warn("%s: no header row" % fp)
                 reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+                # the table column of each field after the time field.
+                # Without a header row, the fields are taken to be in table
+                # order
+                colmap = range(ncols)
                 rindex = 0
                 for csvrow in reader:
-                    if hh:  # skip the header row
+                    if hh:  # map the columns by the header row
                         hh = False
+                        colmap = column_map(csvrow[1:],
+                                        PSCSVHEADERS if is_ps else DCCSVHEADERS)
                         continue
-                    if len(csvrow) != (LENPSROW if is_ps else LENDCROW) + 1:
+                    # files written by earlier versions may lack columns that
+                    # have since been added.  Those values are None
+                    if len(csvrow) > len(colmap) + 1 or len(csvrow) < 2:
                         raise StatsError("%s: line %d: wrong number of fields" \
                                 % (fp, rindex+1))
-                    csvrow = csvrow[1:]     # remove the time field
-                    table[rindex] = [number(s) for s in csvrow]
+                    if rindex >= MINPERDAY:
+                        raise StatsError("%s: too many data rows" % fp)
+                    values = [None] * ncols
+                    for (c, s) in zip(colmap, csvrow[1:]):
+                        if c is not None:
+                            values[c] = number(s)
+                    table.set_row(rindex, values)
                     rindex += 1
             if rindex != MINPERDAY:
                 raise StatsError("%s: wrong number of data rows: %d" \
                                  % (fp, rindex))
+        read_histograms(datecam, table)
+        # apply the changes made since the CSV file was last written
+        if replay_journal(datecam, table):
+            statdict[datecam][STALE] = True
+        table.take_dirty()
     statdict[datecam][LOCK].acquire()
-    statdict[datecam][CHANGED] = changed
+    # don't lose the changes of an earlier caller
+    statdict[datecam][CHANGED] = statdict[datecam][CHANGED] or changed
+    statdict[datecam][TOUCHED] = time.time()
     dictlock.release()
     return (statdict[datecam][LOCK], statdict[datecam][TABLE])
 
+def column_map(headers, tableheaders):
+    """Return a list of the table column index of each of the CSV headers
+    (not including the time header), None for headers the table doesn't
+    have."""
+    colmap = []
+    for h in headers:
+        if h in tableheaders[1:]:
+            colmap.append(tableheaders.index(h) - 1)
+        else:
+            colmap.append(None)
+    return colmap
+
 def zeroback(table, rowindex, colindex):
     """Starting with row rowindex-1 and working backward, replace all None
     values in the specified column of the table with integer zero until a
     non-None value is encountered."""
-    rowindex -= 1
-    while rowindex >= 0 and table[rowindex][colindex] is None:
-        table[rowindex][colindex] = 0
-        rowindex -= 1
+    table.zeroback(rowindex, colindex)
 
-def proc_stats(imagepath):
-    """Called by image processing code to record image processing statistics for
-    the given image file."""
+def proc_record(imagepath, mtime=None, now=None):
+    """Return the record of an image's processing statistics that is queued
+    by record_proc() and tallied by tally_records(), a tuple of (date,
+    camera shortname, image filename, mtime, now).  The arguments are as for
+    proc_stats()."""
     (p, filename) = os.path.split(imagepath)
     (p, cam) = os.path.split(p)
     (_, date) = os.path.split(p)
-    createdatecam = (date, cam)
-    mtime = os.path.getmtime(imagepath)
-
-    # the upload latency is recorded with respect to the time the image was
-    # created, which is indicated by the image filename
-    (yr, mo, day) = dir2date(createdatecam[0])
-    (hr, minute, sec) = file2time(filename)
-    fndt = datetime.datetime(yr, mo, day, hr, minute, sec)
-    createminute = hr*60 + minute
-    uplatdelta = datetime.datetime.fromtimestamp(mtime) - fndt
-    uplat = uplatdelta.days*24*60 + float(uplatdelta.seconds)/60
-    if uplat < 0:
-        logging.warn("upload latency is negative: %s %s: %d minutes" % \
-                         (createdatecam, filename, uplat))
-        uplat = 0
-
-    # datecam table for the image's creation date
-    (lock, table) = lock_datecam(createdatecam)        
-    row = table[createminute]
-    if row[NCREATE] is None:
-        row[NCREATE] = 0
-    if row[AVGUPLAT] is None:
-        row[AVGUPLAT] = 0.0
-    row[AVGUPLAT] = (row[AVGUPLAT] * row[NCREATE] + uplat) / (row[NCREATE] + 1)
-    row[NCREATE] += 1
-    zeroback(table, createminute, NCREATE)
-    lock.release()
-    
-    # per-server table for the image's creation date    datesrv = 
-    (lock, table) = lock_datecam((createdatecam[0],""))
-    row = table[createminute]
-    if row[NCREATE] is None:
-        row[NCREATE] = 0
-    if row[AVGUPLAT] is None:
-        row[AVGUPLAT] = 0.0
-    row[AVGUPLAT] = (row[AVGUPLAT] * row[NCREATE] + uplat) / (row[NCREATE] + 1)
-    row[NCREATE] += 1
-    zeroback(table, createminute, NCREATE)
-    lock.release()
-    
-    # the processing latency is recorded with respect the time the image was
-    # uploaded to the server, which is indicated by the modification time of the
-    # file
-    now = time.time()
-    proclat = (now - mtime)/60
-    mtime_tm = time.localtime(mtime)
-    uploaddatecam = (time.strftime("%Y-%m-%d", mtime_tm), createdatecam[1])
-    uploadminute = mtime_tm.tm_hour*60 + mtime_tm.tm_min
-    
-    # datecam table for the image's upload date
-    (lock, table) = lock_datecam(uploaddatecam)
-    row = table[uploadminute]
-    if row[NUPLOAD] is None:
-        row[NUPLOAD] = 0
-    if row[AVGPROCLAT] is None:
-        row[AVGPROCLAT] = 0.0
-    row[AVGPROCLAT] = (row[AVGPROCLAT] * row[NUPLOAD] + proclat) \
-                        / (row[NUPLOAD] + 1)
-    row[NUPLOAD] += 1
-    zeroback(table, uploadminute, NUPLOAD)
-    lock.release()
-    
-    # per-server table for the image's upload date
-    (lock, table) = lock_datecam((uploaddatecam[0],""))
-    row = table[uploadminute]
-    if row[NUPLOAD] is None:
-        row[NUPLOAD] = 0
-    if row[AVGPROCLAT] is None:
-        row[AVGPROCLAT] = 0.0
-    row[AVGPROCLAT] = (row[AVGPROCLAT] * row[NUPLOAD] + proclat) \
-                        / (row[NUPLOAD] + 1)
-    row[NUPLOAD] += 1
-    zeroback(table, uploadminute, NUPLOAD)
-    lock.release()
-    
-    # the record the number of images processed this minute
-    now_tm = time.localtime(now)
-    nowdatecam = (time.strftime("%Y-%m-%d", now_tm), createdatecam[1])
-    nowminute = now_tm.tm_hour*60 + now_tm.tm_min
-    
-    # datecam table for the image's processing date
-    (lock, table) = lock_datecam(nowdatecam)
-    if table[nowminute][NPROC] is None:
-        table[nowminute][NPROC] = 0
-    table[nowminute][NPROC] += 1
-    zeroback(table, nowminute, NPROC)
-    lock.release()
+    if mtime is None:
+        mtime = os.path.getmtime(imagepath)
+    if now is None:
+        now = time.time()
+    return (date, cam, filename, mtime, now)
 
-    # per-server table for the image's processing date
-    (lock, table) = lock_datecam((nowdatecam[0],""))
-    if table[nowminute][NPROC] is None:
-        table[nowminute][NPROC] = 0
-    table[nowminute][NPROC] += 1
-    zeroback(table, nowminute, NPROC)
-    lock.release()
+def _add_avg(table, minute, ncol, avgcol, n, total):
+    """Add n values summing to total to the count in column ncol and the
+    average in column avgcol of the table's row for the minute."""
+    row = table[minute]
+    if row[ncol] is None:
+        row[ncol] = 0
+    if row[avgcol] is None:
+        row[avgcol] = 0.0
+    row[avgcol] = (row[avgcol] * row[ncol] + total) / (row[ncol] + n)
+    row[ncol] += n
+    zeroback(table, minute, ncol)
+
+def _add_count(table, minute, ncol, n):
+    row = table[minute]
+    if row[ncol] is None:
+        row[ncol] = 0
+    row[ncol] += n
+    zeroback(table, minute, ncol)
+
+def tally_records(records):
+    """Add the statistics of the records made by proc_record() to the stats
+    tables.  The records are first totalled per table, minute and column, so
+    that each table is locked only once however many records there are."""
+    # (date, cam): {(minute, ncol, avgcol): [n, total, {bucket: count}]}
+    tallies = {}
+    def add(datecam, minute, ncol, avgcol, value):
+        b = histogram.bucket(value)
+        for dc in (datecam, (datecam[0], "")):  # datecam and per-server
+            t = tallies.setdefault(dc, {}).setdefault((minute, ncol, avgcol),
+                                                      [0, 0.0, {}])
+            t[0] += 1
+            t[1] += value
+            t[2][b] = t[2].get(b, 0) + 1
+
+    for (date, cam, filename, mtime, now) in records:
+        # the upload latency is recorded with respect to the time the image
+        # was created, which is indicated by the image filename
+        (yr, mo, day) = dir2date(date)
+        (hr, minute, sec) = file2time(filename)
+        fndt = datetime.datetime(yr, mo, day, hr, minute, sec)
+        uplatdelta = datetime.datetime.fromtimestamp(mtime) - fndt
+        uplat = uplatdelta.days*24*60 + float(uplatdelta.seconds)/60
+        if uplat < 0:
+            logging.warn("upload latency is negative: %s %s: %d minutes" % \
+                             ((date, cam), filename, uplat))
+            uplat = 0
+        add((date, cam), hr*60 + minute, NCREATE, AVGUPLAT, uplat)
+
+        # the processing latency is recorded with respect the time the image
+        # was uploaded to the server, which is indicated by the modification
+        # time of the file
+        mtime_tm = time.localtime(mtime)
+        add((time.strftime("%Y-%m-%d", mtime_tm), cam),
+            mtime_tm.tm_hour*60 + mtime_tm.tm_min, NUPLOAD, AVGPROCLAT,
+            (now - mtime)/60)
+
+        # the number of images processed this minute
+        now_tm = time.localtime(now)
+        add((time.strftime("%Y-%m-%d", now_tm), cam),
+            now_tm.tm_hour*60 + now_tm.tm_min, NPROC, None, 0)
+
+    for (datecam, cells) in tallies.items():
+        (lock, table) = lock_datecam(datecam)
+        try:
+            for ((minute, ncol, avgcol), (n, total, buckets)) \
+                    in sorted(cells.items()):
+                if avgcol is None:
+                    _add_count(table, minute, ncol, n)
+                else:
+                    _add_avg(table, minute, ncol, avgcol, n, total)
+                    table.add_latencies(AVGHIST[avgcol], minute, buckets)
+        finally:
+            lock.release()
+
+def proc_stats(imagepath, mtime=None, now=None):
+    """Called by image processing code to record image processing statistics for
+    the given image file.  mtime is the image file's modification time and
+    now is the time the image was processed; these default to the file's
+    current mtime and the current time, but must be supplied if the stats
+    are being recorded after the file has been moved, e.g., for an image
+    processed in a worker process.  The statistics are added to the tables
+    before returning; see record_proc() for the queued alternative."""
+    tally_records([proc_record(imagepath, mtime, now)])
+
+# records queued by record_proc(), waiting to be tallied by the aggregator
+# thread.  Appending to and popping from a deque are atomic, so the queue
+# needs no lock
+proc_queue = collections.deque()
+
+def record_proc(imagepath, mtime=None, now=None):
+    """Queue the image's processing statistics to be added to the tables by
+    the aggregator thread, within about a second.  Takes no locks.  The
+    arguments are as for proc_stats()."""
+    proc_queue.append(proc_record(imagepath, mtime, now))
+
+def flush_proc_queue():
+    """Tally all of the records in the queue."""
+    records = []
+    try:
+        while True:
+            records.append(proc_queue.popleft())
+    except IndexError:
+        pass
+    if records:
+        tally_records(records)
+
+def aggregator_loop():
+    """Called by the aggregator thread to tally the queued processing
+    statistics once per second."""
+    set_thread_prefix(threading.current_thread(), "Aggregator")
+    logging.info("Starting aggregator_loop()")
+    while True:
+        health.beat()
+        try:
+            flush_proc_queue()
+        except Exception, e:
+            logging.error("Unexpected exception in aggregator_loop()")
+            logging.exception(e)
+        time.sleep(1)
+
+aggregator_thread = None
+
+def start_aggregator():
+    """Start the aggregator thread if it is not already running."""
+    global aggregator_thread
+    if aggregator_thread is None or not aggregator_thread.is_alive():
+        aggregator_thread = threading.Thread(target=aggregator_loop)
+        aggregator_thread.daemon = True
+        aggregator_thread.start()
 
 def write_dctable(datecam):
     """Write the specified datecam or per-server
-    stats table out to the filesystem."""
+    stats table out to the filesystem as a CSV file, and remove its journal,
+    whose changes are now in the CSV file.  The table is only locked while
+    it's copied, not while the file is written."""
     is_ps = datecam[1]==""
     fp = os.path.join(statspath, datecam_to_fn(datecam)+".temp")
-    statdict[datecam][LOCK].acquire()
+    entry = statdict[datecam]
+    entry[LOCK].acquire()
+    try:
+        # changes not yet journaled are written to the CSV file too
+        table = entry[TABLE].copy()
+        entry[TABLE].take_dirty()
+        entry[CHANGED] = False
+        entry[STALE] = False
+    finally:
+        entry[LOCK].release()
     with open(fp, "wb") as csvfile:
         writer = csv.writer(csvfile, delimiter=',', quotechar='"')
         writer.writerow(PSCSVHEADERS if is_ps else DCCSVHEADERS)
         
         for m in range(MINPERDAY):
-            trow = statdict[datecam][TABLE][m]
+            trow = table[m]
             csvrow = [None] * (LENPSROW if is_ps else LENDCROW + 1)
             csvrow[0] = datecam[0] + " %02d:%02d" % (m/60, m%60)
             csvrow[1:(LENPSROW if is_ps else LENDCROW)+1] = \
@@ -299,51 +622,326 @@ def write_dctable(datecam):
         if os.path.isfile(dcfilepath):
             os.remove(dcfilepath)
     os.rename(fp, dcfilepath)
-    statdict[datecam][CHANGED] = False
-    statdict[datecam][LOCK].release()
-    
+    write_histograms(datecam, table)
+    # if the journal were removed first, a crash here would lose its changes.
+    # Replaying a journal whose changes are already in the CSV file is
+    # harmless
+    try:
+        os.remove(journal_path(datecam))
+    except OSError:
+        pass
+
+# The latency histograms of a table are saved alongside its CSV file, when
+# the CSV file is written, so that the percentiles of a minute can be updated
+# after the table is reloaded.  Only the non-zero buckets are saved: for each
+# histogram, the metric, the minute and the number of non-zero buckets, then
+# the index and count of each non-zero bucket.
+_hhead = struct.Struct("<BHB")
+_hbucket = struct.Struct("<BI")
+
+def histogram_path(datecam):
+    return os.path.join(statspath, datecam_to_fn(datecam) + ".hist")
+
+def write_histograms(datecam, table):
+    if not table.hists:
+        return
+    parts = []
+    for ((metric, minute), hist) in sorted(table.hists.items()):
+        nz = [(b, n) for (b, n) in enumerate(hist) if n]
+        parts.append(_hhead.pack(metric, minute, len(nz)))
+        parts.extend([_hbucket.pack(b, n) for (b, n) in nz])
+    fp = histogram_path(datecam)
+    with open(fp + ".temp", "wb") as f:
+        f.write("".join(parts))
+    if platform.system() == "Windows":
+        if os.path.isfile(fp):
+            os.remove(fp)
+    os.rename(fp + ".temp", fp)
+
+def read_histograms(datecam, table):
+    try:
+        with open(histogram_path(datecam), "rb") as f:
+            buf = f.read()
+    except IOError:
+        return
+    i = 0
+    try:
+        while i < len(buf):
+            (metric, minute, nnz) = _hhead.unpack_from(buf, i)
+            i += _hhead.size
+            hist = histogram.new()
+            for _ in range(nnz):
+                (b, n) = _hbucket.unpack_from(buf, i)
+                i += _hbucket.size
+                hist[b] = n
+            table.hists[(metric, minute)] = hist
+    except (struct.error, IndexError), e:
+        logging.warn("%s: bad histogram file: %s"
+                     % (histogram_path(datecam), e))
+
+# Journal of the changes to a table since its CSV file was last written.
+# Each record is a row of the table: the minute (row index) and the number of
+# values, as unsigned shorts, followed by the values as doubles, NaN for None.
+# A journal begins with a layout record, whose minute is _jlayout and whose
+# values are the table's column headers, newline-separated, so that records
+# written before the table's columns were changed are mapped by header, as the
+# CSV files are, rather than lost.  A journal without one is ignored.
+_jhead = struct.Struct("<HH")
+_jlayout = 0xFFFF
+
+def _layout_record(is_ps):
+    headers = "\n".join((PSCSVHEADERS if is_ps else DCCSVHEADERS)[1:])
+    return _jhead.pack(_jlayout, len(headers)) + headers
+
+def journal_path(datecam):
+    return os.path.join(statspath, datecam_to_fn(datecam) + ".jnl")
+
+def write_journal(datecam):
+    """Append the rows of the table that have changed since they were last
+    journaled (or the table was written as CSV) to its journal."""
+    entry = statdict[datecam]
+    entry[LOCK].acquire()
+    try:
+        table = entry[TABLE]
+        rows = table.take_dirty()
+        records = []
+        for m in rows:
+            records.append(_jhead.pack(m, table.ncols))
+            records.append(table.data[m*table.ncols:(m+1)*table.ncols]
+                           .tostring())
+        entry[CHANGED] = False
+        if rows:
+            entry[STALE] = True
+    finally:
+        entry[LOCK].release()
+    if records:
+        with open(journal_path(datecam), "ab") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                records.insert(0, _layout_record(datecam[1]==""))
+            f.write("".join(records))
+
+def replay_journal(datecam, table):
+    """Apply the table's journal, if any, to the table.  A partial record at
+    the end of the journal, as left by a crash while it was being written, is
+    ignored.  A journal that doesn't begin with a layout record is corrupt,
+    and is removed, leaving the table as its CSV file has it.  Return True if
+    there were any records."""
+    jp = journal_path(datecam)
+    try:
+        with open(jp, "rb") as f:
+            buf = f.read()
+    except IOError:
+        return False
+    (m, n) = (None, 0)
+    if len(buf) >= _jhead.size:
+        (m, n) = _jhead.unpack_from(buf)
+    i = _jhead.size + n
+    if m != _jlayout or i > len(buf):
+        logging.warn("%s: no layout record; ignoring journal" % jp)
+        try:
+            os.remove(jp)
+        except OSError:
+            pass
+        return False
+    # the table column of each value in a record
+    colmap = column_map(buf[_jhead.size:i].split("\n"),
+                        PSCSVHEADERS if datecam[1]=="" else DCCSVHEADERS)
+    nrecords = 0
+    while i + _jhead.size <= len(buf):
+        (m, ncols) = _jhead.unpack_from(buf, i)
+        end = i + _jhead.size + 8*ncols
+        if end > len(buf):
+            logging.warn("%s: partial record at end of journal" % jp)
+            break
+        if m >= MINPERDAY:
+            raise StatsError("%s: bad minute in journal: %d" % (jp, m))
+        if ncols != len(colmap):
+            # e.g., zeros left by a crash while the record was being written
+            logging.warn("%s: bad record in journal" % jp)
+            break
+        values = array.array("d")
+        values.fromstring(buf[i+_jhead.size:end])
+        row = [None] * table.ncols
+        for (c, v) in zip(colmap, values):
+            if c is not None and v == v:
+                row[c] = v
+        table.set_row(m, row)
+        nrecords += 1
+        i = end
+    return nrecords > 0
+
+# Counts of the unprocessed images in each camera-day's incoming dir, kept
+# up to date as images arrive and are processed, so that the stats thread
+# doesn't have to list the directories every minute.  The counts are
+# reconciled with the directories every stats_reconcile_minutes.
+# Key is (date, camera shortname)
+unprocessed = {}
+unproc_lock = threading.Lock()
+last_reconcile = None   # time of the last reconciliation
+
+def count_arrival(date, cam):
+    """Count an image that has arrived in the camera-day's incoming dir."""
+    with unproc_lock:
+        unprocessed[(date, cam)] = unprocessed.get((date, cam), 0) + 1
+
+def count_processed(date, cam):
+    """Count an image that has been moved out of the camera-day's incoming
+    dir."""
+    with unproc_lock:
+        n = unprocessed.get((date, cam), 0)
+        if n > 0:
+            unprocessed[(date, cam)] = n - 1
+
+def set_unprocessed(date, cam, n):
+    """Set the count of the camera-day's unprocessed images, e.g., after
+    listing its incoming dir."""
+    with unproc_lock:
+        unprocessed[(date, cam)] = n
+
+def forget_unprocessed(date):
+    with unproc_lock:
+        for k in [k for k in unprocessed if k[0] == date]:
+            del unprocessed[k]
+
+def reconcile_unprocessed(timestamp, cameras):
+    """Recount the unprocessed images in all of the incoming dirs."""
+    global last_reconcile
+    counts = {}
+    for dp in get_daydirs():
+        (_, d) = os.path.split(dp)
+        for cam in cameras:
+            dcp = os.path.join(dp, cam.shortname)
+            if os.path.isdir(dcp):
+                counts[(d, cam.shortname)] = len(get_images_in_dir(dcp))
+    with unproc_lock:
+        unprocessed.clear()
+        unprocessed.update(counts)
+    last_reconcile = timestamp
+
 def minute_stats(timestamp, cameras):
     global restarted
+    # bring the tables up to date with the queued processing statistics
+    flush_proc_queue()
     # get count of unprocessed images for previous days and today.
     # Write each changed stats table out to the filesystem
     ts_tm = time.localtime(timestamp)
     today = time.strftime("%Y-%m-%d", ts_tm)
     minute = ts_tm.tm_hour*60 + ts_tm.tm_min
-    datepaths = get_daydirs()
+    if last_reconcile is None \
+            or abs(timestamp - last_reconcile) >= stats_reconcile_minutes*60:
+        reconcile_unprocessed(timestamp, cameras)
+    with unproc_lock:
+        counts = unprocessed.items()
     unproctodayallcams = 0
     unprocprevdaysallcams = 0
+    queuedallcams = 0
     for cam in cameras:
         unproctoday = 0
         unprocprevdays = 0
-        for dp in datepaths:
-            dcp = os.path.join(dp, cam.shortname)
-            if os.path.isdir(dcp):
-                n = len(get_images_in_dir(dcp))
-                (_, d) = os.path.split(dp)
+        for ((d, c), n) in counts:
+            if c == cam.shortname:
                 if d == today:
                     unproctoday += n
                 else:
                     unprocprevdays += n
         unproctodayallcams += unproctoday
         unprocprevdaysallcams += unprocprevdays
+        queued = scheduler.slots.count(cam.shortname)
+        queuedallcams += queued
 
         (lock, table) = lock_datecam((today, cam.shortname))
         table[minute][NUNPROC] = unproctoday
         table[minute][NUNPROCPREV] = unprocprevdays
+        table[minute][NQUEUED] = queued
         lock.release()
 
     # per-server table
     (lock, table) = lock_datecam((today, ""))
     table[minute][NUNPROC] = unproctodayallcams
     table[minute][NUNPROCPREV] = unprocprevdaysallcams
+    table[minute][NQUEUED] = queuedallcams
     if restarted:
         table[minute][RESTARTED] = 1
         restarted = False
+    table[minute][PEAKRSS] = memory.peak_rss_mb(imagepool.worker_pids())
+    if timing.enabled:
+        n = len(timing.STAGES)
+        for (stage, (secs, count)) in enumerate(timing.take()):
+            table[minute][STAGETIME + stage] = round(secs, 3)
+            table[minute][STAGETIME + n + stage] = count
+    (errors, warnings, by_thread) = health.take_counts()
+    table[minute][NERRORS] = errors
+    table[minute][NWARNINGS] = warnings
+    for (i, prefix) in enumerate(health.HEARTBEATS):
+        age = health.heartbeat_age(prefix, timestamp)
+        table[minute][HEARTBEAT + i] = None if age is None else int(age)
+    if storage.last_usage is not None:
+        (free, hires, deriv) = storage.last_usage
+        table[minute][DISKFREE] = free >> 20
+        table[minute][HIRESMB] = hires >> 20
+        table[minute][DERIVMB] = deriv >> 20
+    # the latency of the images uploaded in the last few minutes, for the
+    # concurrency controller
+    latency = histogram.percentile(table.merged_histogram(PROCLAT,
+                                        range(max(minute - 4, 0), minute + 1)),
+                                   0.95)
     lock.release()
+    controller.update(latency, unproctodayallcams + unprocprevdaysallcams)
+    if by_thread:
+        logging.info("errors, warnings logged in the last minute by thread: "
+                     + ", ".join(["%s %d, %d" % (t, e, w) for (t, (e, w))
+                                  in sorted(by_thread.items())]))
 
+    # journal the changes to each changed table, and periodically bring the
+    # CSV files that the stats page reads up to date
     for k in statdict.keys():
         if statdict[k][CHANGED]:
-            write_dctable(k)
+            rollups_pending.add(k)
+            write_journal(k)
+    if minute % stats_csv_minutes == 0:
+        for k in statdict.keys():
+            if statdict[k][STALE]:
+                write_dctable(k)
+    if minute % stats_rollup_minutes == 0 or rollups_building:
+        update_rollups()
+
+    evict_stats(timestamp, today)
+
+def evict_stats(now, today):
+    """Drop the tables that are not for today from memory if they haven't been
+    used for stats_cache_minutes, writing them out first if they've changed,
+    then drop the least recently used of the remaining tables that are not
+    for today until no more than stats_cache_tables are left.  Tables that
+    are locked by another thread are left alone."""
+    dictlock.acquire()
+    try:
+        cold = sorted([(e[TOUCHED], k) for (k, e) in statdict.items()
+                       if k[0] != today])
+        excess = len(statdict) - stats_cache_tables
+        for (touched, k) in cold:
+            if now - touched < stats_cache_minutes * 60 and excess <= 0:
+                continue
+            entry = statdict[k]
+            if not entry[LOCK].acquire(False):
+                continue
+            try:
+                # at the end of the day (or when an earlier day's table
+                # was updated), the table's changes are written to its CSV
+                # file
+                if entry[CHANGED] or entry[STALE]:
+                    write_dctable(k)
+                    cache_counts["flushes"] += 1
+                del statdict[k]
+                cache_counts["evictions"] += 1
+                excess -= 1
+            finally:
+                entry[LOCK].release()
+    finally:
+        dictlock.release()
+    logging.debug("stats cache: %d tables, %d loads, %d evictions, %d flushes"
+                  % (len(statdict), cache_counts["loads"],
+                     cache_counts["evictions"], cache_counts["flushes"]))
 
 def restart_stats():
     global restarted
@@ -368,7 +966,194 @@ def expire_stats(retain_days):
             if re.search("^"+retain_date, f):
                 break
             os.remove(os.path.join(statspath, f))
+        expire_rollups(retain_date)
     
+# Hourly and daily rollups of the stats tables, covering all of the retained
+# days, so that the stats page can graph weeks or months without loading
+# every day's per-minute files.  Each camera (and the server) has an hourly
+# file, hourly_<camera>.csv, and a daily file, daily_<camera>.csv, with the
+# same columns as its per-minute files.
+#
+# The rollups are kept in memory as {camera: {period: {time: row}}} and the
+# rows for each date whose tables have changed are recalculated every
+# stats_rollup_minutes.  If there are no rollup files, they are built from
+# all of the stats files, ROLLUP_BUILD_TABLES tables a minute, each dropped
+# from memory once it's rolled up, and the files are written when they're
+# all done.
+ROLLUP_PERIODS = {"hourly": 60, "daily": MINPERDAY}
+ROLLUP_BUILD_TABLES = 20
+
+rollups = None
+rollups_pending = set()     # datecams changed since the rollups were updated
+rollups_changed = set()     # (period, cam) rollups not yet written
+rollups_building = False    # True while building the rollups from scratch
+rollup_lock = threading.Lock()
+
+def rollup_path(period, cam):
+    return os.path.join(statspath, "%s_%s.csv" % (period, cam))
+
+def rollup_row(table, first, last):
+    """Return the rollup of the table's rows from minute first up to minute
+    last, or None if they have no data."""
+    ncols = table.ncols
+    cells = table.data[first*ncols:last*ncols]
+    values = [None] * ncols
+    for col in range(ncols):
+        vals = [v for v in cells[col::ncols] if v == v]     # skip NaNs
+        if not vals:
+            continue
+        if col in SUMCOLS:
+            values[col] = sum(vals)
+        elif col in MAXCOLS:
+            values[col] = max(vals)
+        elif col in MINCOLS:
+            values[col] = min(vals)
+        elif col in AVGCOUNTCOL:
+            # weight each minute's average by the number of its images
+            pairs = [(a, n) for (a, n) in zip(cells[col::ncols],
+                                             cells[AVGCOUNTCOL[col]::ncols])
+                     if a == a and n == n and n > 0]
+            total = sum([n for (a, n) in pairs])
+            if total:
+                values[col] = round(sum([a*n for (a, n) in pairs]) / total, 3)
+        if values[col] is not None and col not in FLOATCOLS:
+            values[col] = int(values[col])
+    for (metric, pcts) in PCTCOLS.items():
+        hist = table.merged_histogram(metric, range(first, last))
+        for (q, col) in pcts:
+            p = histogram.percentile(hist, q)
+            if p is not None:
+                values[col] = round(p, 4)
+    if values == [None] * ncols:
+        return None
+    return values
+
+def _load_rollups():
+    """Read the rollup files into memory, if not already read, noting all of
+    the stats tables as pending if there are none."""
+    global rollups, rollups_building
+    if rollups is not None:
+        return
+    rollups = {}
+    found = False
+    for f in os.listdir(statspath):
+        mobj = re.search(r"^(hourly|daily)_(.*)\.csv$", f)
+        if not mobj:
+            continue
+        found = True
+        (period, cam) = mobj.groups()
+        rows = rollups.setdefault(cam, {}).setdefault(period, {})
+        with open(os.path.join(statspath, f), "rb") as csvfile:
+            reader = csv.reader(csvfile)
+            headers = next(reader, None)
+            if headers is None:
+                continue
+            colmap = column_map(headers[1:],
+                                PSCSVHEADERS if cam == "" else DCCSVHEADERS)
+            ncols = LENPSROW if cam == "" else LENDCROW
+            for csvrow in reader:
+                values = [None] * ncols
+                for (c, v) in zip(colmap, csvrow[1:]):
+                    if c is not None:
+                        values[c] = number(v)
+                rows[csvrow[0]] = values
+    if not found:
+        for f in os.listdir(statspath):
+            mobj = re.search(r"^(\d\d\d\d-\d\d-\d\d)_(.*)\.csv$", f)
+            if mobj:
+                rollups_pending.add(mobj.groups())
+        rollups_building = bool(rollups_pending)
+
+def _write_rollup(period, cam):
+    rows = rollups.get(cam, {}).get(period, {})
+    fp = rollup_path(period, cam)
+    with open(fp + ".temp", "wb") as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', quotechar='"')
+        writer.writerow(PSCSVHEADERS if cam == "" else DCCSVHEADERS)
+        for t in sorted(rows):
+            writer.writerow([t] + [str(x) if x is not None else None
+                                   for x in rows[t]])
+    if platform.system() == "Windows":
+        if os.path.isfile(fp):
+            os.remove(fp)
+    os.rename(fp + ".temp", fp)
+
+def drop_table(datecam):
+    """Drop the table from memory unless it has changed or is in use."""
+    dictlock.acquire()
+    try:
+        entry = statdict.get(datecam)
+        if entry is None or not entry[LOCK].acquire(False):
+            return
+        try:
+            if not (entry[CHANGED] or entry[STALE]):
+                del statdict[datecam]
+                cache_counts["evictions"] += 1
+        finally:
+            entry[LOCK].release()
+    finally:
+        dictlock.release()
+
+def update_rollups():
+    """Recalculate the rollup rows of the dates whose stats tables have
+    changed, and write out the rollup files that have changed.  While the
+    rollups are being built, only ROLLUP_BUILD_TABLES tables are read, and
+    the files aren't written until they're all done."""
+    global rollups_building
+    with rollup_lock:
+        _load_rollups()
+        nread = 0
+        while rollups_pending and not (rollups_building
+                                       and nread >= ROLLUP_BUILD_TABLES):
+            (date, cam) = rollups_pending.pop()
+            dictlock.acquire()
+            loaded = (date, cam) in statdict
+            dictlock.release()
+            if not loaded:
+                nread += 1
+            (lock, table) = lock_datecam((date, cam), False)
+            try:
+                for (period, length) in ROLLUP_PERIODS.items():
+                    rows = rollups.setdefault(cam, {}).setdefault(period, {})
+                    for first in range(0, MINPERDAY, length):
+                        t = date if length == MINPERDAY \
+                                else date + " %02d:00" % (first/60)
+                        values = rollup_row(table, first, first + length)
+                        if values is None:
+                            rows.pop(t, None)
+                        else:
+                            rows[t] = values
+                    rollups_changed.add((period, cam))
+            finally:
+                lock.release()
+            # a table read only to be rolled up isn't kept
+            if not loaded:
+                drop_table((date, cam))
+        if rollups_building:
+            if rollups_pending:
+                return
+            logging.info("built the stats rollups")
+            rollups_building = False
+        for (period, cam) in rollups_changed:
+            _write_rollup(period, cam)
+        rollups_changed.clear()
+
+def expire_rollups(retain_date):
+    """Drop the rollup rows for dates before retain_date."""
+    with rollup_lock:
+        _load_rollups()
+        for (cam, periods) in rollups.items():
+            for (period, rows) in periods.items():
+                old = [t for t in rows if t[:10] < retain_date]
+                for t in old:
+                    del rows[t]
+                if old and rollups_building:
+                    rollups_changed.add((period, cam))
+                elif old:
+                    _write_rollup(period, cam)
+        for k in [k for k in list(rollups_pending) if k[0] < retain_date]:
+            rollups_pending.discard(k)
+
 # Flag to stop the stats loop for test purposes.
 # Only for manipulation by testing code; always set to False in this file
 #
@@ -382,6 +1167,7 @@ def stats_loop(cameras):
     while True:
         ts = time.time()
         time.sleep(60 - ts%60)
+        health.beat()
         minute_stats(time.time(), cameras)
         if terminate_stats_loop:
             return
@@ -0,0 +1,89 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Keep the disk from filling up before retain_days have been kept.
+#
+# The bytes used by each camera-day's hires and derivative images are kept
+# in the image index, added to as images are processed, so the governor
+# never has to walk the directories to find them.  When the filesystem
+# holding the root passes storage_high_water_pct full, the governor chooses
+# what to delete to bring it back down to storage_low_water_pct: first the
+# mediumres images of the oldest days, then the oldest days' hires images
+# (i.e., the whole day).  A stripped day keeps its thumbnails, so that its
+# index pages still show them.  Today is never chosen.  The purge thread does
+# the deleting.
+
+import os
+import logging
+
+# the last usage found by plan(): (free bytes, hires bytes, derivative
+# bytes), for the stats
+last_usage = None
+
+
+def disk_usage(path):
+    """Return a tuple of the total and free (for unprivileged users) bytes of
+    the filesystem holding path."""
+    st = os.statvfs(path)
+    return (st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize)
+
+
+def plan(index, root, today, high_pct, low_pct):
+    """Return a tuple of a list of the (day, cam) camera-days whose
+    mediumres images should be deleted, and a list of the days that
+    should be deleted, to bring the filesystem holding root down to low_pct
+    full if it's high_pct or more full.  Both lists are empty if it isn't,
+    or if high_pct is 0."""
+    global last_usage
+    usage = index.usage()
+    (total, free) = disk_usage(root)
+    last_usage = (free, sum([u[2] for u in usage]), sum([u[3] for u in usage]))
+    if high_pct <= 0 or total == 0:
+        return ([], [])
+    used = total - free
+    if used * 100 < high_pct * total:
+        return ([], [])
+    need = used - total * low_pct / 100
+    logging.warn("disk is %d%% full; freeing %d MB"
+                 % (used * 100 / total, need >> 20))
+
+    strip = []
+    for (day, cam, unused_hires, deriv, stripped) in usage:
+        if need <= 0 or day >= today:
+            break
+        if not stripped and deriv > 0:
+            strip.append((day, cam))
+            # the derivatives are mostly mediumres images.  Whatever the
+            # thumbnails keep is found on the next pass
+            need -= deriv
+    days = []
+    daybytes = {}
+    for (day, cam, hires, unused_deriv, unused_stripped) in usage:
+        daybytes[day] = daybytes.get(day, 0) + hires
+    for day in sorted(daybytes):
+        if need <= 0 or day >= today:
+            break
+        days.append(day)
+        need -= daybytes[day]
+    # no need to strip the days that are going
+    strip = [(day, cam) for (day, cam) in strip if day not in days]
+    return (strip, days)
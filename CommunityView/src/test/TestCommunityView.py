@@ -27,6 +27,7 @@ import localsettings
 # Set up the testing values for the global config vars
 #
 localsettings.root                  = testsettings.root
+localsettings.index_path            = testsettings.index_path
 localsettings.cameras               = testsettings.cameras
 
 import communityview
@@ -36,10 +37,13 @@ import logging
 import os
 import shutil
 import inspect
+import json
 import datetime
 import platform
+import signal
 import stats
-from utils import is_thread_prefix
+import controller
+from utils import is_thread_prefix, get_daydirs
 
 moduleUnderTest = communityview
 
@@ -108,8 +112,16 @@ def deleteTestFiles():
     if os.path.isdir(moduleUnderTest.root):
         shutil.rmtree(moduleUnderTest.root, False, None)
     os.mkdir(moduleUnderTest.root)
+    for f in (moduleUnderTest.index_path,
+              moduleUnderTest.index_path + "-journal"):
+        if os.path.exists(f):
+            os.remove(f)
 
 
+def killWorker(*args):
+    """Stands in for an image worker's job, killing the worker."""
+    os.kill(os.getpid(), signal.SIGKILL)
+
 def buildImages(rootPath, day, location, time, startingSeq, count):
     """Build the incoming directories and files to simulate the cameras
     or ftp_upload dropping files into the Web server.
@@ -307,6 +319,35 @@ class TestSurveilleance(unittest.TestCase):
         moduleUnderTest.processImage(indir, ifn, cam)
         assert not os.path.exists(ifp) and os.path.exists(hfp)
 
+    def test00ReducedScaleDecode(self):
+        cam = moduleUnderTest.cameras[0]
+        origquality = moduleUnderTest.resample_quality
+        try:
+            # SampleImage.jpg is 800x600, so a thumbnail only needs 1/4 scale
+            moduleUnderTest.resample_quality = "balanced"
+            (img, scale) = moduleUnderTest.open_image("SampleImage.jpg",
+                                    cam.croparea, moduleUnderTest.thumbsize)
+            assert scale == 4 and img.size == (200, 150), \
+                    "scale %d, size %s" % (scale, img.size)
+            
+            # absolute crop coordinates are remapped to the reduced scale
+            cropped = moduleUnderTest.crop_image(img, 
+                                            ("400", "300", "100%", "100%"),
+                                            scale)
+            assert cropped.size == (100, 75), "size %s" % (cropped.size,)
+            
+            # the mediumres image needs the full-scale decode
+            (img, scale) = moduleUnderTest.open_image("SampleImage.jpg",
+                                    cam.croparea, moduleUnderTest.mediumsize)
+            assert scale == 1 and img.size == (800, 600)
+            
+            moduleUnderTest.resample_quality = "best"
+            (img, scale) = moduleUnderTest.open_image("SampleImage.jpg",
+                                    cam.croparea, moduleUnderTest.thumbsize)
+            assert scale == 1 and img.size == (800, 600)
+        finally:
+            moduleUnderTest.resample_quality = origquality
+
     def test00NothingToDo(self):
         logging.info("========== %s" % inspect.stack()[0][3])
         SleepHook.setCallback(self.terminateTestRun)
@@ -394,6 +435,178 @@ class TestSurveilleance(unittest.TestCase):
         
         assert validateWebsite(tree)
 
+    def test05ImageIndex(self):
+        logging.info("========== %s" % inspect.stack()[0][3])
+        ForceDate.setForcedDate(datetime.date(2013,7,1))
+        buildImages(moduleUnderTest.root, "2013-06-30", "camera1", "11-00-00", 1, 10)
+        buildImages(moduleUnderTest.root, "2013-06-30", "camera2", "11-00-02", 1, 10)
+        
+        SleepHook.setCallback(self.terminateTestRun)
+        moduleUnderTest.main()
+        SleepHook.removeCallback()
+        
+        index = moduleUnderTest.get_image_index()
+        for cam in ("camera1", "camera2"):
+            assert index.incoming("2013-06-30", cam) == []
+            assert len(index.images("2013-06-30", cam)) == 10
+        
+        # a new image shows up as incoming, and the rebuilt index matches
+        # the filesystem
+        buildImages(moduleUnderTest.root, "2013-06-30", "camera1", "11-00-00", 11, 1)
+        index.rebuild(get_daydirs(), moduleUnderTest.cameras)
+        assert index.incoming("2013-06-30", "camera1") == ["11-00-00-00011.jpg"]
+        assert index.last_processed("2013-06-30", "camera1") \
+                == "11-00-00-00010.jpg"
+        assert len(index.images("2013-06-30", "camera2")) == 10
+
+    def test06ManifestPages(self):
+        logging.info("========== %s" % inspect.stack()[0][3])
+        ForceDate.setForcedDate(datetime.date(2013,7,1))
+        buildImages(moduleUnderTest.root, "2013-06-30", "camera1", "11-00-00", 1, 10)
+        
+        origpages = moduleUnderTest.image_pages
+        moduleUnderTest.image_pages = "manifest"
+        try:
+            SleepHook.setCallback(self.terminateTestRun)
+            moduleUnderTest.main()
+            SleepHook.removeCallback()
+        finally:
+            moduleUnderTest.image_pages = origpages
+        
+        camdir = os.path.join(moduleUnderTest.root, "2013-06-30", "camera1")
+        manifest = json.load(open(os.path.join(camdir, "manifest.json")))
+        filenames = [f for seq in manifest["sequences"] for (f, unused_secs) in seq]
+        assert filenames == sorted(os.listdir(os.path.join(camdir, "hires")))
+        assert len(filenames) == 10
+        assert manifest["sequences"][0][0][1] == 11*3600
+        assert os.listdir(os.path.join(camdir, "html")) == []
+        assert file_has_data(os.path.join(moduleUnderTest.root, "viewer.html"))
+        assert "../../viewer.html#2013-06-30/camera1/" \
+                in open(os.path.join(camdir, "index_hidden.html")).read()
+
+    def test07CatchUp(self):
+        logging.info("========== %s" % inspect.stack()[0][3])
+        ForceDate.setForcedDate(datetime.date(2013,7,1))
+        buildImages(moduleUnderTest.root, "2013-06-30", "camera1", "11-00-00", 1, 10)
+        tree = get_image_tree()
+
+        # in catch-up mode, only the thumbnails and index pages are made.
+        # Keep the stats thread from switching it off
+        origoff = controller.catchup_backlog_off
+        controller.catchup = True
+        controller.catchup_backlog_off = -1
+        try:
+            SleepHook.setCallback(self.terminateTestRun)
+            moduleUnderTest.main()
+            SleepHook.removeCallback()
+        finally:
+            controller.catchup = False
+            controller.catchup_backlog_off = origoff
+
+        camdir = os.path.join(moduleUnderTest.root, "2013-06-30", "camera1")
+        assert len(os.listdir(os.path.join(camdir, "thumbnails"))) == 10
+        assert os.listdir(os.path.join(camdir, "mediumres")) == []
+        assert os.listdir(os.path.join(camdir, "html")) == []
+        assert file_has_data(os.path.join(camdir, "index.html"))
+        index = moduleUnderTest.get_image_index()
+        assert index.is_deferred("2013-06-30", "camera1")
+
+        # once it's off, the work that was put off is done
+        moduleUnderTest.terminate_main_loop = False
+        SleepHook.setCallback(self.terminateTestRun)
+        moduleUnderTest.main()
+        SleepHook.removeCallback()
+
+        assert not index.is_deferred("2013-06-30", "camera1")
+        assert validateWebsite(tree)
+
+    def test08LostJob(self):
+        """An image job whose worker dies is logged and its image left to be
+        processed again, without an exception in the job's callback."""
+        logging.info("========== %s" % inspect.stack()[0][3])
+        buildImages(moduleUnderTest.root, "2013-06-30", "camera1", "11-00-00",
+                    1, 1)
+        cam = [c for c in moduleUnderTest.cameras
+               if c.shortname == "camera1"][0]
+        indir = os.path.join(moduleUnderTest.root, "2013-06-30", "camera1")
+        filename = "11-00-00-00001.jpg"
+        with open("communityview.log") as f:
+            f.seek(0, os.SEEK_END)
+            logstart = f.tell()
+        imagepool = moduleUnderTest.imagepool
+        origworker = moduleUnderTest.processImage_worker
+        origcheck = imagepool.check_sec
+        moduleUnderTest.processImage_worker = killWorker
+        imagepool.check_sec = 0.1
+        imagepool.pool = imagepool.ImagePool(1, 2)
+        try:
+            imagepool.wait([moduleUnderTest.submit_image(indir, filename,
+                                                         cam)])
+        finally:
+            imagepool.pool.pool.terminate()
+            imagepool.pool = None
+            imagepool.check_sec = origcheck
+            moduleUnderTest.processImage_worker = origworker
+        with open("communityview.log") as f:
+            f.seek(logstart)
+            log = f.read()
+        assert "image job failed" in log
+        assert "Unexpected exception in image job callback" not in log
+        assert os.path.exists(os.path.join(indir, filename))
+
+    def test09SequenceSignatures(self):
+        """A sequence's signature changes when an image in its middle is
+        replaced, and only the most recently made camera dirs' signatures
+        are kept."""
+        logging.info("========== %s" % inspect.stack()[0][3])
+        def sequences(filenames):
+            seqr = moduleUnderTest.sequencer.Sequencer(
+                                    datetime.date(2013, 6, 30), 60)
+            seqr.add([(f, i) for (i, f) in enumerate(filenames)])
+            return seqr
+        sig = moduleUnderTest.sequence_signature
+        before = sig(sequences(["a.jpg", "b.jpg", "c.jpg"]), 0)
+        assert sig(sequences(["a.jpg", "b.jpg", "c.jpg"]), 0) == before
+        assert sig(sequences(["a.jpg", "bb.jpg", "c.jpg"]), 0) != before
+
+        orig = moduleUnderTest.SIGNATURE_DIRS
+        moduleUnderTest.SIGNATURE_DIRS = 2
+        moduleUnderTest.sequence_signatures.clear()
+        try:
+            for cam in ("camera1", "camera2", "camera3"):
+                indir = os.path.join(moduleUnderTest.root, "2013-06-30", cam)
+                buildImages(moduleUnderTest.root, "2013-06-30", cam,
+                            "11-00-00", 1, 1)
+                moduleUnderTest.make_subdirs(indir)
+                moduleUnderTest.make_sequence_pages(indir,
+                        sequences(["11-00-00-00001.jpg"]), 0)
+            assert moduleUnderTest.sequence_signatures.keys() == \
+                    [os.path.join(moduleUnderTest.root, "2013-06-30", cam)
+                     for cam in ("camera2", "camera3")]
+        finally:
+            moduleUnderTest.SIGNATURE_DIRS = orig
+            moduleUnderTest.sequence_signatures.clear()
+
+    def test10StripKeepsThumbnails(self):
+        """Stripping a camera-day to free storage deletes its mediumres
+        images but keeps the thumbnails its index page shows."""
+        logging.info("========== %s" % inspect.stack()[0][3])
+        ForceDate.setForcedDate(datetime.date(2013,7,1))
+        buildImages(moduleUnderTest.root, "2013-06-30", "camera1", "11-00-00", 1, 10)
+        SleepHook.setCallback(self.terminateTestRun)
+        moduleUnderTest.main()
+        SleepHook.removeCallback()
+
+        camdir = os.path.join(moduleUnderTest.root, "2013-06-30", "camera1")
+        moduleUnderTest.purge_images([], [("2013-06-30", "camera1")])
+        assert len(os.listdir(os.path.join(camdir, "thumbnails"))) == 10
+        assert not os.path.exists(os.path.join(camdir, "mediumres"))
+        thumbbytes = moduleUnderTest.imageindex.dir_bytes(
+                                        os.path.join(camdir, "thumbnails"))
+        assert ("2013-06-30", "camera1", thumbbytes) in \
+                [u[:2] + (u[3],) for u in
+                 moduleUnderTest.get_image_index().usage() if u[4]]
+
     def terminateTestRun(self,seconds):
         if threading.currentThread().name == "MainThread":
             self.waitForThreads()   # wait for communityview to complete current tasks
@@ -414,6 +627,12 @@ class TestSurveilleance(unittest.TestCase):
         elif is_thread_prefix(threading.current_thread(), "Stats"):
             self.stats_thread = threading.current_thread()
             self.stats_run.wait()
+        # daemon threads, such as the image pool's housekeeping threads, and
+        # the purge thread, which sleeps to limit its rate of deletion, just
+        # sleep
+        elif threading.current_thread().daemon \
+                or is_thread_prefix(threading.current_thread(), "Purge"):
+            SleepHook.realSleep(seconds)
         else:
             # the only other sleep call is in processtoday().
             # If processtoday() is trying to sleep, it thinks it's done with
@@ -422,13 +641,15 @@ class TestSurveilleance(unittest.TestCase):
 
     def waitForThreads(self):
         """Wait for all threads to die that are not either threads
-        that were running when the test was started, or the stats thread."""
+        that were running when the test was started, the stats thread, or
+        daemon threads (such as the image pool's), which never die."""
         wait = True
         while wait:
             wait = False
             for thread in threading.enumerate():
                 if self.origThreadList.count(thread) == 0 \
-                        and not is_thread_prefix(thread, "Stats"):
+                        and not is_thread_prefix(thread, "Stats") \
+                        and not thread.daemon:
                     logging.info("waitForThreads: waiting for "+thread.name)
                     wait = True
                     thread.join()
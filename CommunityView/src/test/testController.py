@@ -0,0 +1,108 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import controller
+
+class TestController(unittest.TestCase):
+
+    def test000add_worker(self):
+        """A worker is added while images are waiting and the latency is
+        over the target or the number waiting isn't going down, up to the
+        number of worker processes."""
+        (workers, unused_poll, unused_reason) = controller.decide(
+                2, 4, 300, controller.target_proc_latency_min + 1, 100, None,
+                0.5, 50)
+        assert workers == 3
+        (workers, unused_poll, unused_reason) = controller.decide(
+                2, 4, 300, 0.1, 100, 100, 0.5, 50)
+        assert workers == 3
+        (workers, unused_poll, unused_reason) = controller.decide(
+                4, 4, 300, None, 100, 100, None, None)
+        assert workers == 4
+
+    def test010hold(self):
+        """The workers are left alone when images are being processed
+        promptly and the number waiting is going down, or none are
+        waiting."""
+        for (latency, backlog, prev_backlog) in ((0.1, 50, 100),
+                                                 (None, 0, 100)):
+            (workers, unused_poll, unused_reason) = controller.decide(
+                    2, 4, 300, latency, backlog, prev_backlog, 0.5, 50)
+            assert workers == 2
+
+    def test020back_off(self):
+        """The workers are cut back when the server is overloaded, but
+        never below the minimum."""
+        (workers, unused_poll, reason) = controller.decide(
+                4, 4, 300, 10, 100, None, controller.max_load_per_cpu + 1, 50)
+        assert workers == int(4 * controller.concurrency_backoff)
+        assert reason.startswith("load")
+        (workers, unused_poll, reason) = controller.decide(
+                1, 4, 300, 10, 100, None, 0.5,
+                controller.min_memory_available_pct - 1)
+        assert workers == controller.image_workers_min
+        assert reason.startswith("memory")
+
+    def test025cooldown(self):
+        """The workers are left alone while cooling down after a cut, even
+        if the server is still overloaded or images are waiting."""
+        for (latency, load) in ((10, controller.max_load_per_cpu + 1),
+                                (10, 0.5)):
+            (workers, unused_poll, reason) = controller.decide(
+                    2, 4, 300, latency, 100, None, load, 50, 3)
+            assert workers == 2
+            assert reason.startswith("cooling")
+
+    def test030poll(self):
+        """The time between passes is halved while images are waiting, and
+        lengthened while they're not, within the bounds."""
+        poll = controller.sleeptime_max
+        for unused_i in range(20):
+            (unused_workers, poll, unused_reason) = controller.decide(
+                    1, 1, poll, 1, 10, None, 0.5, 50)
+        assert poll == controller.sleeptime_min
+        (unused_workers, poll, unused_reason) = controller.decide(
+                1, 1, poll, 1, 0, 10, 0.5, 50)
+        assert poll == 2 * controller.sleeptime_min
+        for unused_i in range(20):
+            (unused_workers, poll, unused_reason) = controller.decide(
+                    1, 1, poll, 1, 0, 0, 0.5, 50)
+        assert poll == controller.sleeptime_max
+
+    def test040catchup(self):
+        """Catch-up mode goes on when the backlog reaches catchup_backlog,
+        and stays on until it's down to catchup_backlog_off."""
+        try:
+            controller.catchup = False
+            controller.update_catchup(controller.catchup_backlog - 1)
+            assert not controller.catchup
+            controller.update_catchup(controller.catchup_backlog)
+            assert controller.catchup
+            controller.update_catchup(controller.catchup_backlog_off + 1)
+            assert controller.catchup
+            controller.update_catchup(controller.catchup_backlog_off)
+            assert not controller.catchup
+        finally:
+            controller.catchup = False
+
+if __name__ == "__main__":
+    unittest.main()
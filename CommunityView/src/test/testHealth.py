@@ -0,0 +1,106 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import logging
+import threading
+import time
+import health
+
+class TestHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger("testHealth")
+        self.logger.propagate = False
+        self.handler = health.CountingHandler()
+        self.logger.addHandler(self.handler)
+        health.take_counts()    # discard anything logged before the test
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test000counts(self):
+        """Warnings and errors are counted by thread name prefix, and
+        records from other processes are added in."""
+        def log():
+            self.logger.error("error")
+            self.logger.warn("warning")
+            self.logger.info("not counted")
+        t = threading.Thread(target=log, name="Today-12")
+        t.start()
+        t.join()
+        self.logger.error("error")
+        health.add_records([("PoolWorker", True)])
+        (errors, warnings, by_thread) = health.take_counts()
+        assert (errors, warnings) == (3, 1)
+        assert by_thread == {"Today": [1, 1], "MainThread": [1, 0],
+                             "PoolWorker": [1, 0]}, by_thread
+        assert health.take_counts() == (0, 0, {})
+        assert health.totals[("Today", "warning")] >= 1
+
+    def test010heartbeats(self):
+        """A thread's heartbeat ages until the next beat, and is forgotten
+        when the thread is done."""
+        beaten = threading.Event()
+        finish = threading.Event()
+        def run():
+            health.beat()
+            beaten.set()
+            finish.wait()
+            health.done()
+        t = threading.Thread(target=run, name="Purge-3")
+        t.start()
+        beaten.wait()
+        age = health.heartbeat_age("Purge", time.time() + 30)
+        assert 29 <= age <= 31, age
+        finish.set()
+        t.join()
+        assert health.heartbeat_age("Purge") is None
+
+    def test020heartbeats_by_thread(self):
+        """Of several threads with the same name prefix, the oldest
+        heartbeat is reported, and it stays until that thread is done."""
+        finish = dict([(name, threading.Event())
+                       for name in ("PrevDays-5", "PrevDays-6")])
+        beaten = threading.Semaphore(0)
+        def run():
+            health.beat()
+            beaten.release()
+            finish[threading.current_thread().name].wait()
+            health.done()
+        threads = [threading.Thread(target=run, name=name)
+                   for name in sorted(finish)]
+        for t in threads:
+            t.start()
+            beaten.acquire()
+        health.heartbeats["PrevDays-5"] -= 100
+        age = health.heartbeat_age("PrevDays")
+        assert 99 <= age <= 101, age
+        finish["PrevDays-6"].set()
+        threads[1].join()
+        age = health.heartbeat_age("PrevDays")
+        assert 99 <= age <= 101, age
+        finish["PrevDays-5"].set()
+        threads[0].join()
+        assert health.heartbeat_age("PrevDays") is None
+
+if __name__ == "__main__":
+    unittest.main()
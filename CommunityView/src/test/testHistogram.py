@@ -0,0 +1,59 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+# 
+# This file is part of CommunityView.
+# 
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import histogram
+
+class TestHistogram(unittest.TestCase):
+
+    def test000buckets(self):
+        """Values fall in buckets whose representative value is within the
+        bucket's error bound, and the extremes go in the end buckets."""
+        assert histogram.bucket(0) == 0
+        assert histogram.bucket(1e9) == histogram.NBUCKETS - 1
+        for v in (0.02, 0.5, 1.0, 3.0, 60.0, 1000.0):
+            est = histogram.bucket_value(histogram.bucket(v))
+            assert abs(est - v) / v < 0.1, "%f estimated as %f" % (v, est)
+
+    def test010percentiles(self):
+        """Percentiles of a known distribution are estimated closely, and
+        merging histograms gives the same result as adding to one, with and
+        without NumPy."""
+        whole = histogram.new()
+        parts = [histogram.new(), histogram.new()]
+        for i in range(1, 1001):
+            histogram.add(whole, i / 100.0)     # 0.01 to 10 minutes
+            histogram.add(parts[i % 2], i / 100.0)
+        assert histogram.percentile(histogram.new(), 0.5) is None
+        for (q, expected) in ((0.5, 5.0), (0.95, 9.5), (0.99, 9.9)):
+            p = histogram.percentile(whole, q)
+            assert abs(p - expected) / expected < 0.1, "p%d: %f" % (q*100, p)
+        orig_numpy = histogram.numpy
+        try:
+            for np in (orig_numpy, None):
+                histogram.numpy = np
+                assert histogram.merge(parts) == whole
+                assert histogram.merge([]) == histogram.new()
+        finally:
+            histogram.numpy = orig_numpy
+
+if __name__ == "__main__":
+    unittest.main()
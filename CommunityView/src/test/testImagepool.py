@@ -0,0 +1,122 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+# 
+# This file is part of CommunityView.
+# 
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import os
+import signal
+import threading
+import time
+import memory
+import imagepool
+
+def square(x):
+    return x * x
+
+def nap(x):
+    time.sleep(0.2)
+    return x
+
+def die(mb):
+    memory.reserve(mb)
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def die_locked(mb):
+    memory.reserve(mb)
+    memory.budget._acquire()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def reserve(mb):
+    memory.reserve(mb)
+    memory.release(mb)
+    return mb
+
+class TestImagePool(unittest.TestCase):
+
+    def setUp(self):
+        self.save_check_sec = imagepool.check_sec
+        imagepool.check_sec = 0.1
+        memory.set_budget(100, 4)
+        imagepool.pool = imagepool.ImagePool(2, 4)
+        self.results = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        imagepool.pool.pool.terminate()
+        imagepool.pool = None
+        imagepool.check_sec = self.save_check_sec
+        memory.set_budget(0)
+
+    def done(self, result):
+        with self.lock:
+            self.results.append(result)
+
+    def test000jobs(self):
+        """Jobs are run in the workers and their callbacks get the
+        results."""
+        jobs = [imagepool.pool.submit(square, (i,), self.done)
+                for i in range(10)]
+        imagepool.wait(jobs)
+        assert sorted(self.results) == [i * i for i in range(10)]
+        assert imagepool.pool.in_flight() == 0
+        assert len(imagepool.pool.free_slots) == 4
+
+    def test010dead_worker(self):
+        """A job whose worker dies is failed, its queue slot and memory are
+        released, and later jobs are run by the worker that replaces it,
+        even with only one worker allowed to run jobs."""
+        imagepool.pool.set_active(1)
+        job = imagepool.pool.submit(die, (80,), self.done)
+        imagepool.wait([job])
+        assert self.results == [None]
+        assert memory.budget.used.value == 0
+        assert len(imagepool.pool.free_slots) == 4
+        jobs = [imagepool.pool.submit(square, (i,), self.done)
+                for i in range(10)]
+        imagepool.wait(jobs)
+        assert sorted(self.results[1:]) == [i * i for i in range(10)]
+        assert imagepool.pool.in_flight() == 0
+
+    def test011dead_worker_locked(self):
+        """A worker that dies holding the memory budget's lock doesn't keep
+        other workers from reserving memory."""
+        job = imagepool.pool.submit(die_locked, (80,), self.done)
+        imagepool.wait([job])
+        assert self.results == [None]
+        assert memory.budget.used.value == 0
+        job = imagepool.pool.submit(reserve, (80,), self.done)
+        imagepool.wait([job])
+        assert self.results == [None, 80]
+
+    def test020limit(self):
+        """No more jobs than the limit are handed to the workers at once,
+        and the rest are held until the limit is raised or jobs finish."""
+        imagepool.pool.set_active(1)
+        jobs = [imagepool.pool.submit(nap, (i,), self.done) for i in range(3)]
+        assert imagepool.pool.dispatched == 1
+        assert len(imagepool.pool.held) == 2
+        imagepool.pool.set_active(2)
+        assert imagepool.pool.dispatched == 2
+        imagepool.wait(jobs)
+        assert sorted(self.results) == range(3)
+        assert imagepool.pool.dispatched == 0
+
+if __name__ == "__main__":
+    unittest.main()
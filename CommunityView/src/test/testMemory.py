@@ -0,0 +1,70 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+# 
+# This file is part of CommunityView.
+# 
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import threading
+import time
+import os
+import memory
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def test000waits_for_budget(self):
+        """A reservation that doesn't fit waits until enough is released."""
+        budget = memory.MemoryBudget(100)
+        budget.reserve(60)
+        reserved = threading.Event()
+        def reserve():
+            budget.reserve(60)
+            reserved.set()
+        t = threading.Thread(target=reserve)
+        t.start()
+        time.sleep(0.2)
+        assert not reserved.is_set(), "reservation exceeded the budget"
+        budget.release(60)
+        t.join(5)
+        assert reserved.is_set()
+        assert budget.used.value == 60
+
+    def test010oversize(self):
+        """An image larger than the whole budget is allowed when nothing else
+        is reserved."""
+        budget = memory.MemoryBudget(100)
+        budget.reserve(150)
+        assert budget.used.value == 150
+        budget.release(150)
+        assert budget.used.value == 0
+
+    def test020release_worker(self):
+        """What a dead worker had reserved is released, along with the
+        budget's lock if the worker held it."""
+        budget = memory.MemoryBudget(100, 2)
+        budget.reserve(60)
+        budget.release_worker(os.getpid())
+        assert budget.used.value == 0
+        budget.lock.acquire()
+        budget.owner.value = 99999
+        budget.release_worker(99999)
+        assert budget.lock.acquire(False)
+        budget.lock.release()
+
+if __name__ == "__main__":
+    unittest.main()
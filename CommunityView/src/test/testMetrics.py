@@ -0,0 +1,85 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import testsettings
+import localsettings
+
+localsettings.root = testsettings.root
+
+import stats
+import metrics
+import threading
+import time
+import urllib2
+
+class TestMetrics(unittest.TestCase):
+
+    day = "2014-09-01"
+    now = time.mktime((2014, 9, 1, 1, 0, 0, 0, 0, -1))   # minute 60
+
+    def setUp(self):
+        # today's tables, put directly into memory
+        cam = stats.StatTable(stats.LENDCROW)
+        cam[50][stats.NUNPROC] = 7
+        cam[50][stats.NUNPROCPREV] = 2
+        cam.add_latencies(stats.UPLAT, 50, {0: 3, 10: 1})
+        server = stats.StatTable(stats.LENPSROW)
+        server[50][stats.NPROC] = 4
+        server[51][stats.NPROC] = 5
+        for (k, table) in (((self.day, "cam1"), cam), ((self.day, ""), server)):
+            stats.statdict[k] = [threading.RLock(), table, False, self.now,
+                                 False]
+        metrics.threads["stats"] = threading.current_thread()
+
+    def tearDown(self):
+        for k in ((self.day, "cam1"), (self.day, "")):
+            del stats.statdict[k]
+        del metrics.threads["stats"]
+
+    def test000render(self):
+        """The metrics are read from the tables in memory."""
+        lines = metrics.render(self.now).splitlines()
+        for expected in (
+                "communityview_images_processed_today 9",
+                'communityview_unprocessed_images{camera="cam1",day="today"} 7',
+                'communityview_unprocessed_images{camera="cam1",'
+                    'day="previous"} 2',
+                'communityview_upload_latency_seconds_bucket{le="1.0"} 3',
+                'communityview_upload_latency_seconds_bucket{le="+Inf"} 4',
+                "communityview_upload_latency_seconds_count 4",
+                "communityview_processing_latency_seconds_count 0",
+                'communityview_thread_alive{thread="stats"} 1',
+                "# TYPE communityview_stats_tables_cached gauge"):
+            assert expected in lines, "missing: " + expected
+
+    def test010serve(self):
+        """The metrics are served over HTTP."""
+        server = metrics.start("127.0.0.1", 0)
+        try:
+            url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+            body = urllib2.urlopen(url, timeout=10).read()
+            assert "communityview_stats_tables_cached" in body
+        finally:
+            metrics.stop()
+
+if __name__ == "__main__":
+    unittest.main()
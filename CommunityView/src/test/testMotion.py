@@ -0,0 +1,71 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+# 
+# This file is part of CommunityView.
+# 
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import motion
+import Image
+import ImageDraw
+
+@unittest.skipIf(motion.numpy is None, "NumPy is not installed")
+class TestMotion(unittest.TestCase):
+
+    def make_images(self):
+        """Return a master image and a copy of it with two changed regions
+        and one changed pixel."""
+        master = Image.new("RGB", (128, 96), (40, 40, 40))
+        img = master.copy()
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((10, 10, 29, 19), fill=(200, 200, 200))
+        draw.rectangle((80, 50, 89, 59), fill=(200, 200, 200))
+        img.putpixel((120, 90), (255, 255, 255))
+        return (master, img)
+
+    def test000regions(self):
+        """Each changed region gets its own box, largest first, and isolated
+        noise pixels are ignored."""
+        (master, img) = self.make_images()
+        (boxes, area) = motion.find_motion(master, img, 32, 6, 4)
+        assert boxes == [(10, 10, 29, 19), (80, 50, 89, 59)], boxes
+        assert area == (20*10 + 10*10) / (128.0*96), area
+
+    def test010max_boxes(self):
+        (master, img) = self.make_images()
+        (boxes, unused_area) = motion.find_motion(master, img, 32, 6, 1)
+        assert boxes == [(10, 10, 29, 19)], boxes
+
+    def test020no_change(self):
+        (master, unused_img) = self.make_images()
+        assert motion.find_motion(master, master.copy(), 32, 6, 4) == ([], 0.0)
+
+    def test030connected(self):
+        """A winding region is found as a single region."""
+        master = Image.new("L", (64, 64), 0)
+        img = master.copy()
+        draw = ImageDraw.Draw(img)
+        for y in range(4, 60, 8):
+            draw.rectangle((4, y, 59, y+3), fill=255)
+            x = 56 if (y/8) % 2 == 0 else 4
+            draw.rectangle((x, y, x+3, y+11), fill=255)
+        (boxes, unused_area) = motion.find_motion(master, img, 32, 6, 4)
+        assert len(boxes) == 1, boxes
+
+if __name__ == "__main__":
+    unittest.main()
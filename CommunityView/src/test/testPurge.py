@@ -0,0 +1,106 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+import purge
+
+class TestPurge(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.daydir = os.path.join(self.root, "2014-06-01")
+        for sub in ("cam1/hires", "cam1/thumbnails", "cam2/hires"):
+            os.makedirs(os.path.join(self.daydir, sub))
+            for i in range(10):
+                open(os.path.join(self.daydir, sub, "%d.jpg" % i), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, True)
+
+    def test000trash(self):
+        """A trashed day is out of the root at once, and emptying the trash
+        deletes it at no more than the limit of unlinks per second."""
+        purge.trash(self.daydir, self.root)
+        assert os.listdir(self.root) == [purge.trashname]
+        started = time.time()
+        purge.empty_trash(self.root, 100)
+        assert time.time() - started >= 0.25    # 30 files at 100/sec
+        assert os.listdir(self.root) == []
+
+    def test005trash_denied(self):
+        """The web server is denied access to the trash, and the heartbeat
+        is beaten while the trash is emptied with no limit."""
+        purge.trash(self.daydir, self.root)
+        with open(os.path.join(purge.trash_path(self.root), ".htaccess")) as f:
+            assert "denied" in f.read()
+        beats = []
+        orig_beat = purge.health.beat
+        try:
+            purge.health.beat = lambda: beats.append(1)
+            for i in range(300):
+                open(os.path.join(purge.trash_path(self.root),
+                                  "%d.jpg" % i), "w").close()
+            purge.empty_trash(self.root, 0)
+        finally:
+            purge.health.beat = orig_beat
+        assert len(beats) >= 3
+        assert os.listdir(self.root) == []
+
+    def test010no_scandir(self):
+        """Without scandir, the trash is emptied by listing directories."""
+        orig_scandir = purge._scandir
+        try:
+            purge._scandir = None
+            purge.trash(self.daydir, self.root)
+            purge.empty_trash(self.root, 0)
+            assert os.listdir(self.root) == []
+        finally:
+            purge._scandir = orig_scandir
+
+    def test015trash_subdir(self):
+        """A day's derivative dir can be trashed on its own, and trashing
+        another with the same path doesn't collide with the first."""
+        thumbs = os.path.join(self.daydir, "cam1", "thumbnails")
+        purge.trash(thumbs, self.root)
+        os.mkdir(thumbs)
+        purge.trash(thumbs, self.root)
+        assert sorted(os.listdir(purge.trash_path(self.root))) \
+                == [".htaccess", "2014-06-01_cam1_thumbnails",
+                    "2014-06-01_cam1_thumbnails.1"]
+        assert os.listdir(os.path.join(self.daydir, "cam1")) == ["hires"]
+
+    def test020idle_io_priority(self):
+        """Setting idle I/O priority either works or is quietly skipped."""
+        result = []
+        # in a thread of its own, so that the rest of the tests aren't idled
+        t = threading.Thread(
+                target=lambda: result.append(purge.set_idle_io_priority()))
+        t.start()
+        t.join()
+        assert result[0] in (True, False)
+
+if __name__ == "__main__":
+    unittest.main()
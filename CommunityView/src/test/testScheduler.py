@@ -0,0 +1,112 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import datetime
+import threading
+import scheduler
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.work = scheduler.Scheduler()
+
+    def test000priority_order(self):
+        """Today's camera-days come first, then the previous days newest
+        first, and equal priorities in the order queued."""
+        for day in ("2014-06-01", "2014-06-03", "2014-06-02"):
+            self.work.put((day, "cam1"), scheduler.day_priority(
+                    datetime.date(*[int(x) for x in day.split("-")])))
+        self.work.put(("2014-06-04", "cam2"), scheduler.TODAY)
+        self.work.put(("2014-06-04", "cam1"), scheduler.TODAY)
+        assert len(self.work) == 5
+        order = []
+        while True:
+            item = self.work.claim()
+            if item is None:
+                break
+            order.append(item)
+        assert order == [("2014-06-04", "cam2"), ("2014-06-04", "cam1"),
+                         ("2014-06-03", "cam1"), ("2014-06-02", "cam1"),
+                         ("2014-06-01", "cam1")]
+
+    def test010max_priority(self):
+        """A claim can be limited to the items of a given priority or
+        higher, and a queued item can be raised to a higher priority."""
+        prev = scheduler.day_priority(datetime.date(2014, 6, 3))
+        self.work.put("a", prev)
+        assert self.work.claim(scheduler.TODAY) is None
+        self.work.put("a", scheduler.TODAY)
+        assert self.work.claim(scheduler.TODAY) == "a"
+        self.work.release("a")
+        assert self.work.claim() is None     # the lower entry is stale
+
+    def test020claims(self):
+        """A claimed item isn't handed out again, and an item queued while
+        claimed is queued again when the claim is released."""
+        self.work.put("a", scheduler.TODAY)
+        assert self.work.claim() == "a"
+        assert self.work.is_claimed("a")
+        self.work.put("a", scheduler.TODAY)
+        assert self.work.claim() is None
+        self.work.release("a")
+        assert not self.work.is_claimed("a")
+        assert self.work.claim() == "a"
+        self.work.release("a")
+        assert self.work.claim() is None
+
+    def test030round_robin(self):
+        """An unfinished camera-day goes to the back of its priority, and
+        the deficit carries what a camera was allowed but didn't use."""
+        self.work.put("noisy", scheduler.TODAY)
+        self.work.put("quiet", scheduler.TODAY)
+        assert self.work.claim() == "noisy"
+        assert self.work.allowance("noisy", 100) == 100
+        self.work.charge("noisy", 90, True)
+        self.work.release("noisy", True)
+        assert self.work.claim() == "quiet"
+        self.work.release("quiet")
+        assert self.work.claim() == "noisy"
+        assert self.work.allowance("noisy", 100) == 110
+        self.work.charge("noisy", 5, False)
+        self.work.release("noisy")
+        assert self.work.claim() is None
+        assert self.work.allowance("noisy", 100) == 100
+
+    def test040camera_slots(self):
+        """A camera with as many images queued as it's allowed waits for one
+        of them to be done."""
+        slots = scheduler.CameraSlots()
+        slots.acquire("cam1", 2)
+        slots.acquire("cam1", 2)
+        slots.acquire("cam2", 2)
+        acquired = threading.Event()
+        t = threading.Thread(target=lambda: (slots.acquire("cam1", 2),
+                                             acquired.set()))
+        t.start()
+        assert not acquired.wait(0.2)
+        slots.release("cam1")
+        t.join()
+        assert acquired.is_set()
+        assert slots.count("cam1") == 2 and slots.count("cam2") == 1
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+# 
+# This file is part of CommunityView.
+# 
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import datetime
+import sequencer
+
+class FakeIndex:
+    """Stands in for imageindex.ImageIndex, holding one camera-day."""
+
+    def __init__(self):
+        self.rows = []      # (rowid, filename, secs)
+        self.generation = 0
+
+    def add(self, *times):
+        for t in times:
+            (h, m, s) = t
+            self.rows.append((self.last_rowid() + 1, "%02d%02d%02d.jpg" % t,
+                              h*3600 + m*60 + s))
+
+    def remove(self, filename):
+        self.rows = [r for r in self.rows if r[1] != filename]
+        self.generation += 1
+
+    def images(self, day, cam, after=None):
+        return sorted([r[1:] for r in self.rows if r[1] > (after or "")])
+
+    def last_rowid(self):
+        return max([r[0] for r in self.rows] or [0])
+
+    def images_since(self, day, cam, rowid):
+        return sorted([r[1:] for r in self.rows if r[0] > rowid])
+
+class TestSequencer(unittest.TestCase):
+
+    day = datetime.date(2018, 3, 4)
+
+    def setUp(self):
+        sequencer.sequencers.clear()
+        self.numpy = sequencer.numpy
+
+    def tearDown(self):
+        sequencer.numpy = self.numpy
+        sequencer.sequencers.clear()
+
+    def filenames(self, seqr):
+        return [[f for (f, unused_ts) in seq] for seq in seqr]
+
+    def test000sequences(self):
+        index = FakeIndex()
+        index.add((0, 0, 1), (0, 0, 3), (0, 0, 6), (1, 0, 0), (1, 0, 2))
+        seqr = sequencer.get_sequencer(self.day, "cam", 3, index)
+        assert self.filenames(seqr) == [["000001.jpg", "000003.jpg"],
+                                         ["000006.jpg"],
+                                         ["010000.jpg", "010002.jpg"]]
+        assert seqr[2][-1] == ("010002.jpg",
+                               datetime.datetime(2018, 3, 4, 1, 0, 2))
+        assert seqr.sequence_of("000006.jpg") == 1
+        assert seqr.sequence_of("000007.jpg") is None
+
+    def test010without_numpy(self):
+        sequencer.numpy = None
+        self.test000sequences()
+
+    def test020incremental(self):
+        """New images extend the open sequence or start new ones without the
+        camera-day being sequenced again."""
+        index = FakeIndex()
+        index.add((9, 0, 0), (9, 0, 1))
+        seqr = sequencer.get_sequencer(self.day, "cam", 3, index)
+        index.add((9, 0, 3), (9, 0, 10))
+        assert sequencer.get_sequencer(self.day, "cam", 3, index) is seqr
+        assert self.filenames(seqr) == [["090000.jpg", "090001.jpg",
+                                          "090003.jpg"], ["090010.jpg"]]
+
+    def test030out_of_order(self):
+        """An image that sorts before the last one sequenced causes the
+        camera-day to be sequenced again."""
+        index = FakeIndex()
+        index.add((9, 0, 0), (9, 0, 10))
+        seqr = sequencer.get_sequencer(self.day, "cam", 3, index)
+        index.add((9, 0, 8))
+        seqr2 = sequencer.get_sequencer(self.day, "cam", 3, index)
+        assert seqr2 is not seqr
+        assert self.filenames(seqr2) == [["090000.jpg"],
+                                          ["090008.jpg", "090010.jpg"]]
+
+    def test040gap(self):
+        index = FakeIndex()
+        index.add((9, 0, 0), (9, 0, 5))
+        seqr = sequencer.get_sequencer(self.day, "cam", 10, index)
+        assert len(seqr) == 1
+        seqr = sequencer.get_sequencer(self.day, "cam", 5, index)
+        assert len(seqr) == 2
+
+    def test050removed(self):
+        """An image removed from the index causes the camera-day to be
+        sequenced again."""
+        index = FakeIndex()
+        index.add((9, 0, 0), (9, 0, 1), (9, 0, 10))
+        seqr = sequencer.get_sequencer(self.day, "cam", 3, index)
+        index.remove("090001.jpg")
+        seqr2 = sequencer.get_sequencer(self.day, "cam", 3, index)
+        assert seqr2 is not seqr
+        assert self.filenames(seqr2) == [["090000.jpg"], ["090010.jpg"]]
+
+    def test060cache(self):
+        """Only the most recently used camera-days' Sequencers are kept."""
+        orig = sequencer.sequencer_cache_camdays
+        sequencer.sequencer_cache_camdays = 2
+        try:
+            index = FakeIndex()
+            index.add((9, 0, 0))
+            for cam in ("cam1", "cam2", "cam1", "cam3"):
+                sequencer.get_sequencer(self.day, cam, 3, index)
+            assert sequencer.sequencers.keys() == \
+                    [("2018-03-04", "cam1"), ("2018-03-04", "cam3")]
+        finally:
+            sequencer.sequencer_cache_camdays = orig
+
+if __name__ == "__main__":
+    unittest.main()
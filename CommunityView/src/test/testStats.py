@@ -31,6 +31,10 @@ import datetime
 import time
 from testutils import filename_to_time, dirname_to_datetime
 import shutil
+import csv
+import platform
+import threading
+import array
 
 class MockTime():
     """Monkey patch time.time() to return a timestamp set by set_time()."""
@@ -171,6 +175,30 @@ class TestStats(unittest.TestCase):
         assert now_table[now_row][stats.NPROC] == nfiles*2, "%d, %d" \
                 % (now_table[now_row][stats.NPROC], nfiles*2)
         
+    def test005record_proc(self):
+        """Queued records are only tallied when the queue is flushed, and
+        then match the tallies made by proc_stats()."""
+        date_dt = dirname_to_datetime("2014-08-01")
+        dp = os.path.join(stats.root, "2014-08-01", "cam1")
+        if not os.path.isdir(dp):
+            os.makedirs(dp)
+        for i in range(3):
+            fn = "00-02-00-%05d.jpg" % (i+1)
+            mtime = time.mktime((date_dt + filename_to_time(fn)).timetuple()) \
+                    + 2*60 + i*60
+            stats.record_proc(os.path.join(dp, fn), mtime, mtime + 3*60)
+        assert ("2014-08-01", "cam1") not in stats.statdict
+        stats.flush_proc_queue()
+        assert len(stats.proc_queue) == 0
+        table = stats.statdict[("2014-08-01", "cam1")][stats.TABLE]
+        assert table[2][stats.NCREATE] == 3
+        assert table[2][stats.AVGUPLAT] == 3.0
+        assert [table[m][stats.NUPLOAD] for m in (4, 5, 6)] == [1, 1, 1]
+        assert table[5][stats.AVGPROCLAT] == 3.0
+        assert table[1][stats.NCREATE] == 0     # zeroed back
+        table = stats.statdict[("2014-08-01", "")][stats.TABLE]
+        assert sum([table[m][stats.NPROC] or 0 for m in (7, 8, 9)]) == 3
+
     def test010writereadstatsfile(self):
         # DEPENDS ON RUNNING PREVIOUS TEST 
         # to set up the datecam stats tables in memory
@@ -236,6 +264,91 @@ class TestStats(unittest.TestCase):
                 "Wrong per-server count of unprocessed files: " \
                 "today: %d, prev: %d. Should have been %d, %d." % \
                 (trow[stats.NUNPROC], trow[stats.NUNPROCPREV], 3*2, 9*2)
+        if platform.system() == "Linux":
+            assert trow[stats.PEAKRSS] > 0, "No peak RSS recorded"
+
+    def test025read_old_format(self):
+        """A per-server stats file written before the Peak RSS column was
+        added is read with the missing values set to None."""
+        fp = os.path.join(stats.statspath, "2014-07-03_.csv")
+        with open(fp, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(stats.DCCSVHEADERS[:8] + ("Restarted", "Errors"))
+            for m in range(stats.MINPERDAY):
+                writer.writerow(["2014-07-03 %02d:%02d" % (m/60, m%60)]
+                                + [""] * 7 + ["1" if m == 5 else "", ""])
+        (lock, table) = stats.lock_datecam(("2014-07-03", ""), False)
+        lock.release()
+        assert len(table[5]) == stats.LENPSROW
+        assert table[5][stats.RESTARTED] == 1
+        assert table[5][stats.PEAKRSS] is None
+        assert table[5][stats.UPLATP50] is None
+
+    def test026latency_percentiles(self):
+        """The latency percentile columns are derived from the minute's
+        histogram, which is saved with the CSV file and reloaded."""
+        dp = os.path.join(stats.root, "2014-08-02", "cam1")
+        recs = []
+        for i in range(100):
+            fn = "00-02-00-%05d.jpg" % (i+1)
+            ctime = time.mktime((dirname_to_datetime("2014-08-02")
+                                 + filename_to_time(fn)).timetuple())
+            # upload latencies of 0.01 to 1.0 minute
+            recs.append(stats.proc_record(os.path.join(dp, fn),
+                                          ctime + (i+1)*0.6, ctime + 180))
+        stats.tally_records(recs)
+        datecam = ("2014-08-02", "cam1")
+        table = stats.statdict[datecam][stats.TABLE]
+        for (col, expected) in ((stats.UPLATP50, 0.5), (stats.UPLATP95, 0.95),
+                                (stats.UPLATP99, 0.99)):
+            assert abs(table[2][col] - expected) / expected < 0.1, \
+                    "column %d: %s" % (col, table[2][col])
+        hist = table.merged_histogram(stats.UPLAT, range(60))
+        assert sum(hist) == 100
+        ps = stats.statdict[("2014-08-02", "")][stats.TABLE]
+        assert ps[2][stats.UPLATP50] == table[2][stats.UPLATP50]
+
+        stats.write_dctable(datecam)
+        del stats.statdict[datecam]
+        (lock, table) = stats.lock_datecam(datecam, False)
+        lock.release()
+        assert table.hists[(stats.UPLAT, 2)] == hist
+        assert table[2][stats.UPLATP50] is not None
+
+    def test027stat_table(self):
+        """StatTable rows read and write like lists, zeroback() fills the gap
+        back to the previous value, and the column reductions skip the
+        empty cells, with and without NumPy."""
+        orig_numpy = stats.numpy
+        try:
+            for np in (orig_numpy, None):
+                stats.numpy = np
+                table = stats.StatTable(stats.LENDCROW)
+                assert table[0][stats.NCREATE] is None
+                table[3][stats.NCREATE] = 2
+                table[10][stats.NCREATE] = 5
+                table[10][stats.AVGUPLAT] = 1.5
+                stats.zeroback(table, 10, stats.NCREATE)
+                assert [table[m][stats.NCREATE] for m in range(11)] \
+                        == [None]*3 + [2] + [0]*6 + [5]
+                # later calls only look at the rows since the last one,
+                # unless the row is before them
+                table[6][stats.NCREATE] = None
+                table[14][stats.NCREATE] = 1
+                stats.zeroback(table, 14, stats.NCREATE)
+                assert [table[m][stats.NCREATE] for m in range(6, 15)] \
+                        == [None] + [0]*3 + [5] + [0]*3 + [1]
+                table[2][stats.NCREATE] = 1
+                stats.zeroback(table, 2, stats.NCREATE)
+                assert [table[m][stats.NCREATE] for m in range(3)] \
+                        == [0, 0, 1]
+                table[6][stats.NCREATE] = 0
+                assert table[10] == [5, 1.5] + [None]*(stats.LENDCROW - 2)
+                assert table.column_sum(stats.NCREATE) == 9
+                assert table.column_max(stats.AVGUPLAT) == 1.5
+                assert table.column_max(stats.NPROC) is None
+        finally:
+            stats.numpy = orig_numpy
 
     def test030expire_stats(self):
         """Test to see that expire_stats deletes the correct files."""
@@ -301,6 +414,205 @@ class TestStats(unittest.TestCase):
             self.fail("Fails more-files-allowed-than-extant test")
 
 
+    def test040evict_stats(self):
+        """Tables not for today that haven't been used recently are written
+        out if changed and dropped from memory; today's and recently used
+        tables are kept."""
+        stats.statdict.clear()
+        now = time.mktime(datetime.datetime(2014, 9, 2, 12, 0).timetuple())
+        for datecam in (("2014-09-01", "cam1"), ("2014-09-02", "cam1")):
+            (lock, table) = stats.lock_datecam(datecam)
+            table[0][stats.NPROC] = 1
+            lock.release()
+            stats.statdict[datecam][stats.TOUCHED] = now - 3600
+        # recently used
+        (lock, table) = stats.lock_datecam(("2014-08-31", "cam1"), False)
+        lock.release()
+        stats.statdict[("2014-08-31", "cam1")][stats.TOUCHED] = now - 60
+        counts = dict(stats.cache_counts)
+        stats.evict_stats(now, "2014-09-02")
+        assert sorted(stats.statdict.keys()) \
+                == [("2014-08-31", "cam1"), ("2014-09-02", "cam1")]
+        assert stats.cache_counts["evictions"] == counts["evictions"] + 1
+        assert stats.cache_counts["flushes"] == counts["flushes"] + 1
+        assert os.path.isfile(os.path.join(stats.statspath,
+                                           "2014-09-01_cam1.csv"))
+        # an evicted table is loaded again from its file
+        (lock, table) = stats.lock_datecam(("2014-09-01", "cam1"))
+        lock.release()
+        assert table[0][stats.NPROC] == 1
+        assert stats.cache_counts["loads"] == counts["loads"] + 1
+
+    def test050journal(self):
+        """Changes are appended to the table's journal, replayed when the
+        table is loaded again, and folded into the CSV file when it's
+        written."""
+        stats.statdict.clear()
+        datecam = ("2014-09-05", "cam1")
+        (lock, table) = stats.lock_datecam(datecam)
+        table[10][stats.NPROC] = 3
+        table[10][stats.AVGUPLAT] = 0.5
+        lock.release()
+        stats.write_journal(datecam)
+        (lock, table) = stats.lock_datecam(datecam)
+        table[11][stats.NPROC] = 4
+        lock.release()
+        stats.write_journal(datecam)
+        jp = stats.journal_path(datecam)
+        recsize = 4 + 8*stats.LENDCROW
+        assert os.path.getsize(jp) == \
+                len(stats._layout_record(False)) + 2*recsize
+        csvpath = os.path.join(stats.statspath, stats.datecam_to_fn(datecam))
+        assert not os.path.exists(csvpath)
+
+        # a partial record from a crash is ignored
+        with open(jp, "ab") as f:
+            f.write("\0" * (recsize - 1))
+        del stats.statdict[datecam]
+        (lock, table) = stats.lock_datecam(datecam, False)
+        lock.release()
+        assert table[10][stats.NPROC] == 3 and table[11][stats.NPROC] == 4
+        assert table[10][stats.AVGUPLAT] == 0.5
+        assert table[10][stats.NCREATE] is None
+        assert stats.statdict[datecam][stats.STALE]
+
+        stats.write_dctable(datecam)
+        assert os.path.isfile(csvpath) and not os.path.exists(jp)
+        del stats.statdict[datecam]
+        (lock, table) = stats.lock_datecam(datecam, False)
+        lock.release()
+        assert table[11][stats.NPROC] == 4
+        assert not stats.statdict[datecam][stats.STALE]
+
+    def test051journal_layout(self):
+        """A journal written before the table's columns were changed is
+        replayed by column header."""
+        stats.statdict.clear()
+        datecam = ("2014-09-06", "")
+        # an older layout, with a column since dropped and without the
+        # columns added after Restarted
+        headers = list(stats.PSCSVHEADERS[1:stats.RESTARTED+2]) + ["Gone"]
+        text = "\n".join(headers)
+        values = [float("nan")] * len(headers)
+        values[stats.NPROC] = 5
+        values[stats.RESTARTED] = 1
+        values[-1] = 9
+        with open(stats.journal_path(datecam), "wb") as f:
+            f.write(stats._jhead.pack(stats._jlayout, len(text)) + text)
+            f.write(stats._jhead.pack(20, len(values))
+                    + array.array("d", values).tostring())
+        (lock, table) = stats.lock_datecam(datecam, False)
+        lock.release()
+        assert table[20][stats.NPROC] == 5
+        assert table[20][stats.RESTARTED] == 1
+        assert table[20][stats.NCREATE] is None
+        assert table[20][stats.PEAKRSS] is None
+
+        # a journal without the layout record is ignored and removed
+        del stats.statdict[datecam]
+        with open(stats.journal_path(datecam), "wb") as f:
+            f.write(stats._jhead.pack(20, len(values))
+                    + array.array("d", values).tostring())
+        (lock, table) = stats.lock_datecam(datecam, False)
+        lock.release()
+        assert table[20][stats.NPROC] is None
+        assert not os.path.exists(stats.journal_path(datecam))
+        assert not stats.statdict[datecam][stats.STALE]
+
+    def test060unprocessed_counters(self):
+        """Between reconciliations, minute_stats() reports the live counts of
+        unprocessed images rather than listing the directories."""
+        cam = testsettings.cameras[0].shortname
+        test_now = time.mktime(datetime.datetime(2014, 7, 1, 0, 10, 0) \
+                               .timetuple())
+        stats.minute_stats(test_now, testsettings.cameras)    # reconciles
+        stats.forget_unprocessed("2014-06-29")
+        stats.set_unprocessed("2014-07-01", cam, 5)
+        stats.set_unprocessed("2014-06-30", cam, 2)
+        stats.count_arrival("2014-07-01", cam)
+        stats.count_processed("2014-06-30", cam)
+        stats.minute_stats(test_now + 60, testsettings.cameras)
+        trow = stats.statdict[("2014-07-01", cam)][stats.TABLE][11]
+        assert trow[stats.NUNPROC] == 6 and trow[stats.NUNPROCPREV] == 1, trow
+
+        # a reconciliation recounts the directories
+        stats.minute_stats(test_now + stats.stats_reconcile_minutes*60,
+                           testsettings.cameras)
+        trow = stats.statdict[("2014-07-01", cam)][stats.TABLE][10 +
+                                                stats.stats_reconcile_minutes]
+        counts = [len(os.listdir(os.path.join(stats.root, d, cam)))
+                  if os.path.isdir(os.path.join(stats.root, d, cam)) else 0
+                  for d in ("2014-07-01", "2014-06-30", "2014-06-29")]
+        assert trow[stats.NUNPROC] == counts[0], trow
+        assert trow[stats.NUNPROCPREV] == counts[1] + counts[2], trow
+
+    def test070rollups(self):
+        """The hourly and daily rollups sum the counts, weight the averages
+        by their counts and take the peak unprocessed images, and rows
+        before the retention date are expired."""
+        datecam = ("2014-09-02", "cam1")
+        table = stats.StatTable(stats.LENDCROW)
+        table[60][stats.NCREATE] = 2
+        table[60][stats.AVGUPLAT] = 1.0
+        table[60][stats.NUNPROC] = 5
+        table[61][stats.NCREATE] = 1
+        table[61][stats.AVGUPLAT] = 4.0
+        table[61][stats.NUNPROC] = 3
+        table[150][stats.NCREATE] = 4
+        stats.statdict[datecam] = [threading.RLock(), table, False,
+                                   time.time(), False]
+        stats.rollups_pending.add(datecam)
+        stats.update_rollups()
+
+        def read(period):
+            with open(stats.rollup_path(period, "cam1"), "rb") as f:
+                rows = list(csv.reader(f))
+            assert tuple(rows[0]) == stats.DCCSVHEADERS
+            return dict([(r[0], r[1:]) for r in rows[1:]])
+        hourly = read("hourly")
+        assert hourly["2014-09-02 01:00"][:stats.NUNPROC+1] \
+                == ["3", "2.0", "", "", "", "5"]
+        assert hourly["2014-09-02 02:00"][stats.NCREATE] == "4"
+        assert "2014-09-02 03:00" not in hourly
+        assert read("daily")["2014-09-02"][:stats.NUNPROC+1] \
+                == ["7", "2.0", "", "", "", "5"]
+
+        stats.expire_rollups("2014-09-03")
+        assert "2014-09-02" not in read("daily")
+        assert "2014-09-02 01:00" not in read("hourly")
+        del stats.statdict[datecam]
+
+    def test075rollup_build(self):
+        """Without rollup files, the rollups are built from the stats files
+        a few tables at a time, without keeping the tables in memory, and
+        written when they're all done."""
+        dates = ["2014-09-0%d" % d for d in range(1, 6)]
+        for date in dates:
+            table = stats.StatTable(stats.LENDCROW)
+            table[60][stats.NCREATE] = 1
+            stats.statdict[(date, "cam1")] = [threading.RLock(), table, False,
+                                              time.time(), False]
+            stats.write_dctable((date, "cam1"))
+            del stats.statdict[(date, "cam1")]
+        origtables = stats.ROLLUP_BUILD_TABLES
+        stats.ROLLUP_BUILD_TABLES = 2
+        try:
+            stats.rollups = None
+            stats.rollups_pending.clear()
+            for unused_i in range(2):
+                stats.update_rollups()
+                assert stats.rollups_building
+                assert not os.path.exists(stats.rollup_path("daily", "cam1"))
+                assert not [k for k in stats.statdict if k[1] == "cam1"]
+            stats.update_rollups()
+            assert not stats.rollups_building
+            with open(stats.rollup_path("daily", "cam1"), "rb") as f:
+                rows = list(csv.reader(f))[1:]
+            assert [r[0] for r in rows] == dates
+        finally:
+            stats.ROLLUP_BUILD_TABLES = origtables
+            stats.rollups = None
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testStats']
     unittest.main()
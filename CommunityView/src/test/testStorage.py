@@ -0,0 +1,100 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import os
+import shutil
+import tempfile
+import imageindex
+import storage
+
+MB = 1 << 20
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.index = imageindex.ImageIndex(os.path.join(self.root, "index.db"))
+        for day in ("2014-06-01", "2014-06-02", "2014-06-03"):
+            for cam in ("cam1", "cam2"):
+                indir = os.path.join(self.root, day, cam)
+                os.makedirs(indir)
+                self.index.sync_incoming(day, cam, indir, [])
+                self.index.add_bytes(day, cam, 10*MB, 2*MB)
+        self.orig_disk_usage = storage.disk_usage
+        self.free = 0
+        storage.disk_usage = lambda path: (100*MB, self.free)
+
+    def tearDown(self):
+        storage.disk_usage = self.orig_disk_usage
+        self.index.close()
+        shutil.rmtree(self.root, True)
+
+    def test000below_high_water(self):
+        """Nothing is chosen below the high water mark, or if it's 0, but the
+        usage is still found for the stats."""
+        self.free = 20*MB
+        assert storage.plan(self.index, self.root, "2014-06-03", 90, 85) \
+                == ([], [])
+        self.free = 0
+        assert storage.plan(self.index, self.root, "2014-06-03", 0, 85) \
+                == ([], [])
+        assert storage.last_usage == (0, 60*MB, 12*MB)
+
+    def test010strip_oldest_first(self):
+        """Derivatives are deleted from the oldest days first, and no more
+        than needed."""
+        self.free = 9*MB        # 91% full; 6 MB over 85%
+        (strip, days) = storage.plan(self.index, self.root, "2014-06-03",
+                                     90, 85)
+        assert strip == [("2014-06-01", "cam1"), ("2014-06-01", "cam2"),
+                         ("2014-06-02", "cam1")]
+        assert days == []
+        for (day, cam) in strip:
+            self.index.set_stripped(day, cam, MB / 4)
+        (strip, days) = storage.plan(self.index, self.root, "2014-06-03",
+                                     90, 85)
+        assert strip == [("2014-06-02", "cam2")]
+
+    def test020delete_oldest_days(self):
+        """When stripping the derivatives isn't enough, the oldest days are
+        deleted, but never today."""
+        self.free = 0           # 100% full; 15 MB over 85%
+        (strip, days) = storage.plan(self.index, self.root, "2014-06-03",
+                                     90, 85)
+        assert days == ["2014-06-01"]
+        assert strip == [("2014-06-02", "cam1"), ("2014-06-02", "cam2")]
+        (strip, days) = storage.plan(self.index, self.root, "2014-06-02",
+                                     50, 10)
+        assert days == ["2014-06-01"]
+
+    def test030import_bytes(self):
+        """The bytes of a camera-day are found by listing its dirs when it's
+        imported into the index."""
+        indir = os.path.join(self.root, "2014-06-04", "cam1")
+        os.makedirs(os.path.join(indir, "hires"))
+        with open(os.path.join(indir, "hires", "a.jpg"), "w") as f:
+            f.write("x" * 1000)
+        self.index.sync_incoming("2014-06-04", "cam1", indir, [])
+        assert self.index.usage()[-1] == ("2014-06-04", "cam1", 1000, 0, 0)
+
+if __name__ == "__main__":
+    unittest.main()
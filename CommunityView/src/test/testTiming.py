@@ -0,0 +1,85 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import threading
+import timing
+
+class TestTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.enabled = timing.enabled
+        timing.enabled = True
+        timing.take()   # discard anything timed before the test
+
+    def tearDown(self):
+        timing.enabled = self.enabled
+
+    def test000take(self):
+        """take() returns the time and count of each stage added by all the
+        threads since the last call."""
+        def work():
+            timing.stop(timing.ENCODE, timing.start())
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+        work()
+        stages = timing.take()
+        assert len(stages) == len(timing.STAGES)
+        assert stages[timing.ENCODE][1] == 2
+        assert stages[timing.ENCODE][0] >= 0
+        assert stages[timing.DECODE] == (0.0, 0)
+        assert timing.take()[timing.ENCODE] == (0.0, 0)
+
+    def test010since_add(self):
+        """The amounts added since a snapshot can be added to another
+        thread's totals, as for image worker processes."""
+        snap = timing.snapshot()
+        timing.stop(timing.MOVE, timing.start())
+        amounts = timing.since(snap)
+        assert amounts[len(timing.STAGES) + timing.MOVE] == 1
+        t = threading.Thread(target=timing.add, args=(amounts,))
+        t.start()
+        t.join()
+        assert timing.take()[timing.MOVE][1] == 2
+
+    def test015ended_threads(self):
+        """The totals of threads that have ended are kept without keeping
+        the threads' own totals."""
+        def work():
+            timing.stop(timing.RESIZE, timing.start())
+        nthreads = len(timing._threads)
+        for unused_i in range(100):
+            t = threading.Thread(target=work)
+            t.start()
+            t.join()
+        assert len(timing._threads) <= nthreads + 1
+        assert timing.take()[timing.RESIZE][1] == 100
+
+    def test020disabled(self):
+        """Nothing is timed when timing is off."""
+        timing.enabled = False
+        timing.stop(timing.DECODE, timing.start())
+        assert timing.since(timing.snapshot()) is None
+        assert timing.take()[timing.DECODE] == (0.0, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+# 
+# This file is part of CommunityView.
+# 
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import os
+import shutil
+import tempfile
+import utils
+
+class TestWriteIfChanged(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "page.html")
+
+    def tearDown(self):
+        utils.forget_written(self.dir)
+        shutil.rmtree(self.dir)
+
+    def test000write(self):
+        assert utils.write_if_changed(self.path, "<p>one</p>")
+        assert open(self.path).read() == "<p>one</p>"
+        assert os.listdir(self.dir) == ["page.html"], "temp file left behind"
+
+    def test010unchanged(self):
+        utils.write_if_changed(self.path, "<p>one</p>")
+        ino = os.stat(self.path).st_ino
+        assert not utils.write_if_changed(self.path, "<p>one</p>")
+        assert os.stat(self.path).st_ino == ino
+
+    def test020changed(self):
+        utils.write_if_changed(self.path, "<p>one</p>")
+        assert utils.write_if_changed(self.path, "<p>two</p>")
+        assert open(self.path).read() == "<p>two</p>"
+
+    def test030unknown_file(self):
+        """A file that wasn't written by write_if_changed() is compared with
+        the content."""
+        with open(self.path, "w") as f:
+            f.write("<p>one</p>")
+        assert not utils.write_if_changed(self.path, "<p>one</p>")
+        assert utils.write_if_changed(self.path, "<p>one!</p>")
+
+    def test040bounded(self):
+        """Only the most recently written directories' files are kept."""
+        saved = utils.WRITTEN_DIRS
+        utils.WRITTEN_DIRS = 2
+        try:
+            for name in ("a", "b", "c"):
+                d = os.path.join(self.dir, name)
+                os.mkdir(d)
+                utils.write_if_changed(os.path.join(d, "page.html"), name)
+            assert os.path.join(self.dir, "a") not in utils._written
+            assert os.path.join(self.dir, "c") in utils._written
+            utils.forget_written(self.dir)
+            assert os.path.join(self.dir, "c") not in utils._written
+        finally:
+            utils.WRITTEN_DIRS = saved
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+# 
+# This file is part of CommunityView.
+# 
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import watcher
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        try:
+            self.w = watcher.Watcher(self.root)
+        except (OSError, AttributeError):
+            self.skipTest("inotify not available")
+
+    def tearDown(self):
+        self.w.stop()
+        shutil.rmtree(self.root)
+
+    def test000stop(self):
+        """The watcher returns once it's stopped."""
+        self.w.sync([])
+        t = threading.Thread(target=self.w.run)
+        t.start()
+        self.w.stop()
+        os.mkdir(os.path.join(self.root, "2014-09-01"))   # wake the read
+        t.join(5)
+        assert not t.is_alive()
+
+    def test010gives_up(self):
+        """When reading the events keeps failing, the watcher waits longer
+        after each failure, then gives up so that the directories are
+        polled instead."""
+        saved = (watcher.retry_sec, watcher.max_failures)
+        watcher.retry_sec = 0.01
+        watcher.max_failures = 3
+        watcher.watcher = self.w
+        os.close(self.w.fd)
+        self.w.fd = -1
+        try:
+            t = threading.Thread(target=self.w.run)
+            t.start()
+            t.join(5)
+            assert not t.is_alive()
+            assert watcher.watcher is None
+        finally:
+            (watcher.retry_sec, watcher.max_failures) = saved
+            watcher.watcher = None
+
+if __name__ == "__main__":
+    unittest.main()
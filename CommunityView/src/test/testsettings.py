@@ -57,4 +57,5 @@ cameras = [
 ##################################################################################
         
 root = "/tmp/survtesting"
+index_path = "/tmp/survtesting.sqlite"
 
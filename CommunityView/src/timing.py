@@ -0,0 +1,192 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Time the stages of processing an image, with little enough overhead to be
+# left on all the time.
+#
+# Each thread adds the time it spends in each stage, and the number of times
+# it goes through it, to its own running totals, so no locking is needed.  The
+# stats thread periodically takes the amounts added to the totals of all the
+# threads since it last looked.  When a thread ends, what it added since then
+# is folded into a shared total, so the threads that come and go with each
+# pass of the main loop aren't kept.  Image worker processes return the
+# amounts they added while processing an image, which are added to the
+# totals of the thread that receives the result.
+#
+# Usage:
+#     t = timing.start()
+#     ...
+#     timing.stop(timing.ENCODE, t)
+#
+# When stage_timing is off, start() returns None and stop() does nothing.
+
+import array
+import ctypes
+import ctypes.util
+import os
+import threading
+import time
+from localsettings import stage_timing
+
+# stages
+DECODE = 0      # open and decode (which happens when cropped) an image
+RESIZE = 1      # make the thumbnail and mediumres images
+ENCODE = 2      # save the thumbnail and mediumres JPEG files
+MOTION = 3      # find the differences from the master image
+MOVE = 4        # move the image to the hires dir
+IMAGEHTML = 5   # make an image's HTML page
+INDEXHTML = 6   # make a camera-day's index page
+
+STAGES = ("Decode", "Resize", "Encode", "Motion", "Move", "Image HTML",
+          "Index HTML")
+
+enabled = stage_timing
+
+
+def _monotonic_clock():
+    """Return a function that returns the seconds on a monotonic clock, or
+    time.time if there's no such clock."""
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library("rt")
+                          or ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = lib.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+clock = _monotonic_clock()
+
+# each thread's _Owner
+_local = threading.local()
+# the _Totals of all the running threads, and the amounts added by the
+# threads that have ended since they were last taken
+_lock = threading.RLock()
+_threads = {}
+_ended = array.array("d", [0.0]) * (2 * len(STAGES))
+
+
+class _Totals:
+    """A thread's running totals: an array of the seconds spent in each
+    stage followed by the number of times through each stage, and their
+    values when last taken."""
+
+    def __init__(self):
+        self.totals = array.array("d", [0.0]) * (2 * len(STAGES))
+        self.taken = self.totals[:]
+
+    def take(self, amounts):
+        """Add what was added since last taken to amounts."""
+        current = self.totals[:]
+        for i in xrange(len(current)):
+            amounts[i] += current[i] - self.taken[i]
+        self.taken = current
+
+
+class _Owner:
+    """Held only by a thread's local data, so that it's deleted when the
+    thread ends, and then folds the thread's totals into _ended."""
+
+    def __init__(self):
+        self.t = _Totals()
+        with _lock:
+            _threads[id(self)] = self.t
+
+    def __del__(self, lock=_lock, threads=_threads, ended=_ended):
+        # the module's globals may be gone already if the interpreter is
+        # exiting
+        with lock:
+            self.t.take(ended)
+            del threads[id(self)]
+
+
+def _thread_totals():
+    owner = getattr(_local, "owner", None)
+    if owner is None:
+        owner = _local.owner = _Owner()
+    return owner.t.totals
+
+
+def start():
+    """Return the start time of a stage, or None if timing is off."""
+    if not enabled:
+        return None
+    return clock()
+
+
+def stop(stage, started):
+    """Add the time since started, as returned by start(), to the stage."""
+    if started is None:
+        return
+    totals = _thread_totals()
+    totals[stage] += clock() - started
+    totals[len(STAGES) + stage] += 1
+
+
+def snapshot():
+    """Return a copy of this thread's running totals, for since()."""
+    return array.array("d", _thread_totals())
+
+
+def since(snap):
+    """Return a list of the amounts this thread added to its running totals
+    since the snapshot, or None if timing is off."""
+    if not enabled:
+        return None
+    return [now - then for (now, then) in zip(_thread_totals(), snap)]
+
+
+def add(amounts):
+    """Add amounts returned by since(), e.g., by an image worker process, to
+    this thread's running totals."""
+    if amounts is None:
+        return
+    totals = _thread_totals()
+    for i in xrange(len(amounts)):
+        totals[i] += amounts[i]
+
+
+def take():
+    """Return a list of (seconds, count) tuples, one per stage, of the time
+    spent in each stage by all threads since the last call.  Only called
+    by the stats thread."""
+    amounts = [0.0] * (2 * len(STAGES))
+    with _lock:
+        for t in _threads.values():
+            t.take(amounts)
+        for i in xrange(len(amounts)):
+            amounts[i] += _ended[i]
+            _ended[i] = 0.0
+    n = len(STAGES)
+    return [(amounts[s], int(round(amounts[n + s]))) for s in range(n)]
@@ -25,6 +25,8 @@ import os
 from localsettings import root
 import logging
 import threading
+import hashlib
+import collections
 
 def dir2date(indir):
     #extract date from indir style z:\\ftp\\12-01-2
@@ -92,12 +94,65 @@ def get_images_in_dir(indir):
         images=sorted(images)
     return images
 
+# (size, mtime, md5 digest) of the files written by write_if_changed(), by
+# directory, {dirpath: {filename: (size, mtime, digest)}}, for only the
+# WRITTEN_DIRS directories most recently written to
+WRITTEN_DIRS = 100
+_written = collections.OrderedDict()
+_written_lock = threading.Lock()
+
+def write_if_changed(path, content):
+    """Write the string content to the file at path, unless the file already
+    holds exactly that content.  The file is replaced atomically, by writing a
+    temporary file and renaming it, so that a web server never sees a
+    partially written file.  Return True if the file was written."""
+    digest = hashlib.md5(content).digest()
+    (dirpath, filename) = os.path.split(path)
+    try:
+        st = os.stat(path)
+        with _written_lock:
+            known = _written.get(dirpath, {}).get(filename)
+        if known is not None and known[:2] == (st.st_size, st.st_mtime):
+            ondisk = known[2]
+        elif st.st_size == len(content):
+            with open(path, "rb") as f:
+                ondisk = hashlib.md5(f.read()).digest()
+        else:
+            ondisk = None
+        if ondisk == digest:
+            return False
+    except (OSError, IOError):
+        pass        # doesn't exist yet
+
+    tmppath = "%s.%d.tmp" % (path, threading.current_thread().ident)
+    with open(tmppath, "wb") as f:
+        f.write(content)
+    os.rename(tmppath, path)
+    st = os.stat(path)
+    with _written_lock:
+        files = _written.pop(dirpath, None)
+        if files is None:
+            files = {}
+            while _written and len(_written) >= WRITTEN_DIRS:
+                _written.popitem(last=False)
+        _written[dirpath] = files
+        files[filename] = (st.st_size, st.st_mtime, digest)
+    return True
+
+def forget_written(dirpath):
+    """Forget the files written by write_if_changed() in dirpath and the
+    directories under it."""
+    prefix = os.path.join(dirpath, "")
+    with _written_lock:
+        for d in [d for d in _written if d == dirpath or d.startswith(prefix)]:
+            del _written[d]
+
 def set_thread_prefix(thread, pref):
     """Change the thread's name to pref-<thread number> (presuming that it was
     Thread-<thread number>.  Not for use on MainThread."""
     sr = re.search(r"(-\d+$)", thread.name)
     if sr:
-        threading.current_thread().name = "Stats" + sr.group(1)
+        thread.name = pref + sr.group(1)
     else:
         logging.warn("Can't find thread number in thread \"%s\"" % thread.name)
         
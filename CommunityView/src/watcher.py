@@ -0,0 +1,246 @@
+################################################################################
+#
+# Copyright (C) 2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of CommunityView.
+#
+# CommunityView is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CommunityView is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CommunityView.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# Watch the upload directories with Linux inotify so that newly uploaded
+# images can be processed as soon as they arrive, rather than at the next
+# poll of the directories.
+#
+# The root directory is watched for new day directories, each day directory
+# for new camera directories, and each camera directory for image files that
+# have been completely written (IN_CLOSE_WRITE) or moved into it
+# (IN_MOVED_TO).  Arrivals are recorded per day directory and picked up by
+# the image processing threads.
+#
+# inotify is accessed through the C library with ctypes.  If it isn't
+# available (e.g., not Linux), start() leaves watcher set to None and the
+# image processing threads fall back to polling the directories.  They also
+# fall back to polling if reading the events keeps failing: the watcher
+# waits longer after each failure, and after max_failures in a row it gives
+# up and sets watcher back to None.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import threading
+import time
+import atexit
+import logging
+import stats
+from utils import dir2date, set_thread_prefix
+
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ISDIR        = 0x40000000
+IN_CLOEXEC      = 0x00080000
+
+# struct inotify_event, not including the variable-length name
+_event = struct.Struct("iIII")
+
+# kinds of watched directories
+ROOT = 0
+DAY = 1
+CAM = 2
+
+_masks = {
+    ROOT:   IN_CREATE | IN_MOVED_TO,
+    DAY:    IN_CREATE | IN_MOVED_TO,
+    CAM:    IN_CLOSE_WRITE | IN_MOVED_TO,
+    }
+
+# the running watcher, if any
+watcher = None
+
+# the seconds to wait after the first failure to read the events, doubled
+# after each failure in a row up to max_retry_sec, and the number of
+# failures in a row after which the watcher gives up
+retry_sec = 1
+max_retry_sec = 60
+max_failures = 10
+
+
+class Watcher:
+
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.lock = threading.Lock()
+        self.wds = {}       # watch descriptor: (kind, path)
+        self.arrivals = {}  # daydir: set of (camera shortname, filename)
+        self.overflowed = False
+        self.stopping = False
+
+    def _add_watch(self, kind, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, _masks[kind])
+        if wd < 0:
+            e = ctypes.get_errno()
+            logging.warn("Can't watch %s: %s" % (path, os.strerror(e)))
+            return
+        with self.lock:
+            self.wds[wd] = (kind, path)
+
+    def _arrived(self, daydir, cam, filename):
+        if filename.lower().endswith(".jpg"):
+            with self.lock:
+                self.arrivals.setdefault(daydir, set()).add((cam, filename))
+
+    def _watch_day(self, daydir):
+        self._add_watch(DAY, daydir)
+        for cam in os.listdir(daydir):
+            campath = os.path.join(daydir, cam)
+            if os.path.isdir(campath):
+                self._watch_cam(campath)
+
+    def _watch_cam(self, campath):
+        self._add_watch(CAM, campath)
+        # pick up any images that arrived before the watch was in place
+        (daydir, cam) = os.path.split(campath)
+        for filename in os.listdir(campath):
+            self._arrived(daydir, cam, filename)
+
+    def sync(self, daydirs):
+        """Make sure the root dir and each of the day dirs (and the camera dirs
+        within them) are being watched.  Called on each pass of the main loop,
+        so that the watches are restored if the directories are recreated."""
+        watched = set([path for (unused_kind, path) in self.wds.values()])
+        try:
+            if self.root not in watched:
+                self._add_watch(ROOT, self.root)
+            for daydir in daydirs:
+                if daydir not in watched:
+                    self._watch_day(daydir)
+        except OSError, e:
+            logging.warn("Watcher sync failed: %s" % e)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events have been lost; have the next pass do a full rescan
+            logging.warn("inotify event queue overflowed")
+            self.overflowed = True
+            return
+        if mask & IN_IGNORED:
+            with self.lock:
+                self.wds.pop(wd, None)
+            return
+        with self.lock:
+            if wd not in self.wds:
+                return
+            (kind, path) = self.wds[wd]
+        child = os.path.join(path, name)
+        try:
+            if kind == ROOT:
+                if mask & IN_ISDIR and dir2date(name)[0] != None:
+                    self._watch_day(child)
+            elif kind == DAY:
+                if mask & IN_ISDIR:
+                    self._watch_cam(child)
+        except OSError, e:
+            # the new directory has already been removed or renamed
+            logging.debug("Can't watch %s: %s" % (child, e))
+        if kind == CAM:
+            (daydir, cam) = os.path.split(path)
+            self._arrived(daydir, cam, name)
+            if name.lower().endswith(".jpg") and mask & (IN_CLOSE_WRITE
+                                                         | IN_MOVED_TO):
+                stats.count_arrival(os.path.basename(daydir), cam)
+
+    def run(self):
+        global watcher
+        set_thread_prefix(threading.current_thread(), "Watch")
+        logging.info("Starting watcher")
+        failures = 0
+        while not self.stopping:
+            try:
+                buf = os.read(self.fd, 65536)
+                failures = 0
+                i = 0
+                while i < len(buf):
+                    (wd, mask, unused_cookie, namelen) = \
+                            _event.unpack_from(buf, i)
+                    i += _event.size
+                    name = buf[i:i+namelen].rstrip("\0")
+                    i += namelen
+                    self._handle(wd, mask, name)
+            except Exception, e:
+                if self.stopping:
+                    break
+                failures += 1
+                if failures >= max_failures:
+                    logging.error("Watcher failed %d times in a row, polling "
+                                  "for new images instead: %s" % (failures, e))
+                    if watcher is self:
+                        watcher = None
+                    self.stopping = True
+                    if getattr(e, "errno", None) != errno.EBADF:
+                        self.stop()
+                    break
+                logging.error("Unexpected exception in watcher")
+                logging.exception(e)
+                time.sleep(min(retry_sec * 2 ** (failures - 1), max_retry_sec))
+
+    def stop(self):
+        """Have run() return, and stop watching."""
+        self.stopping = True
+        if self.fd >= 0:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = -1
+
+    def has_arrivals(self, daydir):
+        """Return True if images have arrived in daydir since the last call
+        of take_arrivals() for daydir, or if events may have been lost."""
+        return self.overflowed or bool(self.arrivals.get(daydir))
+
+    def take_arrivals(self, daydir):
+        """Return the set of (camera shortname, filename) of the images that
+        have arrived in daydir since the last call, and forget them."""
+        with self.lock:
+            self.overflowed = False
+            return self.arrivals.pop(daydir, set())
+
+
+def start(root):
+    """Start the watcher thread if it is not already running.  If inotify is
+    not available, log it and leave watcher set to None."""
+    global watcher
+    if watcher is None:
+        try:
+            w = Watcher(root)
+        except (OSError, AttributeError), e:
+            logging.warn("inotify not available, polling for new images: %s"
+                         % e)
+            return
+        thread = threading.Thread(target=w.run)
+        thread.daemon = True
+        thread.start()
+        atexit.register(w.stop)
+        watcher = w